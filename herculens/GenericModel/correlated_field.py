@@ -73,6 +73,12 @@ class CorrelatedField(object):
     exponentiate : bool, optional
         Whether to return the exponential of the field, by default True. 
         For example, taking the exponential is useful to ensures non–negative values.
+    cache_harmonic_transform : bool, optional
+        Whether to evaluate the field with Herculens' own implementation of the NIFTy.re
+        forward model, by default True. All quantities that do not depend on the parameters
+        (lengths and binning of the Fourier modes, shapes of the padded field) are computed
+        once at creation, the harmonic transforms use real-input FFTs, and stacks of 2D fields
+        are evaluated as a single vectorized call. If False, the NIFTy.re model is called directly.
 
     Raises
     ------
@@ -109,6 +115,9 @@ class CorrelatedField(object):
 
             # Non-linearity
             exponentiate=True,
+
+            # Evaluation
+            cache_harmonic_transform=True,
         ):
         # Sanity checks
         if num_pix_wl < 1:
@@ -235,6 +244,15 @@ class CorrelatedField(object):
         elif self._field_type in ('3d', '2d_stack'):
             self._shape_latent = (self._num_pix_wl_tot, self._num_pix_tot, self._num_pix_tot)
             self._shape_direct = (self._num_pix_wl, self._num_pix, self._num_pix)
+        # Names of all the latent (standard normal) parameters of the field
+        models = [self._jft_model] if self._jft_model is not None else self._jft_model_list
+        self._latent_keys = tuple(k for model in models for k in model.domain.keys())
+        # Pre-compute everything that does not depend on the field parameters
+        self._cache_harmonic_transform = cache_harmonic_transform
+        self._exponentiate = exponentiate
+        self._border_xy = cropped_border_size
+        self._border_wl = cropped_border_size_wl if self._field_type == '3d' else 0
+        self._prepare_harmonic_cache()
         # Nice message to say everything went smoothly
         print(f"New '{self._field_type}' CorrelatedField model successfully created "
               f"(final shape is {str(tuple(self._shape_direct))}.")
@@ -264,10 +282,107 @@ class CorrelatedField(object):
         jnp.Array
             Field model (in direct space), as 2d or 3d array.
         """
+        if self._cache_harmonic_transform:
+            if self._field_type in ('2d', '3d'):
+                return self._model_cached(params)
+            else:
+                return self._model_cached_stack(params)
         if self._field_type in ('2d', '3d'):
             return self._model_std(self._jft_model, params)
         else:
             return self._model_stack(params)
+
+    def log_prior(self, params):
+        """Log-density of the field parameters, which are all standard normally distributed.
+
+        Parameters
+        ----------
+        params : Pytree
+            Parameters values as a Pytree (e.g. dict).
+
+        Returns
+        -------
+        float
+            Log-prior density.
+        """
+        return sum(jnp.sum(jax.scipy.stats.norm.logpdf(params[key])) for key in self._latent_keys)
+
+    def model_and_log_prior(self, params):
+        """Evaluate the model and the log-prior of its parameters in a single call,
+        e.g. to be used in a custom loss function.
+
+        Parameters
+        ----------
+        params : Pytree
+            Parameters values as a Pytree (e.g. dict).
+
+        Returns
+        -------
+        tuple of (jnp.Array, float)
+            Field model (in direct space), and log-prior density.
+        """
+        return self.model(params), self.log_prior(params)
+
+    def _prepare_harmonic_cache(self):
+        if self._field_type == '2d_stack':
+            # all bands share the same structure, hence are evaluated with the model of the first band
+            cfm = self._cfm_list[0]
+            self._cache_prefix = f'{self._param_prefix}_{self._field_key}_stack0_'
+        else:
+            cfm = self._cfm
+            self._cache_prefix = f'{self._param_prefix}_{self._field_key}_'
+        self._cache_amplitudes = cfm.get_normalized_amplitudes()
+        self._cache_zeromode = cfm.azm
+        # same grids as in `jifty_util.prepare_correlated_field()`
+        grid_shapes = [(self._num_pix_tot, self._num_pix_tot)]
+        if self._field_type == '3d':
+            grid_shapes.insert(0, (self._num_pix_wl_tot,))
+        self._cache_grids = []
+        num_dims = 0
+        for shape in grid_shapes:
+            power_distributor, total_volume = jifty_util.fourier_mode_binning(shape)
+            axes = tuple(range(num_dims, num_dims + len(shape)))
+            num_dims += len(shape)
+            self._cache_grids.append((
+                power_distributor,
+                1. / total_volume,
+                axes,
+                jifty_util.real_hartley_upper_index(shape[-1]),
+            ))
+        # slices to crop the padded field
+        crop_xy = slice(self._border_xy, self._num_pix_tot - self._border_xy)
+        crop_wl = slice(self._border_wl, self._num_pix_wl_tot - self._border_wl)
+        self._cache_crop = (crop_wl, crop_xy, crop_xy) if self._field_type == '3d' else (crop_xy, crop_xy)
+
+    def _model_cached(self, params):
+        # amplitudes of all the Fourier modes (outer product over the sub-grids)
+        amplitude = None
+        for amp, (power_distributor, _, _, _) in zip(self._cache_amplitudes, self._cache_grids):
+            amp_modes = amp(params)[power_distributor]
+            if amplitude is None:
+                amplitude = amp_modes
+            else:
+                amplitude = amplitude.reshape(amplitude.shape + (1,) * amp_modes.ndim) * amp_modes
+        field = self._cache_zeromode(params) * amplitude * params[self._cache_prefix + 'xi']
+        for _, harmonic_dvol, axes, upper_index in self._cache_grids:
+            field = harmonic_dvol * jifty_util.real_hartley(field, axes, upper_index)
+        field = self._kw_amplitude_offset['offset_mean'] + field
+        field = field[self._cache_crop]
+        if self._exponentiate:
+            field = jnp.exp(field)
+        return field
+
+    def _model_cached_stack(self, params):
+        # parameters of all bands stacked along a leading axis, with the names of the first band
+        key_base = f'{self._param_prefix}_{self._field_key}'
+        params_stack = {
+            key: jnp.stack([
+                params[key.replace(f'{key_base}_stack0_', f'{key_base}_stack{i_wl}_', 1)] 
+                for i_wl in range(self._num_pix_wl)
+            ], axis=0)
+            for key in self._jft_model_list[0].domain.keys()
+        }
+        return jax.vmap(self._model_cached)(params_stack)
     
     def _model_std(self, jft_model, params):
         return jft_model(params)[self._param_prefix]
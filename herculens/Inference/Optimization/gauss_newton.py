@@ -0,0 +1,112 @@
+# Gauss-Newton and Levenberg-Marquardt optimization over the residual vector
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+import time
+import jax
+import jax.numpy as jnp
+from jax.flatten_util import ravel_pytree
+from jax.scipy.sparse.linalg import cg
+
+from herculens.Inference.Optimization.base_optim import BaseOptimizer
+
+
+__all__ = ['GaussNewtonOptimizer']
+
+
+class GaussNewtonOptimizer(BaseOptimizer):
+    """Minimizes 0.5 * sum(r**2), where r is the vector of weighted residuals
+    of the model (see `Loss.residuals()`), with the Gauss-Newton or Levenberg-Marquardt method.
+
+    The normal equations (J^T J + damping * I) delta = - J^T r are solved with conjugate gradients,
+    where the products with J and J^T are computed as Jacobian-vector and vector-Jacobian products,
+    such that the Jacobian of the residuals is never built.
+    NOTE: non-Gaussian prior terms, that cannot be written as residuals, are ignored during the optimization.
+    NOTE: a factor site, e.g. numpyro.factor('regul', - 0.5 * strength * jnp.sum(D(p)**2)), contributes
+    a single residual sqrt(-2 * log_factor), whose Jacobian has rank one. J^T J then only captures the
+    curvature of the factor along its gradient, which slows down the convergence. Quadratic terms should
+    instead be added with numpyro_util.residual_factor('regul', jnp.sqrt(strength) * D(p)), which exposes
+    the full vector of residuals.
+    """
+
+    def run(self, init_params, method='LM', max_iterations=50, init_damping=1e-3,
+            damping_factor=10., tol=1e-6, cg_tol=1e-6, cg_maxiter=100):
+        """
+        Runs the optimization as a single compiled loop.
+
+        :param init_params: initial parameters
+        :param method: 'LM' for Levenberg-Marquardt (adaptive damping, steps that increase
+        the objective are rejected), or 'GN' for Gauss-Newton (fixed damping, all steps accepted)
+        :param max_iterations: maximum number of iterations
+        :param init_damping: initial damping (for 'GN', constant damping that regularizes
+        the normal equations)
+        :param damping_factor: factor by which the damping is decreased (resp. increased)
+        after an accepted (resp. rejected) step, for 'LM' only
+        :param tol: the optimization stops when the relative decrease of the objective
+        after an accepted step is below this tolerance
+        :param cg_tol: tolerance of the conjugate gradient solver
+        :param cg_maxiter: maximum number of conjugate gradient iterations per step
+        :return: best-fit parameters, log-likelihood at best-fit, extra fields, runtime
+        """
+        if method not in ('LM', 'GN'):
+            raise ValueError(f"Method '{method}' is not supported (choose 'LM' or 'GN').")
+        adaptive = method == 'LM'
+        x0, unravel_fn = ravel_pytree(init_params)
+        residuals_flat = lambda x: self.loss.residuals(unravel_fn(x))
+        objective = lambda r: jnp.nan_to_num(0.5 * jnp.sum(r**2), nan=jnp.inf)
+
+        def step(x, r, damping):
+            _, jvp_fn = jax.linearize(residuals_flat, x)
+            vjp_fn = jax.linear_transpose(jvp_fn, x)
+            g = vjp_fn(r)[0]
+            normal_op = lambda v: vjp_fn(jvp_fn(v))[0] + damping * v
+            delta = cg(normal_op, -g, tol=cg_tol, maxiter=cg_maxiter)[0]
+            x_new = x + delta
+            return x_new, residuals_flat(x_new)
+
+        def cond_fn(state):
+            _, _, _, _, it, converged, _ = state
+            return jnp.logical_and(it < max_iterations, jnp.logical_not(converged))
+
+        def body_fn(state):
+            x, r, loss, damping, it, _, history = state
+            x_new, r_new = step(x, r, damping)
+            loss_new = objective(r_new)
+            accept = jnp.logical_or(loss_new < loss, not adaptive)
+            rel_decrease = (loss - loss_new) / jnp.maximum(jnp.abs(loss), 1e-30)
+            converged = jnp.logical_and(accept, jnp.abs(rel_decrease) < tol)
+            if adaptive:
+                damping = jnp.where(accept, damping / damping_factor, damping * damping_factor)
+                # the step can no longer be improved
+                converged = jnp.logical_or(converged, damping > 1e15)
+            x = jnp.where(accept, x_new, x)
+            r = jnp.where(accept, r_new, r)
+            loss = jnp.where(accept, loss_new, loss)
+            history = history.at[it].set(loss)
+            return x, r, loss, damping, it + 1, converged, history
+
+        @jax.jit
+        def optimize(x0):
+            r0 = residuals_flat(x0)
+            init_state = (x0, r0, objective(r0), jnp.asarray(init_damping, dtype=x0.dtype),
+                          0, False, jnp.full(max_iterations, jnp.nan, dtype=x0.dtype))
+            return jax.lax.while_loop(cond_fn, body_fn, init_state)
+
+        start = time.time()
+        x, _, _, damping, num_iterations, converged, history = optimize(x0)
+        x.block_until_ready()
+        runtime = time.time() - start
+
+        best_fit = unravel_fn(x)
+        logL_best_fit = - self.loss.function(best_fit)
+        num_iterations = int(num_iterations)
+        extra_fields = {
+            'loss_history': history[:num_iterations],  # 0.5 * chi2 (incl. Gaussian priors and regularization)
+            'num_iterations': num_iterations,
+            'converged': bool(converged),
+            'damping': damping,
+        }
+        return best_fit, logL_best_fit, extra_fields, runtime
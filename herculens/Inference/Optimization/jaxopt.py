@@ -8,12 +8,14 @@ __author__ = 'aymgal', 'austinpeel'
 import time
 from copy import deepcopy
 import jax
+import jax.numpy as jnp
 import jaxopt
 
 from herculens.Inference.Optimization.base_optim import BaseOptimizer
+from herculens.Util.checkpoint_util import save_checkpoint, load_checkpoint, get_resume_path
 
 
-__all__ = ['JaxoptOptimizer']
+__all__ = ['JaxoptOptimizer', 'build_jaxopt_solver']
 
 
 class JaxoptOptimizer(BaseOptimizer):
@@ -41,18 +43,16 @@ class JaxoptOptimizer(BaseOptimizer):
             extra_fields['param_history'] = metrics.get_param_history()
         return best_fit, logL_best_fit, extra_fields, runtime
 
-    def run(self, init_params, method='BFGS', progress_bar=False, **solver_kwargs):
-        if method == 'BFGS':
-            solver = jaxopt.BFGS(self.function_optim, value_and_grad=False, 
-                                 **solver_kwargs)
-        elif method == 'LBFGS':
-            solver = jaxopt.LBFGS(self.function_optim, value_and_grad=False, 
-                                  **solver_kwargs)
-        elif method == 'LM':
-            solver = jaxopt.LevenbergMarquardt(self.function_optim_LM_scalar, 
-                                               **solver_kwargs)
-        else:
-            raise NotImplementedError
+    def run(self, init_params, method='BFGS', progress_bar=False, 
+            checkpoint_path=None, checkpoint_every=100, resume=None, **solver_kwargs):
+        """
+        Optional checkpointing: if `checkpoint_path` is provided, the parameters, solver state 
+        and loss history are written to that .npz file every `checkpoint_every` iterations.
+        The run can be continued exactly from the last checkpoint by setting `resume` to the 
+        checkpoint path (or to True to resume from `checkpoint_path` if it exists), 
+        using the same settings and initial parameters (the latter define the structure of the pytrees).
+        """
+        solver = build_jaxopt_solver(self, method, **solver_kwargs)
 
         # Defines and jits a single solver update
         @jax.jit
@@ -69,19 +69,40 @@ class JaxoptOptimizer(BaseOptimizer):
         # Gradient descent loop
         maxiter = solver_kwargs.pop('maxiter')
 
+        loss_history = jnp.zeros(0)
+        start_iteration = 0
+        resume_path = get_resume_path(resume, checkpoint_path)
+        if resume_path is not None:
+            checkpoint = load_checkpoint(resume_path, like=(0, params, state, loss_history))
+            start_iteration, params, state, loss_history = checkpoint
+            start_iteration = int(start_iteration)
+
         start_time = time.time()
         if progress_bar:
             # param_history = []
-            loss_history = []
-            for i in self._for_loop(range(maxiter), progress_bar, 
-                                    total=maxiter, 
+            loss_history = list(loss_history)
+            for i in self._for_loop(range(start_iteration, maxiter), progress_bar, 
+                                    total=maxiter, initial=start_iteration,
                                     desc=f"jaxopt.{method}"):
                 (params, state), loss_val = step((params, state), None)
                 loss_history.append(loss_val)
                 # if return_param_history is True:
                 #     param_history.append(params)
+                if checkpoint_path is not None and ((i + 1) % checkpoint_every == 0 or i == maxiter - 1):
+                    save_checkpoint(checkpoint_path, (i + 1, params, state, jnp.array(loss_history)))
+        elif checkpoint_path is not None:
+            # scan over chunks of iterations, saving a checkpoint after each chunk
+            iteration = start_iteration
+            while iteration < maxiter:
+                num_steps = min(checkpoint_every, maxiter - iteration)
+                (params, state), losses = jax.lax.scan(step, (params, state), None, length=num_steps)
+                loss_history = jnp.concatenate([loss_history, losses])
+                iteration += num_steps
+                save_checkpoint(checkpoint_path, (iteration, params, state, loss_history))
         else:
-            (params, state), loss_history = jax.lax.scan(step, (params, state), None, length=maxiter)
+            (params, state), losses = jax.lax.scan(step, (params, state), None, 
+                                                   length=maxiter - start_iteration)
+            loss_history = jnp.concatenate([loss_history, losses])
         runtime = time.time() - start_time
 
         # start_time = time.time()
@@ -97,6 +118,23 @@ class JaxoptOptimizer(BaseOptimizer):
         return best_fit, logL_best_fit, extra_fields, runtime
 
 
+def build_jaxopt_solver(optimizer, method, **solver_kwargs):
+    """Returns the jaxopt solver ('BFGS', 'LBFGS' or 'LM') minimizing the 
+    objective of a BaseOptimizer instance."""
+    if method == 'BFGS':
+        solver = jaxopt.BFGS(optimizer.function_optim, value_and_grad=False, 
+                             **solver_kwargs)
+    elif method == 'LBFGS':
+        solver = jaxopt.LBFGS(optimizer.function_optim, value_and_grad=False, 
+                              **solver_kwargs)
+    elif method == 'LM':
+        solver = jaxopt.LevenbergMarquardt(optimizer.function_optim_LM_scalar, 
+                                           **solver_kwargs)
+    else:
+        raise NotImplementedError
+    return solver
+
+
 class MinimizeMetrics(object):
     """simple callable class used as callback in scipy.optimize.minimize method"""
     
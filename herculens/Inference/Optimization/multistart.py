@@ -0,0 +1,176 @@
+# Handles optimization of a loss function from multiple starting points
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+import time
+import numpy as np
+import jax
+import jax.numpy as jnp
+import optax
+
+from herculens.Inference.Optimization.base_optim import BaseOptimizer
+from herculens.Inference.Optimization.optax import build_optax_optimizer
+from herculens.Inference.Optimization.jaxopt import build_jaxopt_solver
+
+
+__all__ = ['MultiStartOptimizer']
+
+
+_OPTAX_ALGORITHMS = ('adabelief', 'radam', 'adam')
+_JAXOPT_METHODS = ('BFGS', 'LBFGS', 'LM')
+
+
+class MultiStartOptimizer(BaseOptimizer):
+    """Optimizes the loss function from a batch of initial points at once.
+
+    The update step of an optax or jaxopt optimizer is vectorized (with `jax.vmap`)
+    over the batch of starting points, and iterated within a `jax.lax.scan`.
+    The optimization can be split into several stages, after each of which
+    only the most promising starting points (lowest loss) are kept.
+    """
+
+    def __init__(self, loss, projection_fn=None, **kwargs):
+        super().__init__(loss, **kwargs)
+        self._projection_fn = projection_fn
+
+    def run(self, init_params, algorithm='adabelief', max_iterations=100,
+            num_stages=1, keep_fraction=0.5, init_learning_rate=1e-2,
+            schedule_learning_rate=True, **solver_kwargs):
+        """Runs the optimization from all starting points.
+
+        Parameters
+        ----------
+        init_params : list of pytrees or pytree
+            Either a list of initial parameters pytrees, or a single pytree
+            whose leaves have a leading (batch) dimension, one per starting point.
+        algorithm : str, optional
+            Either an optax algorithm ('adabelief', 'radam', 'adam') or
+            a jaxopt method ('BFGS', 'LBFGS', 'LM'). By default 'adabelief'.
+        max_iterations : int, optional
+            Total number of iterations, by default 100.
+        num_stages : int, optional
+            Number of stages the iterations are split into. After each stage
+            (but the last), only a fraction `keep_fraction` of the remaining
+            starting points are further optimized. By default 1 (no rejection).
+        keep_fraction : float, optional
+            Fraction of starting points kept after each stage, by default 0.5.
+        init_learning_rate : float, optional
+            Initial learning rate (only for optax algorithms), by default 1e-2.
+        schedule_learning_rate : bool, optional
+            Whether to use an exponential decay of the learning rate
+            (only for optax algorithms), by default True.
+        solver_kwargs : dict, optional
+            Additional keyword arguments passed to the jaxopt solver.
+
+        Returns
+        -------
+        tuple
+            Best-fit parameters, log-likelihood at best-fit, dictionary of extra fields
+            and runtime. The extra fields contain the loss history of each starting
+            point ('loss_history', shape (num_starts, max_iterations), NaN once a
+            starting point is rejected), the final parameters of each starting
+            point ('final_params'), their final loss ('final_loss'), the index of
+            the best starting point ('best_index') and the stage at which each
+            starting point has been rejected ('rejected_at_stage', -1 if never).
+        """
+        if not 0. < keep_fraction <= 1.:
+            raise ValueError("keep_fraction must be in the range (0, 1].")
+        if num_stages < 1 or num_stages > max_iterations:
+            raise ValueError("num_stages must be between 1 and max_iterations.")
+        params = self._batch_params(init_params)
+        num_starts = jax.tree_util.tree_leaves(params)[0].shape[0]
+        init_fn, update_fn = self._get_update_functions(
+            algorithm, max_iterations, init_learning_rate,
+            schedule_learning_rate, solver_kwargs,
+        )
+
+        def run_stage(params, state, num_iterations):
+            def step(carry, _):
+                params, state = carry
+                params, state, loss_val = update_fn(params, state)
+                return (params, state), loss_val
+            return jax.lax.scan(step, (params, state), None, length=num_iterations)
+
+        run_stage_batched = jax.jit(jax.vmap(run_stage, in_axes=(0, 0, None)),
+                                    static_argnums=(2,))
+
+        loss_history = np.full((num_starts, max_iterations), np.nan)
+        rejected_at_stage = np.full(num_starts, -1, dtype=int)
+        active = np.arange(num_starts)
+        active_params = params
+        active_state = jax.vmap(init_fn)(params)
+        stage_lengths = [len(a) for a in np.array_split(np.arange(max_iterations), num_stages)]
+        start_time = time.time()
+        iteration = 0
+        for stage, num_iterations in enumerate(stage_lengths):
+            (active_params, active_state), losses = run_stage_batched(
+                active_params, active_state, num_iterations)
+            loss_history[active, iteration:iteration+num_iterations] = np.asarray(losses)
+            iteration += num_iterations
+            params = jax.tree_util.tree_map(lambda p, q: p.at[active].set(q), params, active_params)
+            if stage < num_stages - 1:
+                # keep only the most promising starting points
+                num_keep = max(1, int(np.ceil(keep_fraction * len(active))))
+                order = np.argsort(np.nan_to_num(loss_history[active, iteration-1], nan=np.inf))
+                keep, reject = np.sort(order[:num_keep]), order[num_keep:]
+                rejected_at_stage[active[reject]] = stage
+                active = active[keep]
+                active_params = jax.tree_util.tree_map(lambda p: p[keep], active_params)
+                active_state = jax.tree_util.tree_map(lambda s: s[keep], active_state)
+        runtime = time.time() - start_time
+
+        final_loss = np.asarray(jax.vmap(self.loss.function)(params))
+        # only starting points that went through all stages are considered for the best fit
+        best_index = int(active[np.argmin(np.nan_to_num(final_loss[active], nan=np.inf))])
+        best_fit = jax.tree_util.tree_map(lambda p: p[best_index], params)
+        logL_best_fit = - self.loss.function(best_fit)
+        extra_fields = {
+            'loss_history': loss_history,
+            'final_params': params,
+            'final_loss': final_loss,
+            'best_index': best_index,
+            'rejected_at_stage': rejected_at_stage,
+        }
+        return best_fit, logL_best_fit, extra_fields, runtime
+
+    def _get_update_functions(self, algorithm, max_iterations, init_learning_rate,
+                              schedule_learning_rate, solver_kwargs):
+        if algorithm.lower() in _OPTAX_ALGORITHMS:
+            optim = build_optax_optimizer(algorithm, max_iterations, init_learning_rate=init_learning_rate,
+                                          schedule_learning_rate=schedule_learning_rate)
+
+            def update_fn(params, opt_state):
+                loss_val, grads = self.function_optim_with_grad(params)
+                updates, opt_state = optim.update(grads, opt_state, params)
+                params = optax.apply_updates(params, updates)
+                params = self.apply_projections(params)
+                return params, opt_state, loss_val
+
+            return optim.init, update_fn
+
+        elif algorithm in _JAXOPT_METHODS:
+            solver = build_jaxopt_solver(self, algorithm, **solver_kwargs)
+
+            def update_fn(params, state):
+                params, state = solver.update(params, state)
+                params = self.apply_projections(params)
+                return params, state, self.function_optim(params)
+
+            return solver.init_state, update_fn
+
+        raise ValueError(f"Algorithm '{algorithm}' is not supported "
+                         f"(choose from {_OPTAX_ALGORITHMS + _JAXOPT_METHODS}).")
+
+    def apply_projections(self, params):
+        if self._projection_fn is not None:
+            params = self._projection_fn(params)
+        return params
+
+    @staticmethod
+    def _batch_params(init_params):
+        if isinstance(init_params, list):
+            return jax.tree_util.tree_map(lambda *p: jnp.stack(p, axis=0), *init_params)
+        return jax.tree_util.tree_map(jnp.asarray, init_params)
@@ -8,14 +8,16 @@ __author__ = 'aymgal', 'austinpeel'
 import time
 from copy import deepcopy
 from functools import partial
+import jax
 from jax import jit
 import jax.numpy as jnp
 import optax
 
 from herculens.Inference.Optimization.base_optim import BaseOptimizer
+from herculens.Util.checkpoint_util import save_checkpoint, load_checkpoint, get_resume_path
 
 
-__all__ = ['OptaxOptimizer']
+__all__ = ['OptaxOptimizer', 'build_optax_optimizer']
 
 
 class OptaxOptimizer(BaseOptimizer):
@@ -29,47 +31,49 @@ class OptaxOptimizer(BaseOptimizer):
 
     def run(self, init_params, algorithm='adabelief', max_iterations=100, min_iterations=None,
             init_learning_rate=1e-2, schedule_learning_rate=True, 
-            stop_at_loss_increase=False, progress_bar=True, return_param_history=False):
+            stop_at_loss_increase=False, progress_bar=True, return_param_history=False,
+            checkpoint_path=None, checkpoint_every=100, resume=None):
+        """
+        Optional checkpointing: if `checkpoint_path` is provided, the parameters, optimizer state 
+        and history are written to that .npz file every `checkpoint_every` iterations.
+        The run can be continued exactly from the last checkpoint by setting `resume` to the 
+        checkpoint path (or to True to resume from `checkpoint_path` if it exists), 
+        using the same settings and initial parameters (the latter define the structure of the pytrees).
+        """
         if min_iterations is None:
             min_iterations = max_iterations
-        if schedule_learning_rate is True:
-            # Exponential decay of the learning rate
-            scheduler = optax.exponential_decay(
-                init_value=init_learning_rate, 
-                decay_rate=0.99, # NOTE: this has never been fine-tuned (taken from optax examples)
-                transition_steps=max_iterations)
-
-            if algorithm.lower() == 'adabelief':
-                scale_algo = optax.scale_by_belief()
-            elif algorithm.lower() == 'radam':
-                scale_algo = optax.scale_by_radam()
-            elif algorithm.lower() == 'adam':
-                scale_algo = optax.scale_by_adam()
-            else:
-                raise ValueError(f"Optax algorithm '{algorithm}' is not supported")
-
-            # Combining gradient transforms using `optax.chain`
-            optim = optax.chain(
-                #optax.clip_by_global_norm(1.0),  # clip by the gradient by the global norm # TODO: what is this used for?
-                scale_algo,  # use the updates from the chosen optimizer
-                optax.scale_by_schedule(scheduler),  # Use the learning rate from the scheduler
-                optax.scale(-1.)  # because gradient *descent*
-            )
-        else:
-            if algorithm.lower() == 'adabelief':
-                optim = optax.adabelief(init_learning_rate)
-            elif algorithm.lower() == 'radam':
-                optim = optax.radam(init_learning_rate)
-            elif algorithm.lower() == 'adam':
-                optim = optax.adam(init_learning_rate)
-            else:
-                raise ValueError(f"Optax algorithm '{algorithm}' is not supported")
+        optim = build_optax_optimizer(algorithm, max_iterations, init_learning_rate=init_learning_rate,
+                                      schedule_learning_rate=schedule_learning_rate)
 
         # Initialise optimizer state
         #params = self._param.current_values(as_kwargs=False, restart=restart_from_init, copy=True)
         params = deepcopy(init_params)
         opt_state = optim.init(params)
         prev_params, prev_loss_val = params, 1e10
+        param_history = []
+        loss_history = []
+        start_iteration, done = 0, False
+
+        def get_checkpoint(iteration, done):
+            checkpoint = {
+                'iteration': iteration, 'done': done,
+                'params': params, 'opt_state': opt_state,
+                'prev_params': prev_params, 'prev_loss': prev_loss_val,
+                'loss_history': jnp.array(loss_history),
+            }
+            if return_param_history is True:
+                checkpoint['param_history'] = _stack_pytrees(param_history, like=params)
+            return checkpoint
+
+        resume_path = get_resume_path(resume, checkpoint_path)
+        if resume_path is not None:
+            checkpoint = load_checkpoint(resume_path, like=get_checkpoint(0, False))
+            start_iteration, done = int(checkpoint['iteration']), bool(checkpoint['done'])
+            params, opt_state = checkpoint['params'], checkpoint['opt_state']
+            prev_params, prev_loss_val = checkpoint['prev_params'], checkpoint['prev_loss']
+            loss_history = list(checkpoint['loss_history'])
+            if return_param_history is True:
+                param_history = _unstack_pytrees(checkpoint['param_history'])
 
         @jit
         def gd_step(params, opt_state):
@@ -80,21 +84,25 @@ class OptaxOptimizer(BaseOptimizer):
             return params, opt_state, loss_val
 
         # Gradient descent loop
-        param_history = []
-        loss_history = []
         start_time = time.time()
-        for i in self._for_loop(range(max_iterations), progress_bar, 
-                                total=max_iterations, 
+        iterations = range(max_iterations if done else start_iteration, max_iterations)
+        for i in self._for_loop(iterations, progress_bar, 
+                                total=max_iterations, initial=iterations.start,
                                 desc=f"optax.{algorithm}"):
             params, opt_state, loss_val = gd_step(params, opt_state)
             if stop_at_loss_increase and i > min_iterations and loss_val > prev_loss_val:
                 params, loss_val = prev_params, prev_loss_val
-                break
+                done = True
             else:
                 loss_history.append(loss_val)
                 prev_params, prev_loss_val = params, loss_val
-            if return_param_history is True:
-                param_history.append(params)
+                if return_param_history is True:
+                    param_history.append(params)
+            if checkpoint_path is not None and (done or (i + 1) % checkpoint_every == 0 
+                                                or i == max_iterations - 1):
+                save_checkpoint(checkpoint_path, get_checkpoint(i + 1, done))
+            if done:
+                break
         runtime = time.time() - start_time
         best_fit = params
         logL_best_fit = - self.loss.function(best_fit)
@@ -103,8 +111,188 @@ class OptaxOptimizer(BaseOptimizer):
             extra_fields['param_history'] = param_history
         return best_fit, logL_best_fit, extra_fields, runtime
 
+    def run_compiled(self, init_params, algorithm='adabelief', max_iterations=100, min_iterations=0,
+                     init_learning_rate=1e-2, schedule_learning_rate=True, 
+                     loss_tolerance=0., patience=None, grad_norm_tolerance=0., 
+                     history_size=None, return_param_history=False, progress_every=None):
+        """Same as `run()`, except that the whole optimization loop is compiled 
+        (as a `jax.lax.while_loop`), such that no host-device synchronization 
+        happens between iterations. Convergence criteria are evaluated on device.
+
+        Parameters
+        ----------
+        init_params : pytree
+            Initial parameters.
+        algorithm : str, optional
+            Optax algorithm ('adabelief', 'radam' or 'adam'), by default 'adabelief'.
+        max_iterations : int, optional
+            Maximum number of iterations, by default 100.
+        min_iterations : int, optional
+            Number of iterations before convergence criteria are checked, by default 0.
+        init_learning_rate : float, optional
+            Initial learning rate, by default 1e-2.
+        schedule_learning_rate : bool, optional
+            Whether to use an exponential decay of the learning rate, by default True.
+        loss_tolerance : float, optional
+            Minimal relative decrease of the loss for an iteration to count as
+            an improvement, by default 0.
+        patience : int, optional
+            Stop after that many consecutive iterations without improvement of the loss 
+            (i.e. the loss has reached a plateau). If None (default), this criterion is not used.
+        grad_norm_tolerance : float, optional
+            Stop when the global norm of the gradient falls below this value, by default 0.
+        history_size : int, optional
+            Length of the on-device ring buffers storing the loss (and parameters) history.
+            Only the last `history_size` iterations are returned. By default `max_iterations`.
+        return_param_history : bool, optional
+            If True, also store the parameters history, by default False.
+        progress_every : int, optional
+            If not None, prints the current loss every `progress_every` iterations
+            (through `jax.debug.callback`). By default None.
+
+        Returns
+        -------
+        tuple
+            Best-fit parameters (with lowest loss), log-likelihood at best-fit, 
+            dictionary of extra fields and runtime.
+        """
+        optim = build_optax_optimizer(algorithm, max_iterations, init_learning_rate=init_learning_rate,
+                                      schedule_learning_rate=schedule_learning_rate)
+        if history_size is None:
+            history_size = max_iterations
+        if patience is None:
+            patience = max_iterations + 1
+        params = deepcopy(init_params)
+        opt_state = optim.init(params)
+
+        def print_progress(i, loss_val):
+            print(f"optax.{algorithm} iteration {int(i)}/{max_iterations}: loss = {float(loss_val):.6e}")
+
+        def cond_fun(carry):
+            i, stop = carry[0], carry[1]
+            return (i < max_iterations) & jnp.logical_not(stop)
+
+        def body_fun(carry):
+            (i, _, params, opt_state, best_loss, best_params, num_bad, 
+             _, loss_buffer, param_buffer) = carry
+            loss_val, grads = self.function_optim_with_grad(params)
+            grad_norm = optax.global_norm(grads)
+            if progress_every is not None:
+                jax.lax.cond(
+                    i % progress_every == 0,
+                    lambda: jax.debug.callback(print_progress, i, loss_val),
+                    lambda: None,
+                )
+            # track the best parameters, and the number of iterations without improvement
+            improved = loss_val < best_loss - loss_tolerance * jnp.abs(best_loss)
+            is_best = loss_val < best_loss
+            best_loss = jnp.where(is_best, loss_val, best_loss)
+            best_params = jax.tree_util.tree_map(
+                lambda p, b: jnp.where(is_best, p, b), params, best_params)
+            num_bad = jnp.where(improved, 0, num_bad + 1)
+            # ring buffers for the history
+            loss_buffer = loss_buffer.at[i % history_size].set(loss_val)
+            if return_param_history is True:
+                param_buffer = jax.tree_util.tree_map(
+                    lambda b, p: b.at[i % history_size].set(p), param_buffer, params)
+            stop = (i >= min_iterations) & ((num_bad >= patience) | (grad_norm < grad_norm_tolerance))
+            # update the parameters
+            updates, opt_state = optim.update(grads, opt_state, params)
+            params = optax.apply_updates(params, updates)
+            params = self.apply_projections(params)
+            return (i + 1, stop, params, opt_state, best_loss, best_params, num_bad, 
+                    grad_norm, loss_buffer, param_buffer)
+
+        @jit
+        def optimize(params, opt_state):
+            loss_buffer = jnp.full(history_size, jnp.nan)
+            if return_param_history is True:
+                param_buffer = jax.tree_util.tree_map(
+                    lambda p: jnp.zeros((history_size,) + jnp.shape(p), dtype=jnp.result_type(p)), params)
+            else:
+                param_buffer = None
+            carry = (0, False, params, opt_state, jnp.inf, params, 0, 
+                     jnp.inf, loss_buffer, param_buffer)
+            return jax.lax.while_loop(cond_fun, body_fun, carry)
+
+        start_time = time.time()
+        (num_iterations, stop, params, opt_state, best_loss, best_fit, _, 
+         grad_norm, loss_buffer, param_buffer) = optimize(params, opt_state)
+        num_iterations = int(num_iterations)
+        runtime = time.time() - start_time
+        logL_best_fit = - self.loss.function(best_fit)
+        extra_fields = {
+            'loss_history': self._unroll_ring_buffer(loss_buffer, num_iterations),
+            'num_iterations': num_iterations,
+            'converged': bool(stop),
+            'grad_norm': grad_norm,
+        }
+        if return_param_history is True:
+            extra_fields['param_history'] = jax.tree_util.tree_map(
+                lambda b: self._unroll_ring_buffer(b, num_iterations), param_buffer)
+        return best_fit, logL_best_fit, extra_fields, runtime
+
+    @staticmethod
+    def _unroll_ring_buffer(buffer, num_iterations):
+        """Returns the content of a ring buffer in chronological order."""
+        size = buffer.shape[0]
+        if num_iterations <= size:
+            return buffer[:num_iterations]
+        return jnp.roll(buffer, - (num_iterations % size), axis=0)
+
     @partial(jit, static_argnums=(0,))
     def apply_projections(self, params):
         if self._projection_fn is not None:
             params = self._projection_fn(params)
         return params
+
+
+def _stack_pytrees(pytree_list, like):
+    if len(pytree_list) == 0:
+        return jax.tree_util.tree_map(lambda p: jnp.zeros((0,) + jnp.shape(p)), like)
+    return jax.tree_util.tree_map(lambda *p: jnp.stack(p, axis=0), *pytree_list)
+
+
+def _unstack_pytrees(stacked_pytree):
+    num = jax.tree_util.tree_leaves(stacked_pytree)[0].shape[0]
+    return [jax.tree_util.tree_map(lambda p: p[i], stacked_pytree) for i in range(num)]
+
+
+def build_optax_optimizer(algorithm, max_iterations, init_learning_rate=1e-2, 
+                          schedule_learning_rate=True):
+    """Returns the optax gradient transformation for a given algorithm name 
+    ('adabelief', 'radam' or 'adam'), optionally with an exponential decay 
+    of the learning rate over `max_iterations` steps."""
+    if schedule_learning_rate is True:
+        # Exponential decay of the learning rate
+        scheduler = optax.exponential_decay(
+            init_value=init_learning_rate, 
+            decay_rate=0.99, # NOTE: this has never been fine-tuned (taken from optax examples)
+            transition_steps=max_iterations)
+
+        if algorithm.lower() == 'adabelief':
+            scale_algo = optax.scale_by_belief()
+        elif algorithm.lower() == 'radam':
+            scale_algo = optax.scale_by_radam()
+        elif algorithm.lower() == 'adam':
+            scale_algo = optax.scale_by_adam()
+        else:
+            raise ValueError(f"Optax algorithm '{algorithm}' is not supported")
+
+        # Combining gradient transforms using `optax.chain`
+        optim = optax.chain(
+            #optax.clip_by_global_norm(1.0),  # clip by the gradient by the global norm # TODO: what is this used for?
+            scale_algo,  # use the updates from the chosen optimizer
+            optax.scale_by_schedule(scheduler),  # Use the learning rate from the scheduler
+            optax.scale(-1.)  # because gradient *descent*
+        )
+    else:
+        if algorithm.lower() == 'adabelief':
+            optim = optax.adabelief(init_learning_rate)
+        elif algorithm.lower() == 'radam':
+            optim = optax.radam(init_learning_rate)
+        elif algorithm.lower() == 'adam':
+            optim = optax.adam(init_learning_rate)
+        else:
+            raise ValueError(f"Optax algorithm '{algorithm}' is not supported")
+    return optim
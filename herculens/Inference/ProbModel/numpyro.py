@@ -7,6 +7,7 @@ __author__ = 'aymgal'
 
 
 import copy
+from functools import partial
 import jax
 import jax.numpy as jnp
 import numpyro
@@ -45,6 +46,50 @@ class NumpyroModel(BaseProbModel):
             log_prob = - my_util.potential_energy(self.model, (), {}, params)
         return log_prob
     
+    def residuals(self, params, constrained=False):
+        """returns the vector of weighted residuals r, such that the log-probability is -0.5 * sum(r**2),
+        up to a constant and up to non-Gaussian prior terms (see numpyro_util.site_residuals()).
+        For a Gaussian likelihood, this includes (data - model) / sigma, as well as the residuals
+        of Gaussian priors and of (non-positive) factor terms such as regularization terms,
+        concatenated in the order of the sites in the model.
+        """
+        if constrained is True:
+            model = handlers.substitute(self.model, data=params)
+        else:
+            model = handlers.substitute(self.model, substitute_fn=partial(my_util.unconstrain_reparam, params))
+        trace = handlers.trace(model).get_trace()
+        residuals = []
+        for name, site in trace.items():
+            if site['type'] != 'sample' or (name.startswith('_') and name.endswith('_log_det')):
+                continue  # Jacobian terms of the transforms to unconstrained space are not least-squares terms
+            site_residuals = my_util.site_residuals(site)
+            if site_residuals is not None:
+                residuals.append(site_residuals)
+        if len(residuals) == 0:
+            raise ValueError("The model does not contain any site that can be expressed as residuals.")
+        return jnp.concatenate(residuals)
+
+    def log_prior_likelihood(self, params, constrained=False):
+        """returns separately the logarithm of the prior and of the data likelihood, from a single
+        evaluation of the model. The likelihood is the sum over all observed sites, while the prior
+        includes all other sample sites, factor terms (e.g. regularization) and, in unconstrained space,
+        the Jacobian of the transforms, such that their sum is equal to log_prob().
+        """
+        if constrained is True:
+            model = handlers.substitute(self.model, data=params)
+        else:
+            model = handlers.substitute(self.model, substitute_fn=partial(my_util.unconstrain_reparam, params))
+        trace = handlers.trace(model).get_trace()
+        log_prior, log_likelihood = 0., 0.
+        for site in trace.values():
+            if site['type'] != 'sample':
+                continue
+            if site['is_observed'] and not isinstance(site['fn'], numpyro.distributions.Unit):
+                log_likelihood += my_util.site_log_prob(site)
+            else:
+                log_prior += my_util.site_log_prob(site)
+        return log_prior, log_likelihood
+
     def log_likelihood(self, params, obs_site_key='obs'):
         # returns the logarithm of the data likelihood
         return util.log_likelihood(self.model, params, batch_ndims=0)[obs_site_key]
@@ -0,0 +1,136 @@
+# Handles stochastic variational inference to approximate posterior distributions
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+import time
+import jax
+import jax.numpy as jnp
+from numpyro.infer import autoguide, Trace_ELBO, TraceMeanField_ELBO
+from numpyro.infer import SVI as NumpyroSVI
+from numpyro.infer.initialization import init_to_median, init_to_value
+from numpyro.optim import optax_to_numpyro
+
+from herculens.Inference.Optimization.optax import build_optax_optimizer
+
+
+__all__ = ['SVI']
+
+
+_GUIDES = {
+    'mean_field': autoguide.AutoNormal,
+    'low_rank': autoguide.AutoLowRankMultivariateNormal,
+    'full_rank': autoguide.AutoMultivariateNormal,
+    'bnaf': autoguide.AutoBNAFNormal,
+}
+
+_ELBOS = {
+    'trace': Trace_ELBO,
+    'mean_field': TraceMeanField_ELBO,
+}
+
+
+class SVI(object):
+    """Class that handles stochastic variational inference (SVI) using numpyro,
+    i.e. approximating the posterior distribution of parameters with a parametric guide
+    whose parameters are optimized by maximizing the evidence lower bound (ELBO).
+    It currently supports the following guides:
+    - 'mean_field': independent normal distributions (numpyro's AutoNormal)
+    - 'low_rank': multivariate normal with low-rank plus diagonal covariance (AutoLowRankMultivariateNormal)
+    - 'full_rank': multivariate normal with full covariance (AutoMultivariateNormal)
+    - 'bnaf': normalizing flow based on block neural autoregressive transforms (AutoBNAFNormal)
+
+    :param prob_model: herculens.Inference.ProbModel.numpyro.NumpyroModel instance
+    :param guide: name of the guide (see above), by default 'mean_field'
+    :param init_params: optional dictionary of (constrained) parameter values used to
+    initialize the location of the guide, e.g. a best-fit from an optimizer.
+    By default, the guide is initialized to the median of the prior.
+    :param guide_kwargs: additional keyword arguments passed to the numpyro guide
+    (e.g. 'rank' for the low-rank guide, 'num_flows' or 'hidden_factors' for BNAF)
+    """
+
+    def __init__(self, prob_model, guide='mean_field', init_params=None, **guide_kwargs):
+        if guide not in _GUIDES:
+            raise ValueError(f"Guide '{guide}' is not supported (choose from {list(_GUIDES.keys())}).")
+        self._prob_model = prob_model
+        self.guide_type = guide
+        if init_params is not None:
+            init_loc_fn = init_to_value(values=init_params)
+        else:
+            init_loc_fn = init_to_median
+        if guide == 'bnaf':
+            # BNAF is a flow, whose base distribution is always a standard normal
+            self.guide = _GUIDES[guide](self._prob_model.model, **guide_kwargs)
+        else:
+            self.guide = _GUIDES[guide](self._prob_model.model, init_loc_fn=init_loc_fn, **guide_kwargs)
+        self._svi_result = None
+
+    @property
+    def guide_params(self):
+        """Optimized parameters of the guide (after calling run())."""
+        if self._svi_result is None:
+            raise ValueError("The guide has not been optimized yet, call run() first.")
+        return self._svi_result.params
+
+    def run(self, seed, num_steps=1000, algorithm='adam', init_learning_rate=1e-2,
+            schedule_learning_rate=True, elbo='trace', num_particles=1,
+            num_samples=1000, progress_bar=False, stable_update=True, **model_kwargs):
+        """
+        Optimizes the guide and draws samples from it.
+
+        :param seed: seed of the random number generator
+        :param num_steps: number of optimization steps
+        :param algorithm: optax algorithm ('adabelief', 'radam' or 'adam')
+        :param init_learning_rate: initial learning rate
+        :param schedule_learning_rate: whether to use an exponential decay of the learning rate
+        :param elbo: 'trace' for the standard Monte Carlo ELBO, or 'mean_field' to use analytical
+        KL divergences where possible (lower variance, for 'mean_field' guides)
+        :param num_particles: number of samples used to estimate the ELBO at each step
+        :param num_samples: number of posterior samples drawn from the optimized guide
+        :param progress_bar: whether to display a progress bar; if False, the whole training loop
+        is compiled as a single `jax.lax.scan`
+        :param stable_update: whether to skip updates leading to non-finite losses
+        :param model_kwargs: keyword arguments passed to the model (and the guide), e.g. to
+        use minibatches of data through numpyro's `plate` with `subsample_size`
+        :return: samples, log-probabilities of the samples, extra fields, runtime
+        (same as other samplers)
+        """
+        if elbo not in _ELBOS:
+            raise ValueError(f"ELBO '{elbo}' is not supported (choose from {list(_ELBOS.keys())}).")
+        rng_key = jax.random.PRNGKey(seed)
+        rng_key_svi, rng_key_samples = jax.random.split(rng_key)
+        optim = build_optax_optimizer(algorithm, num_steps, init_learning_rate=init_learning_rate,
+                                      schedule_learning_rate=schedule_learning_rate)
+        svi = NumpyroSVI(self._prob_model.model, self.guide, optax_to_numpyro(optim),
+                         _ELBOS[elbo](num_particles=num_particles))
+        start = time.time()
+        self._svi_result = svi.run(rng_key_svi, num_steps, progress_bar=progress_bar,
+                                   stable_update=stable_update, **model_kwargs)
+        samples = self.sample_posterior(rng_key_samples, num_samples)
+        logL = jax.vmap(lambda p: self._prob_model.log_prob(p, constrained=True))(samples)
+        runtime = time.time() - start
+        if self.guide_type == 'bnaf':
+            # flows have no closed-form median
+            median = jax.tree_util.tree_map(lambda s: jnp.median(s, axis=0), samples)
+        else:
+            median = self.guide.median(self._svi_result.params)
+        extra_fields = {
+            'loss_history': self._svi_result.losses,  # negative ELBO
+            'guide_params': self._svi_result.params,
+            'median': median,
+        }
+        return samples, logL, extra_fields, runtime
+
+    def sample_posterior(self, prng_key, num_samples):
+        """Draws samples (in constrained space) from the optimized guide.
+
+        :param prng_key: JAX PRNG key
+        :param num_samples: number of samples
+        :return: dictionary of samples, one entry per latent site
+        """
+        samples = self.guide.sample_posterior(prng_key, self.guide_params, sample_shape=(num_samples,))
+        # keep only the latent sample sites of the model
+        latent_names = self._prob_model.get_sample().keys()
+        return {name: value for name, value in samples.items() if name in latent_names}
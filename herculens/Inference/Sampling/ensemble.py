@@ -0,0 +1,99 @@
+# Affine-invariant ensemble MCMC written in JAX
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+from functools import partial
+import jax
+import jax.numpy as jnp
+
+
+__all__ = ['run_ensemble']
+
+
+_MOVES = ('stretch', 'de')
+
+
+@partial(jax.jit, static_argnums=(0, 3, 4, 5, 6, 7))
+def run_ensemble(log_prob_fn, rng_key, init_positions, num_steps, move='stretch',
+                 stretch_scale=2., de_gamma=None, de_sigma=1e-5):
+    """Runs an ensemble of walkers with affine-invariant moves, in the spirit of emcee.
+
+    At each step, the walkers are split in two halves, and each half is updated
+    in parallel given the positions of the other half (Foreman-Mackey et al. 2013),
+    such that detailed balance is preserved. All walkers of one half are evaluated
+    with a single vectorized call to the log-probability function.
+
+    :param log_prob_fn: log-probability function of a 1D array of parameters
+    :param rng_key: JAX PRNG key
+    :param init_positions: array of shape (num_walkers, num_dims); num_walkers must be even
+    :param num_steps: number of steps
+    :param move: 'stretch' for the stretch move of Goodman & Weare (2010), 'de' for the
+    differential evolution move of ter Braak (2006). By default 'stretch'.
+    :param stretch_scale: scale parameter `a` of the stretch move, by default 2.
+    :param de_gamma: mean scaling of the differential evolution move,
+    by default 2.38 / sqrt(2 * num_dims)
+    :param de_sigma: standard deviation of the isotropic jitter added to the
+    differential evolution move, by default 1e-5
+    :return: chain of positions of shape (num_steps, num_walkers, num_dims),
+    corresponding log-probabilities of shape (num_steps, num_walkers),
+    and acceptance fraction of each walker
+    """
+    num_walkers, num_dims = init_positions.shape
+    if num_walkers % 2 != 0 or num_walkers < 4:
+        raise ValueError(f"The number of walkers must be even and at least 4 (got {num_walkers}).")
+    if move not in _MOVES:
+        raise ValueError(f"Move '{move}' is not supported (choose from {_MOVES}).")
+    if de_gamma is None:
+        de_gamma = 2.38 / jnp.sqrt(2. * num_dims)
+    half = num_walkers // 2
+    log_prob_batched = jax.vmap(log_prob_fn)
+
+    def safe_log_prob(x):
+        log_prob = log_prob_batched(x)
+        return jnp.where(jnp.isnan(log_prob), -jnp.inf, log_prob)
+
+    def propose(key, x_active, x_comp):
+        num_active, num_comp = x_active.shape[0], x_comp.shape[0]
+        key_z, key_a, key_b = jax.random.split(key, 3)
+        if move == 'stretch':
+            z = ((stretch_scale - 1.) * jax.random.uniform(key_z, (num_active,)) + 1.)**2 / stretch_scale
+            idx = jax.random.randint(key_a, (num_active,), 0, num_comp)
+            x_prop = x_comp[idx] + z[:, None] * (x_active - x_comp[idx])
+            log_factor = (num_dims - 1.) * jnp.log(z)
+        else:
+            # pairs of distinct walkers from the complementary half
+            idx_a = jax.random.randint(key_a, (num_active,), 0, num_comp)
+            idx_b = jax.random.randint(key_b, (num_active,), 0, num_comp - 1)
+            idx_b = idx_b + (idx_b >= idx_a)
+            jitter = de_sigma * jax.random.normal(key_z, x_active.shape)
+            x_prop = x_active + de_gamma * (x_comp[idx_a] - x_comp[idx_b]) + jitter
+            log_factor = jnp.zeros(num_active)
+        return x_prop, log_factor
+
+    def update_half(key, x_active, lp_active, x_comp):
+        key_prop, key_acc = jax.random.split(key)
+        x_prop, log_factor = propose(key_prop, x_active, x_comp)
+        lp_prop = safe_log_prob(x_prop)
+        log_accept = log_factor + lp_prop - lp_active
+        accepted = jnp.log(jax.random.uniform(key_acc, lp_active.shape)) < log_accept
+        x_new = jnp.where(accepted[:, None], x_prop, x_active)
+        lp_new = jnp.where(accepted, lp_prop, lp_active)
+        return x_new, lp_new, accepted
+
+    def step(carry, key):
+        x, lp = carry
+        key_1, key_2 = jax.random.split(key)
+        x_1, lp_1, acc_1 = update_half(key_1, x[:half], lp[:half], x[half:])
+        x_2, lp_2, acc_2 = update_half(key_2, x[half:], lp[half:], x_1)
+        x = jnp.concatenate([x_1, x_2], axis=0)
+        lp = jnp.concatenate([lp_1, lp_2], axis=0)
+        accepted = jnp.concatenate([acc_1, acc_2], axis=0)
+        return (x, lp), (x, lp, accepted)
+
+    init_log_probs = safe_log_prob(init_positions)
+    keys = jax.random.split(rng_key, num_steps)
+    _, (chain, log_probs, accepted) = jax.lax.scan(step, (init_positions, init_log_probs), keys)
+    return chain, log_probs, jnp.mean(accepted, axis=0)
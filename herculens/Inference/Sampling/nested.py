@@ -0,0 +1,208 @@
+# Nested sampling with batched constrained slice sampling, written in JAX
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+from functools import partial
+import jax
+import jax.numpy as jnp
+from jax.scipy.special import logsumexp
+
+
+__all__ = ['run_nested_sampling', 'nested_sampling_evidence']
+
+
+@partial(jax.jit, static_argnums=(0, 3, 4, 5, 6, 7))
+def run_nested_sampling(log_prior_likelihood_fn, rng_key, init_positions, num_delete,
+                        num_slice_steps, max_iterations, max_steps_out=10, max_shrink_steps=50,
+                        dlogz=0.1):
+    """Runs nested sampling (Skilling 2006), where the `num_delete` live points with
+    the lowest likelihoods are replaced at each iteration by new points drawn from the prior
+    constrained to higher likelihoods. New points are obtained with slice sampling along random
+    directions scaled by the covariance of the live points (as in PolyChord, Handley et al. 2015),
+    starting from randomly chosen surviving live points. All new points are evolved in parallel,
+    with a single vectorized call to the log-density, and the whole run is a single compiled loop.
+
+    :param log_prior_likelihood_fn: function of a 1D array of parameters that returns
+    the log-prior density and the log-likelihood
+    :param rng_key: JAX PRNG key
+    :param init_positions: array of shape (num_live_points, num_dims) drawn from the prior
+    :param num_delete: number of live points replaced at each iteration
+    :param num_slice_steps: number of slice sampling steps used to draw each new point
+    :param max_iterations: maximum number of iterations
+    :param max_steps_out: maximum number of stepping-out steps on each side of the slice
+    :param max_shrink_steps: maximum number of shrinking steps of the slice interval; if reached,
+    the slice sampling step is rejected
+    :param dlogz: the run stops when the estimated log-evidence remaining in the live points is below this value
+    :return: dictionary with the dead points (positions, log-likelihoods and number of live points
+    at the time of their deletion, padded with NaNs after the last iteration), the final live points
+    and their log-likelihoods, the number of iterations and of log-density evaluations,
+    and whether the stopping criterion was met
+    """
+    num_live, num_dims = init_positions.shape
+    if not 0 < num_delete < num_live:
+        raise ValueError(f"The number of deleted points ({num_delete}) must be positive "
+                         f"and lower than the number of live points ({num_live}).")
+    log_density_batched = jax.vmap(log_prior_likelihood_fn)
+
+    def safe_log_density(x):
+        log_prior, log_like = log_prior_likelihood_fn(x)
+        log_prior = jnp.where(jnp.isnan(log_prior), -jnp.inf, log_prior)
+        log_like = jnp.where(jnp.isnan(log_like), -jnp.inf, log_like)
+        return log_prior, log_like
+
+    def slice_step(key, x, log_prior, log_like, direction, log_like_min):
+        """One slice sampling step of the prior, restricted to log_like > log_like_min."""
+        key_slice, key_init, key_shrink = jax.random.split(key, 3)
+        log_height = log_prior + jnp.log(jax.random.uniform(key_slice))
+
+        def in_slice(t):
+            log_prior_t, log_like_t = safe_log_density(x + t * direction)
+            return jnp.logical_and(log_prior_t > log_height, log_like_t > log_like_min)
+
+        # stepping out
+        lower = - jax.random.uniform(key_init)
+        upper = lower + 1.
+        def step_out(bound, sign):
+            def cond_fn(state):
+                bound, i, count = state
+                return jnp.logical_and(i < max_steps_out, in_slice(bound))
+            def body_fn(state):
+                bound, i, count = state
+                return bound + sign, i + 1, count + 1
+            return jax.lax.while_loop(cond_fn, body_fn, (bound, 0, 1))
+        lower, _, count_lower = step_out(lower, -1.)
+        upper, _, count_upper = step_out(upper, +1.)
+
+        # shrinkage
+        def cond_fn(state):
+            _, _, _, _, found, i, _ = state
+            return jnp.logical_and(jnp.logical_not(found), i < max_shrink_steps)
+        def body_fn(state):
+            lower, upper, t, key, _, i, out = state
+            key, key_t = jax.random.split(key)
+            t = jax.random.uniform(key_t, minval=lower, maxval=upper)
+            log_prior_t, log_like_t = safe_log_density(x + t * direction)
+            found = jnp.logical_and(log_prior_t > log_height, log_like_t > log_like_min)
+            lower = jnp.where(t < 0., t, lower)
+            upper = jnp.where(t >= 0., t, upper)
+            return lower, upper, t, key, found, i + 1, (log_prior_t, log_like_t)
+        init_state = (lower, upper, 0., key_shrink, False, 0, (log_prior, log_like))
+        _, _, t, _, found, num_shrink, (log_prior_t, log_like_t) = jax.lax.while_loop(cond_fn, body_fn, init_state)
+        x_new = jnp.where(found, x + t * direction, x)
+        log_prior_new = jnp.where(found, log_prior_t, log_prior)
+        log_like_new = jnp.where(found, log_like_t, log_like)
+        return x_new, log_prior_new, log_like_new, count_lower + count_upper + num_shrink
+
+    def new_point(key, x, log_prior, log_like, chol, log_like_min):
+        def body_fn(carry, key):
+            x, log_prior, log_like, count = carry
+            key_dir, key_step = jax.random.split(key)
+            n = jax.random.normal(key_dir, (num_dims,))
+            direction = chol @ (n / jnp.linalg.norm(n))
+            x, log_prior, log_like, count_step = slice_step(key_step, x, log_prior, log_like, direction, log_like_min)
+            return (x, log_prior, log_like, count + count_step), None
+        keys = jax.random.split(key, num_slice_steps)
+        (x, log_prior, log_like, count), _ = jax.lax.scan(body_fn, (x, log_prior, log_like, 0), keys)
+        return x, log_prior, log_like, count
+
+    def remaining_evidence(log_like, log_z, log_x):
+        return jnp.logaddexp(log_z, jnp.max(log_like) + log_x) - log_z
+
+    def cond_fn(state):
+        it, _, log_like, _, log_z, log_x = state[:6]
+        return jnp.logical_and(it < max_iterations, remaining_evidence(log_like, log_z, log_x) > dlogz)
+
+    def body_fn(state):
+        it, x, log_like, log_prior, log_z, log_x, key, dead, num_evals = state
+        key, key_start, key_step = jax.random.split(key, 3)
+        # live points with the lowest likelihoods, in increasing order
+        _, idx_dead = jax.lax.top_k(- log_like, num_delete)
+        log_like_dead = log_like[idx_dead]
+        log_like_min = log_like_dead[-1]
+        # update of the evidence, with the expected shrinkage of the prior volume
+        num_live_dead = num_live - jnp.arange(num_delete)
+        log_x_dead = log_x - jnp.cumsum(1. / num_live_dead)
+        log_x_prev = jnp.concatenate([log_x[None], log_x_dead[:-1]])
+        log_weights = log_like_dead + log_x_prev + jnp.log(-jnp.expm1(log_x_dead - log_x_prev))
+        log_z = jnp.logaddexp(log_z, logsumexp(log_weights))
+        log_x = log_x_dead[-1]
+        # store the dead points
+        dead_positions, dead_log_like, dead_num_live = dead
+        start = it * num_delete
+        dead = (jax.lax.dynamic_update_slice(dead_positions, x[idx_dead], (start, 0)),
+                jax.lax.dynamic_update_slice(dead_log_like, log_like_dead, (start,)),
+                jax.lax.dynamic_update_slice(dead_num_live, num_live_dead, (start,)))
+        # new points from the constrained prior, starting from surviving live points
+        alive = jnp.ones(num_live, dtype=bool).at[idx_dead].set(False)
+        above = jnp.logical_and(alive, log_like > log_like_min)
+        # on a likelihood plateau, no surviving point is above the threshold: uniform draw over survivors
+        start_mask = jnp.where(jnp.any(above), above, alive)
+        idx_start = jax.random.categorical(key_start, jnp.where(start_mask, 0., -jnp.inf), shape=(num_delete,))
+        cov = jnp.cov(x, rowvar=False).reshape(num_dims, num_dims)
+        chol = jnp.linalg.cholesky(cov + 1e-12 * jnp.eye(num_dims))
+        keys = jax.random.split(key_step, num_delete)
+        x_new, log_prior_new, log_like_new, counts = jax.vmap(new_point, in_axes=(0, 0, 0, 0, None, None))(
+            keys, x[idx_start], log_prior[idx_start], log_like[idx_start], chol, log_like_min)
+        x = x.at[idx_dead].set(x_new)
+        log_like = log_like.at[idx_dead].set(log_like_new)
+        log_prior = log_prior.at[idx_dead].set(log_prior_new)
+        return it + 1, x, log_like, log_prior, log_z, log_x, key, dead, num_evals + jnp.sum(counts)
+
+    init_log_prior, init_log_like = log_density_batched(init_positions)
+    init_log_like = jnp.where(jnp.isnan(init_log_like), -jnp.inf, init_log_like)
+    max_dead = max_iterations * num_delete
+    dtype = init_positions.dtype
+    init_dead = (jnp.full((max_dead, num_dims), jnp.nan, dtype=dtype),
+                 jnp.full((max_dead,), jnp.nan, dtype=dtype),
+                 jnp.zeros((max_dead,), dtype=int))
+    init_state = (0, init_positions, init_log_like, init_log_prior,
+                  jnp.array(-jnp.inf, dtype=dtype), jnp.array(0., dtype=dtype),
+                  rng_key, init_dead, num_live)
+    num_iterations, x, log_like, _, log_z, log_x, _, dead, num_evals = jax.lax.while_loop(
+        cond_fn, body_fn, init_state)
+    return {
+        'dead_positions': dead[0],
+        'dead_log_likelihood': dead[1],
+        'dead_num_live': dead[2],
+        'live_positions': x,
+        'live_log_likelihood': log_like,
+        'num_iterations': num_iterations,
+        'num_evaluations': num_evals,
+        'converged': remaining_evidence(log_like, log_z, log_x) <= dlogz,
+    }
+
+
+def nested_sampling_evidence(log_likelihood, num_live, rng_key=None, num_volume_samples=100):
+    """Computes the log-evidence and the importance weights of the points of a nested sampling run.
+
+    :param log_likelihood: log-likelihoods of the dead points followed by the final live points,
+    in increasing order
+    :param num_live: number of live points at the time each point was deleted
+    (the final live points being removed one by one, this decreases down to 1)
+    :param rng_key: JAX PRNG key used to estimate the uncertainty of the log-evidence
+    by simulating the shrinkage of the prior volume; if None, no uncertainty is computed
+    :param num_volume_samples: number of simulated sequences of prior volumes
+    :return: log-evidence, its uncertainty (or None), information (in nats),
+    and normalized log-weights of the points
+    """
+    def evidence(log_shrinkage):
+        log_x = jnp.concatenate([jnp.zeros(1), jnp.cumsum(log_shrinkage)])
+        # widths X_{i-1} - X_i of the shells of prior volume
+        log_width = log_x[:-1] + jnp.log(-jnp.expm1(log_x[1:] - log_x[:-1]))
+        log_weights = log_likelihood + log_width
+        return logsumexp(log_weights), log_weights
+
+    # expected shrinkage, E[log t] = -1 / n
+    log_z, log_weights = evidence(- 1. / num_live)
+    log_weights = log_weights - log_z
+    information = jnp.sum(jnp.exp(log_weights) * (log_likelihood - log_z))
+    log_z_err = None
+    if rng_key is not None:
+        # t ~ Beta(n, 1), i.e. log t = log(u) / n with u ~ U(0, 1)
+        u = jax.random.uniform(rng_key, (num_volume_samples, log_likelihood.size))
+        log_z_samples = jax.vmap(lambda log_u: evidence(log_u / num_live)[0])(jnp.log(u))
+        log_z_err = jnp.std(log_z_samples)
+    return log_z, log_z_err, information, log_weights
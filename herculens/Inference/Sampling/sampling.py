@@ -6,11 +6,19 @@ __author__ = 'aymgal', 'austinpeel'
 
 
 import time
+import warnings
 import numpy as np
+from collections import namedtuple
 from functools import partial
 import jax
+import jax.numpy as jnp
+from jax.flatten_util import ravel_pytree
 
 from herculens.Inference.Sampling.base_inference import Inference
+from herculens.Inference.Sampling.ensemble import run_ensemble
+from herculens.Inference.Sampling.nested import run_nested_sampling, nested_sampling_evidence
+from herculens.Inference.Sampling.smc import run_tempered_smc
+from herculens.Util.checkpoint_util import save_checkpoint, load_checkpoint, get_resume_path
 
 
 # TODO: create separate classes for each sampler
@@ -23,13 +31,41 @@ class Sampler(Inference):
     """Class that handles sampling tasks, i.e. approximating posterior distributions of parameters.
     It currently supports:
     - Hamiltonian Monte Carlo using blackjax or numpyro
-    - Ensemble Affine Invariant MCMC using emcee
+    - Ensemble Affine Invariant MCMC, written in JAX or using emcee
+    - Nested sampling, written in JAX, for evidence computation
+    - Adaptive tempered sequential Monte Carlo, written in JAX
     """
 
-    def hmc_blackjax(self, seed, init_params, num_warmup=100, num_samples=100, #num_chains=1, 
-                     sampler_type='NUTS', use_stan_warmup=True, step_size=1e-3, inv_mass_matrix=None):
+    def hmc_blackjax(self, seed, init_params, num_warmup=100, num_samples=100, num_chains=1, 
+                     sampler_type='NUTS', use_stan_warmup=True, step_size=1e-3, inv_mass_matrix=None,
+                     chain_method='vectorized', adaptation='per_chain',
+                     checkpoint_path=None, checkpoint_every=100, resume=None):
+        """
+        Multiple chains: if `num_chains` > 1, each leaf of `init_params` must have a leading 
+        dimension of size `num_chains`. Chains are either vectorized on a single device 
+        (`chain_method='vectorized'`) or distributed over the available devices with `jax.pmap`
+        (`chain_method='parallel'`; on CPU, the number of devices can be set with the XLA flag 
+        `--xla_force_host_platform_device_count`). With Stan warmup, the step size and inverse 
+        mass matrix are either adapted for each chain (`adaptation='per_chain'`) or averaged 
+        over all chains after adaptation (`adaptation='pooled'`). Samples and log-probabilities
+        are then returned grouped by chain, and the extra fields contain the split R-hat and 
+        effective sample size of each parameter, computed on device.
+
+        Optional checkpointing: if `checkpoint_path` is provided, the sampler state, (adapted) 
+        kernel parameters and the samples drawn so far are written to that .npz file after warmup 
+        and every `checkpoint_every` steps. The run can be continued exactly from the last checkpoint 
+        by setting `resume` to the checkpoint path (or to True to resume from `checkpoint_path` if it exists),
+        using the same seed, settings and initial parameters.
+        """
         import blackjax
 
+        if chain_method not in ('vectorized', 'parallel'):
+            raise ValueError(f"Chain method '{chain_method}' is not supported ('vectorized' or 'parallel' only).")
+        if adaptation not in ('per_chain', 'pooled'):
+            raise ValueError(f"Adaptation '{adaptation}' is not supported ('per_chain' or 'pooled' only).")
+        if chain_method == 'parallel' and num_chains % jax.local_device_count() != 0:
+            raise ValueError(f"The number of chains ({num_chains}) must be a multiple of "
+                             f"the number of devices ({jax.local_device_count()}).")
         rng_key = jax.random.PRNGKey(seed)
         log_prob_fn = self.log_probability
 
@@ -45,45 +81,113 @@ class Sampler(Inference):
         else:
             raise ValueError(f"Sampler/kernel type '{sampler_type}' is not supported ('NUTS' or 'HMC' only).")
 
-        if use_stan_warmup and sampler_type.lower() == 'nuts':
+        # internally, we always consider a batch of chains
+        if num_chains == 1:
+            init_params = jax.tree_util.tree_map(lambda p: jnp.asarray(p)[None], init_params)
+
+        def split_chains(key):
+            return key[None] if num_chains == 1 else jax.random.split(key, num_chains)
+
+        stan_warmup = use_stan_warmup and sampler_type.lower() == 'nuts'
+        if stan_warmup:
             rng_key, rng_subkey = jax.random.split(rng_key)
-            
-            # update step size and inverse mass matrix during warmup with Stan
-            window_adaptation = blackjax.window_adaptation(
-                blackjax.nuts,  # we also use NUTS for warmup
-                log_prob_fn,
-                num_steps=num_warmup,
-            )
-            init_state, kernel, _ = window_adaptation.run(
-                rng_key,
-                init_params,
-            )
             # reset number of samples so we don't warmup again in the final inference
-            num_warmup = 0
-
+            num_steps = num_samples
         else:
-            kernel = jax.jit(sampler.step)
-            init_state = sampler.init(init_params)
-        
+            num_steps = num_warmup + num_samples
+        # NOTE: keys are derived from the step index, such that a resumed run draws the same keys
+        keys = jax.vmap(lambda key: jax.vmap(partial(jax.random.fold_in, key))(jnp.arange(num_steps)))(
+            split_chains(rng_key))
+
+        def get_checkpoint(iteration, state, kernel_params, positions, infos):
+            return {
+                'iteration': iteration, 'state': state, 'kernel_params': kernel_params,
+                'positions': positions, 'energy': infos.energy, 
+                'acceptance_probability': infos.acceptance_probability, 
+                'is_divergent': infos.is_divergent,
+            }
+
+        resume_path = get_resume_path(resume, checkpoint_path)
+        if resume_path is not None:
+            init_state = jax.vmap(sampler.init)(init_params)
+            like_kernel_params = {'step_size': jnp.zeros(()), 'inverse_mass_matrix': jnp.zeros(0)} if stan_warmup else {}
+            checkpoint = load_checkpoint(resume_path, like=get_checkpoint(
+                0, init_state, like_kernel_params, init_params, _InfoHistory(0, 0, 0)))
+            iteration = int(checkpoint['iteration'])
+            init_state, kernel_params = checkpoint['state'], checkpoint['kernel_params']
+            positions = checkpoint['positions']
+            infos = _InfoHistory(checkpoint['energy'], checkpoint['acceptance_probability'], 
+                                 checkpoint['is_divergent'])
+        else:
+            iteration, positions, infos = 0, None, None
+            if stan_warmup:
+                # update step size and inverse mass matrix during warmup with Stan
+                init_state, kernel_params = jax.vmap(
+                    lambda key, params: _blackjax_window_adaptation(
+                        blackjax, log_prob_fn, key, params, num_warmup)
+                )(split_chains(rng_subkey), init_params)
+                if adaptation == 'pooled':
+                    kernel_params = {
+                        # geometric mean of the step sizes
+                        'step_size': jnp.exp(jnp.mean(jnp.log(kernel_params['step_size']))),
+                        'inverse_mass_matrix': jnp.mean(kernel_params['inverse_mass_matrix'], axis=0),
+                    }
+            else:
+                init_state = jax.vmap(sampler.init)(init_params)
+                kernel_params = {}
+        per_chain_params = stan_warmup and adaptation == 'per_chain'
+
         # run the inference
-        @jax.jit
-        def one_step_single_chain(state, rng_key):
+        def one_step_single_chain(kernel_params, state, rng_key):
+            if stan_warmup:
+                kernel = blackjax.nuts(log_prob_fn, **kernel_params).step
+            else:
+                kernel = sampler.step
             state, info = kernel(rng_key, state)
-            return state, (state, info)
+            info = _InfoHistory(
+                info.energy, 
+                # the field has been renamed in blackjax 1.0
+                getattr(info, 'acceptance_rate', getattr(info, 'acceptance_probability', None)),
+                info.is_divergent,
+            )
+            return state, (state.position, info)
 
-        keys = jax.random.split(rng_key, num_warmup + num_samples)
-        _, (states, infos) = jax.lax.scan(one_step_single_chain, init_state, keys)
+        def run_single_chain(state, keys, kernel_params):
+            return jax.lax.scan(partial(one_step_single_chain, kernel_params), state, keys)
+
+        run_chains = jax.vmap(run_single_chain, in_axes=(0, 0, 0 if per_chain_params else None))
+        if chain_method == 'parallel':
+            run_chains = _pmap_over_devices(run_chains, per_chain_params)
+        else:
+            run_chains = jax.jit(run_chains)
+
+        def append(history, new):
+            if history is None:
+                return new
+            return jax.tree_util.tree_map(lambda h, n: jnp.concatenate([h, n], axis=1), history, new)
+
+        state = init_state
+        if checkpoint_path is not None and iteration == 0 and resume_path is None and stan_warmup:
+            # save the result of the warmup phase
+            save_checkpoint(checkpoint_path, get_checkpoint(
+                0, state, kernel_params, 
+                jax.tree_util.tree_map(lambda p: jnp.zeros((num_chains, 0) + jnp.shape(p)[1:]), state.position),
+                _InfoHistory(*[jnp.zeros((num_chains, 0), dtype=d) for d in (float, float, bool)])))
+        chunk_size = num_steps if checkpoint_path is None else checkpoint_every
+        while iteration < num_steps:
+            num_chunk = min(chunk_size, num_steps - iteration)
+            state, (new_positions, new_infos) = run_chains(
+                state, keys[:, iteration:iteration+num_chunk], kernel_params)
+            positions = append(positions, new_positions)
+            infos = append(infos, new_infos)
+            iteration += num_chunk
+            if checkpoint_path is not None:
+                save_checkpoint(checkpoint_path, get_checkpoint(iteration, state, kernel_params, positions, infos))
         
-        samples = states.position  #.block_until_ready()
+        samples = positions  #.block_until_ready()
         logL = infos.energy
         runtime = time.time() - start
 
-        # if len(samples.shape) == 3:  # basically if num_chains > 1
-        #     # flatten the multiple chains
-        #     s0, s1, s2 = samples.shape
-        #     samples = samples.reshape(s0*s1, s2)
-        #     logL = logL.flatten()
-
         extra_fields = {
             'step_size': step_size,
             'inverse_mass_matrix': inv_mass_matrix,
@@ -91,6 +195,21 @@ class Sampler(Inference):
             'mean_perc_divergent': 100. * np.mean(infos.is_divergent),
             #'infos': infos,
         }
+        if stan_warmup:
+            extra_fields['adapted_kernel_params'] = kernel_params
+        if num_chains > 1:
+            # convergence diagnostics on the samples following the warmup phase
+            post_warmup = jax.tree_util.tree_map(lambda p: p[:, -num_samples:], samples)
+            extra_fields['r_hat'] = jax.tree_util.tree_map(
+                blackjax.diagnostics.potential_scale_reduction, post_warmup)
+            extra_fields['ess'] = jax.tree_util.tree_map(
+                blackjax.diagnostics.effective_sample_size, post_warmup)
+        else:
+            # single chain: remove the chain dimension
+            samples = jax.tree_util.tree_map(lambda p: p[0], samples)
+            logL = logL[0]
+            if stan_warmup:
+                extra_fields['adapted_kernel_params'] = jax.tree_util.tree_map(lambda p: p[0], kernel_params)
         return samples, logL, extra_fields, runtime
 
     def hmc_numpyro(self, seed, num_warmup=100, num_samples=100, num_chains=1, 
@@ -139,6 +258,186 @@ class Sampler(Inference):
         self._param.set_posterior_samples(samples, logL)
         return samples, logL, extra_fields, runtime
 
+    def mcmc_ensemble(self, seed, init_params, num_warmup=100, num_samples=100, 
+                      move='stretch', stretch_scale=2., de_gamma=None, de_sigma=1e-5):
+        """
+        Affine-invariant ensemble MCMC (similar to emcee), where all walkers are evaluated
+        with a single vectorized and jitted call to the log-probability, inside a `jax.lax.scan`.
+
+        :param seed: seed of the random number generator
+        :param init_params: pytree of initial parameters, where each leaf has a leading dimension
+        equal to the (even) number of walkers (see also `_init_emcee_ball()`)
+        :param num_warmup: number of steps discarded as burn-in
+        :param num_samples: number of steps kept after burn-in
+        :param move: 'stretch' (Goodman & Weare 2010) or 'de' (differential evolution, ter Braak 2006)
+        :param stretch_scale: scale parameter of the stretch move
+        :param de_gamma: mean scaling of the differential evolution move (default is 2.38 / sqrt(2 * num_dims))
+        :param de_sigma: standard deviation of the jitter of the differential evolution move
+        :return: samples (pytree with leaves of leading dimension num_samples * num_walkers), 
+        log-probabilities, extra fields, runtime
+        """
+        rng_key = jax.random.PRNGKey(seed)
+        # work with flattened parameters
+        init_positions = jax.vmap(lambda p: ravel_pytree(p)[0])(init_params)
+        log_prob_fn, unravel_fn = self._flat_function(
+            'log_probability', self.log_probability, jax.tree_util.tree_map(lambda p: p[0], init_params))
+        start = time.time()
+        chain, log_probs, acceptance = run_ensemble(
+            log_prob_fn, rng_key, init_positions, num_warmup + num_samples, 
+            move=move, stretch_scale=stretch_scale, de_gamma=de_gamma, de_sigma=de_sigma,
+        )
+        chain = chain[num_warmup:]
+        log_probs = log_probs[num_warmup:]
+        samples = jax.vmap(unravel_fn)(chain.reshape(-1, chain.shape[-1]))
+        logL = log_probs.flatten()
+        runtime = time.time() - start
+        extra_fields = {
+            'acceptance_fraction': acceptance,
+            'mean_acceptance_rate': jnp.mean(acceptance),
+            'chain': chain,  # ravelled positions of shape (num_samples, num_walkers, num_dims)
+        }
+        return samples, logL, extra_fields, runtime
+
+    def nested_sampling(self, seed, num_live_points=500, num_delete=None, num_slice_steps=None,
+                        max_iterations=1000, dlogz=0.1, num_samples=None, num_volume_samples=100):
+        """
+        Nested sampling for the computation of the Bayesian evidence (and posterior samples), 
+        where the replacement of the live points is vectorized and the whole run is a single compiled loop 
+        (see `run_nested_sampling()`). This requires the probabilistic model of the loss to be 
+        a NumpyroModel, as the prior and the likelihood are evaluated separately. Sampling is performed 
+        in unconstrained space, such that parameters with bounded priors are naturally supported.
+
+        :param seed: seed of the random number generator
+        :param num_live_points: number of live points
+        :param num_delete: number of live points replaced in parallel at each iteration,
+        by default 10% of the live points
+        :param num_slice_steps: number of slice sampling steps to draw each new point, 
+        by default max(5, 2 * num_dims)
+        :param max_iterations: maximum number of iterations
+        :param dlogz: stopping criterion on the estimated remaining log-evidence in the live points
+        :param num_samples: number of equally weighted posterior samples, by default the number of 
+        points with non-negligible weight (Kish effective sample size)
+        :param num_volume_samples: number of simulated sequences of prior volumes used 
+        to estimate the uncertainty of the log-evidence
+        :return: posterior samples, log-probabilities of the samples, extra fields, runtime
+        """
+        prob_model = self._loss.prob_model
+        rng_key = jax.random.PRNGKey(seed)
+        key_prior, key_run, key_evidence, key_resample = jax.random.split(rng_key, 4)
+        init_positions, unravel_fn, log_prior_likelihood_fn = self._init_from_prior(key_prior, num_live_points)
+        num_dims = init_positions.shape[1]
+        if num_delete is None:
+            num_delete = max(1, num_live_points // 10)
+        if num_slice_steps is None:
+            num_slice_steps = max(5, 2 * num_dims)
+
+        start = time.time()
+        result = run_nested_sampling(log_prior_likelihood_fn, key_run, init_positions, num_delete,
+                                     num_slice_steps, max_iterations, dlogz=dlogz)
+        num_iterations = int(result['num_iterations'])
+        num_dead = num_iterations * num_delete
+        # the final live points are removed one by one, in increasing order of likelihood
+        idx_live = jnp.argsort(result['live_log_likelihood'])
+        positions = jnp.concatenate([result['dead_positions'][:num_dead], result['live_positions'][idx_live]])
+        log_likelihood = jnp.concatenate([result['dead_log_likelihood'][:num_dead],
+                                          result['live_log_likelihood'][idx_live]])
+        num_live = jnp.concatenate([result['dead_num_live'][:num_dead], jnp.arange(num_live_points, 0, -1)])
+        log_z, log_z_err, information, log_weights = nested_sampling_evidence(
+            log_likelihood, num_live, rng_key=key_evidence, num_volume_samples=num_volume_samples)
+        # equally weighted posterior samples
+        weights = jnp.exp(log_weights)
+        if num_samples is None:
+            num_samples = int(1. / jnp.sum(weights**2))
+        idx = jax.random.choice(key_resample, weights.size, shape=(num_samples,), p=weights)
+        samples = jax.vmap(unravel_fn)(positions[idx])
+        logL = jax.vmap(lambda p: prob_model.log_prob(p, constrained=False))(samples)
+        if self._loss.constrained_space:
+            samples = jax.vmap(prob_model.constrain)(samples)
+        runtime = time.time() - start
+        extra_fields = {
+            'log_evidence': log_z,
+            'log_evidence_err': log_z_err,
+            'information': information,  # Kullback-Leibler divergence from prior to posterior (nats)
+            'num_iterations': num_iterations,
+            'num_evaluations': int(result['num_evaluations']),
+            'converged': bool(result['converged']),
+            'positions': positions,  # ravelled unconstrained positions of all points, with their
+            'log_weights': log_weights,  # normalized importance weights
+        }
+        return samples, logL, extra_fields, runtime
+
+    def smc(self, seed, num_particles=1000, kernel='rw', num_mutation_steps=10, num_leapfrog_steps=10,
+            max_iterations=100, target_ess=0.5):
+        """
+        Adaptive tempered sequential Monte Carlo, where a population of particles is moved from the prior
+        to the posterior with vectorized Markov kernels, inside a single compiled loop (see `run_tempered_smc()`).
+        Particles explore all modes of the prior in parallel, which makes this sampler well suited for 
+        multimodal posteriors, and it provides an estimate of the evidence. This requires the probabilistic model
+        of the loss to be a NumpyroModel, as the prior and the likelihood are evaluated separately.
+        Sampling is performed in unconstrained space.
+
+        :param seed: seed of the random number generator
+        :param num_particles: number of particles
+        :param kernel: mutation kernel, 'rw' (random-walk Metropolis) or 'hmc' (Hamiltonian Monte Carlo)
+        :param num_mutation_steps: number of kernel steps per particle at each tempering iteration
+        :param num_leapfrog_steps: number of leapfrog steps per HMC step
+        :param max_iterations: maximum number of tempering iterations
+        :param target_ess: target relative effective sample size between two consecutive temperatures,
+        the closer to 1 the more iterations
+        :return: posterior samples (one per particle), log-probabilities of the samples, extra fields, runtime
+        """
+        prob_model = self._loss.prob_model
+        key_prior, key_run = jax.random.split(jax.random.PRNGKey(seed))
+        init_positions, unravel_fn, log_prior_likelihood_fn = self._init_from_prior(key_prior, num_particles)
+        start = time.time()
+        result = run_tempered_smc(log_prior_likelihood_fn, key_run, init_positions, kernel,
+                                  num_mutation_steps, num_leapfrog_steps, max_iterations, 
+                                  target_ess=target_ess)
+        num_iterations = int(result['num_iterations'])
+        samples = jax.vmap(unravel_fn)(result['positions'])
+        logL = jax.vmap(lambda p: prob_model.log_prob(p, constrained=False))(samples)
+        if self._loss.constrained_space:
+            samples = jax.vmap(prob_model.constrain)(samples)
+        runtime = time.time() - start
+        if not bool(result['converged']):
+            warnings.warn(f"The final temperature has not been reached after {max_iterations} iterations.")
+        extra_fields = {
+            'log_evidence': result['log_evidence'],
+            'betas': result['betas'][:num_iterations],  # sequence of temperatures
+            'acceptance_rates': result['acceptance_rates'][:num_iterations],  # mean over particles
+            'step_size': result['step_size'],
+            'num_iterations': num_iterations,
+            'converged': bool(result['converged']),
+        }
+        return samples, logL, extra_fields, runtime
+
+    def _init_from_prior(self, prng_key, num_points):
+        """Draws points from the prior of the probabilistic model, in unconstrained space, and
+        returns them as an array of shape (num_points, num_dims), along with the function that 
+        unravels a single point and the function that returns its log-prior and log-likelihood."""
+        prob_model = self._loss.prob_model
+        prior_samples = prob_model.sample_prior(num_points, prng_key=prng_key)
+        latent_names = [site['name'] for site in prob_model.get_trace(prng_key).values()
+                        if site['type'] == 'sample' and not site['is_observed']]
+        prior_samples = jax.vmap(prob_model.unconstrain)({name: prior_samples[name] for name in latent_names})
+        positions = jax.vmap(lambda p: ravel_pytree(p)[0])(prior_samples)
+        log_prior_likelihood_fn, unravel_fn = self._flat_function(
+            'log_prior_likelihood', partial(prob_model.log_prior_likelihood, constrained=False),
+            jax.tree_util.tree_map(lambda p: p[0], prior_samples))
+        return positions, unravel_fn, log_prior_likelihood_fn
+
+    def _flat_function(self, name, fn, example_params):
+        """Returns the function `fn` of a 1D array of (ravelled) parameters, along with the unravelling
+        function. The former is a static argument of the jitted samplers, hence it is cached on the instance
+        for each structure of the parameters, such that subsequent calls re-use the compiled samplers."""
+        leaves, treedef = jax.tree_util.tree_flatten(example_params)
+        key = (name, treedef, tuple((jnp.shape(l), jnp.result_type(l)) for l in leaves))
+        cache = self.__dict__.setdefault('_flat_function_cache', {})
+        if key not in cache:
+            _, unravel_fn = ravel_pytree(example_params)
+            cache[key] = (lambda x: fn(unravel_fn(x)), unravel_fn)
+        return cache[key]
+
     def mcmc_emcee(self, log_likelihood_fn, init_stds, walker_ratio=10, 
                    num_warmup=100, num_samples=100, 
                    restart_from_init=False, num_threads=1, progress_bar=True):
@@ -149,10 +448,9 @@ class Sampler(Inference):
         import emcee
 
         if num_threads > 1:
-            from lenstronomy.Sampling.Pool.pool import choose_pool  # TODO: remove this dependence
-            pool = choose_pool(mpi=False, processes=num_threads, use_dill=True)
-        else:
-            pool = None  # default one
+            warnings.warn("Parallelization of emcee over multiple threads is not supported anymore, "
+                          "as `mcmc_ensemble()` provides a faster, vectorized ensemble sampler.")
+        pool = None  # default one
         init_means = self._param.current_values(as_kwargs=False, restart=restart_from_init)
         num_dims = len(init_means)
         num_walkers = int(walker_ratio * num_dims)
@@ -197,6 +495,49 @@ class Sampler(Inference):
 
 
 
+# subset of the blackjax HMC/NUTS info fields kept along the chain
+_InfoHistory = namedtuple('_InfoHistory', ['energy', 'acceptance_probability', 'is_divergent'])
+
+
+def _blackjax_window_adaptation(blackjax, log_prob_fn, rng_key, init_params, num_warmup):
+    """Runs the Stan-like window adaptation of NUTS, and returns the last state
+    along with the adapted kernel parameters (step size and inverse mass matrix).
+    Supports both blackjax < 1.0 and >= 1.0 APIs."""
+    if int(blackjax.__version__.split('.')[0]) >= 1:
+        window_adaptation = blackjax.window_adaptation(blackjax.nuts, log_prob_fn)
+        (state, kernel_params), _ = window_adaptation.run(rng_key, init_params, num_steps=num_warmup)
+    else:
+        window_adaptation = blackjax.window_adaptation(
+            blackjax.nuts,  # we also use NUTS for warmup
+            log_prob_fn,
+            num_steps=num_warmup,
+        )
+        state, _, kernel_params = window_adaptation.run(rng_key, init_params)
+    return state, dict(kernel_params)
+
+
+def _pmap_over_devices(run_chains, per_chain_params):
+    """Distributes a function vectorized over chains across the local devices, 
+    by reshaping the chain dimension into (num_devices, num_chains_per_device)."""
+    num_devices = jax.local_device_count()
+    params_axis = 0 if per_chain_params else None
+    pmapped = jax.pmap(run_chains, in_axes=(0, 0, params_axis))
+
+    def to_devices(x):
+        return x.reshape((num_devices, x.shape[0] // num_devices) + x.shape[1:])
+
+    def from_devices(x):
+        return x.reshape((x.shape[0] * x.shape[1],) + x.shape[2:])
+
+    def run(state, keys, kernel_params):
+        if per_chain_params:
+            kernel_params = jax.tree_util.tree_map(to_devices, kernel_params)
+        out = pmapped(jax.tree_util.tree_map(to_devices, state), to_devices(keys), kernel_params)
+        return jax.tree_util.tree_map(from_devices, out)
+
+    return run
+
+
 # Notes about HMC
 # ref: https://bayesianbrad.github.io/posts/2019_hmc.html
 # - q is the position, which are variables we are interested in
@@ -0,0 +1,179 @@
+# Adaptive tempered sequential Monte Carlo written in JAX
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+from functools import partial
+import jax
+import jax.numpy as jnp
+from jax.scipy.special import logsumexp
+
+
+__all__ = ['run_tempered_smc']
+
+
+_KERNELS = ('rw', 'hmc')
+
+
+@partial(jax.jit, static_argnums=(0, 3, 4, 5, 6))
+def run_tempered_smc(log_prior_likelihood_fn, rng_key, init_positions, kernel='rw',
+                     num_mutation_steps=10, num_leapfrog_steps=10, max_iterations=100,
+                     target_ess=0.5, target_acceptance=None):
+    """Runs an adaptive tempered sequential Monte Carlo sampler, which moves a population of particles
+    from the prior to the posterior through the sequence of tempered distributions
+    prior(x) * likelihood(x)**beta, with 0 <= beta <= 1 (e.g. Del Moral et al. 2006).
+    At each iteration, the next temperature is found by bisection such that the effective sample size
+    of the incremental weights is `target_ess` times the number of particles; the particles are then
+    resampled and mutated with a few steps of a Markov kernel targeting the current tempered distribution.
+    The kernels are scaled by the covariance of the particles, and their step size is adapted from
+    the acceptance rate of the previous iteration. All particles are evaluated with vectorized calls
+    to the log-density, and the whole run is a single compiled loop.
+
+    :param log_prior_likelihood_fn: function of a 1D array of parameters that returns
+    the log-prior density and the log-likelihood
+    :param rng_key: JAX PRNG key
+    :param init_positions: array of shape (num_particles, num_dims) drawn from the prior
+    :param kernel: 'rw' for a Gaussian random-walk Metropolis kernel, or 'hmc' for
+    Hamiltonian Monte Carlo with a diagonal mass matrix. By default 'rw'.
+    :param num_mutation_steps: number of kernel steps applied to each particle per iteration
+    :param num_leapfrog_steps: number of leapfrog steps per HMC step
+    :param max_iterations: maximum number of tempering iterations
+    :param target_ess: target relative effective sample size between two temperatures
+    :param target_acceptance: acceptance rate targeted by the adaptation of the step size,
+    by default 0.234 for 'rw' and 0.65 for 'hmc'
+    :return: dictionary with the final particles, their log-likelihoods, the log-evidence,
+    the sequence of temperatures and mean acceptance rates (padded with NaNs after the last iteration),
+    the number of iterations and whether the final temperature is 1
+    """
+    if kernel not in _KERNELS:
+        raise ValueError(f"Kernel '{kernel}' is not supported (choose from {_KERNELS}).")
+    num_particles, num_dims = init_positions.shape
+    if target_acceptance is None:
+        target_acceptance = 0.234 if kernel == 'rw' else 0.65
+    log_density_batched = jax.vmap(log_prior_likelihood_fn)
+
+    def safe_log_density(x):
+        log_prior, log_like = log_prior_likelihood_fn(x)
+        log_prior = jnp.where(jnp.isnan(log_prior), -jnp.inf, log_prior)
+        log_like = jnp.where(jnp.isnan(log_like), -jnp.inf, log_like)
+        return log_prior, log_like
+
+    def next_beta(log_like, beta):
+        """Bisection on the increment of temperature to reach the target effective sample size."""
+        log_like = jnp.where(jnp.isfinite(log_like), log_like, -jnp.inf)
+        def log_ess(delta):
+            log_w = delta * log_like
+            return 2. * logsumexp(log_w) - logsumexp(2. * log_w)
+        log_target = jnp.log(target_ess * num_particles)
+        def body_fn(_, bounds):
+            lower, upper = bounds
+            middle = 0.5 * (lower + upper)
+            above = log_ess(middle) >= log_target
+            return jnp.where(above, middle, lower), jnp.where(above, upper, middle)
+        delta_max = 1. - beta
+        lower, _ = jax.lax.fori_loop(0, 50, body_fn, (0. * beta, delta_max))
+        delta = jnp.where(log_ess(delta_max) >= log_target, delta_max, lower)
+        # always make some progress
+        delta = jnp.maximum(delta, 1e-10 * delta_max)
+        return jnp.where(delta >= delta_max, 1., beta + delta), delta
+
+    def resample(key, log_weights):
+        """Systematic resampling."""
+        weights = jnp.exp(log_weights - logsumexp(log_weights))
+        u = (jax.random.uniform(key) + jnp.arange(num_particles)) / num_particles
+        idx = jnp.searchsorted(jnp.cumsum(weights), u)
+        return jnp.clip(idx, 0, num_particles - 1)
+
+    def rw_step(key, x, log_prior, log_like, beta, step_size, chol):
+        key_prop, key_acc = jax.random.split(key)
+        x_prop = x + step_size * chol @ jax.random.normal(key_prop, (num_dims,))
+        log_prior_prop, log_like_prop = safe_log_density(x_prop)
+        log_accept = (log_prior_prop + beta * log_like_prop) - (log_prior + beta * log_like)
+        return x_prop, log_prior_prop, log_like_prop, log_accept, key_acc
+
+    def tempered_log_density(x, beta):
+        log_prior, log_like = safe_log_density(x)
+        return log_prior + beta * log_like, (log_prior, log_like)
+
+    def hmc_step(key, x, log_prior, log_like, beta, step_size, inv_mass_diag):
+        key_mom, key_acc = jax.random.split(key)
+        grad_fn = jax.grad(tempered_log_density, has_aux=True)
+        p = jax.random.normal(key_mom, (num_dims,)) / jnp.sqrt(inv_mass_diag)
+        kinetic = lambda p: 0.5 * jnp.sum(inv_mass_diag * p**2)
+        def leapfrog(_, state):
+            x, p, g = state
+            p = p + 0.5 * step_size * g
+            x = x + step_size * inv_mass_diag * p
+            g, _ = grad_fn(x, beta)
+            p = p + 0.5 * step_size * g
+            return x, p, g
+        g0, _ = grad_fn(x, beta)
+        x_prop, p_prop, _ = jax.lax.fori_loop(0, num_leapfrog_steps, leapfrog, (x, p, g0))
+        log_prior_prop, log_like_prop = safe_log_density(x_prop)
+        log_accept = (log_prior_prop + beta * log_like_prop - kinetic(p_prop)) \
+            - (log_prior + beta * log_like - kinetic(p))
+        return x_prop, log_prior_prop, log_like_prop, log_accept, key_acc
+
+    def mutate(key, x, log_prior, log_like, beta, step_size, scale):
+        step_fn = rw_step if kernel == 'rw' else hmc_step
+        def body_fn(carry, key):
+            x, log_prior, log_like, num_accepted = carry
+            x_prop, log_prior_prop, log_like_prop, log_accept, key_acc = step_fn(
+                key, x, log_prior, log_like, beta, step_size, scale)
+            log_accept = jnp.where(jnp.isnan(log_accept), -jnp.inf, log_accept)
+            accepted = jnp.log(jax.random.uniform(key_acc)) < log_accept
+            x = jnp.where(accepted, x_prop, x)
+            log_prior = jnp.where(accepted, log_prior_prop, log_prior)
+            log_like = jnp.where(accepted, log_like_prop, log_like)
+            return (x, log_prior, log_like, num_accepted + accepted), None
+        keys = jax.random.split(key, num_mutation_steps)
+        (x, log_prior, log_like, num_accepted), _ = jax.lax.scan(body_fn, (x, log_prior, log_like, 0), keys)
+        return x, log_prior, log_like, num_accepted / num_mutation_steps
+
+    def cond_fn(state):
+        it, beta = state[0], state[1]
+        return jnp.logical_and(it < max_iterations, beta < 1.)
+
+    def body_fn(state):
+        it, beta, x, log_prior, log_like, log_z, step_size, key, betas, acceptances = state
+        key, key_resample, key_mutate = jax.random.split(key, 3)
+        beta_new, delta = next_beta(log_like, beta)
+        log_weights = jnp.where(jnp.isfinite(log_like), delta * log_like, -jnp.inf)
+        log_z = log_z + logsumexp(log_weights) - jnp.log(num_particles)
+        idx = resample(key_resample, log_weights)
+        x, log_prior, log_like = x[idx], log_prior[idx], log_like[idx]
+        # kernels scaled by the covariance of the particles
+        cov = jnp.cov(x, rowvar=False).reshape(num_dims, num_dims) + 1e-12 * jnp.eye(num_dims)
+        if kernel == 'rw':
+            scale = jnp.linalg.cholesky(cov)
+        else:
+            scale = jnp.diag(cov)
+        keys = jax.random.split(key_mutate, num_particles)
+        x, log_prior, log_like, acceptance = jax.vmap(mutate, in_axes=(0, 0, 0, 0, None, None, None))(
+            keys, x, log_prior, log_like, beta_new, step_size, scale)
+        mean_acceptance = jnp.mean(acceptance)
+        step_size = step_size * jnp.exp(mean_acceptance - target_acceptance)
+        betas = betas.at[it].set(beta_new)
+        acceptances = acceptances.at[it].set(mean_acceptance)
+        return it + 1, beta_new, x, log_prior, log_like, log_z, step_size, key, betas, acceptances
+
+    init_log_prior, init_log_like = log_density_batched(init_positions)
+    dtype = init_positions.dtype
+    init_step_size = 2.38 / jnp.sqrt(num_dims) if kernel == 'rw' else 1. / num_dims**0.25
+    init_state = (0, jnp.array(0., dtype=dtype), init_positions, init_log_prior, init_log_like,
+                  jnp.array(0., dtype=dtype), jnp.array(init_step_size, dtype=dtype), rng_key,
+                  jnp.full(max_iterations, jnp.nan, dtype=dtype), jnp.full(max_iterations, jnp.nan, dtype=dtype))
+    num_iterations, beta, x, _, log_like, log_z, step_size, _, betas, acceptances = jax.lax.while_loop(
+        cond_fn, body_fn, init_state)
+    return {
+        'positions': x,
+        'log_likelihood': log_like,
+        'log_evidence': log_z,
+        'betas': betas,
+        'acceptance_rates': acceptances,
+        'step_size': step_size,
+        'num_iterations': num_iterations,
+        'converged': beta >= 1.,
+    }
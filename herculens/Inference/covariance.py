@@ -0,0 +1,266 @@
+# Matrix-free estimation of the parameter covariance via the Fisher information
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jax.flatten_util import ravel_pytree
+from jax.scipy.sparse.linalg import cg
+
+
+__all__ = ['LowRankFisherCovariance']
+
+
+class LowRankFisherCovariance(object):
+    """Estimates the covariance of the parameters at the best-fit, i.e. the inverse
+    of the Hessian of the loss function (the observed Fisher information matrix),
+    without ever building the full Hessian.
+
+    All quantities are obtained from Hessian-vector products
+    (see `Differentiable.hessian_vec_prod()`), such that the cost in memory
+    is linear in the number of parameters. It provides:
+    - the top eigenpairs of the Hessian, through the Lanczos algorithm;
+    - stochastic estimates of the diagonal of the covariance matrix (marginal variances),
+    through the Hutchinson or Hutch++ estimators combined with conjugate gradients;
+    - dense Hessian blocks for groups of parameters (e.g., per model component);
+    - a low-rank-plus-diagonal approximation of the Hessian, from which samples
+    can be drawn and marginal variances computed in closed form.
+
+    :param loss: Differentiable instance, typically herculens.Inference.loss.Loss
+    :param best_fit: parameters (pytree or 1D array) at which the Hessian is evaluated,
+    typically the output of an optimizer
+    """
+
+    def __init__(self, loss, best_fit):
+        self._diff = loss
+        self._best_fit = best_fit
+        self._best_fit_flat, self._unravel_fn = ravel_pytree(best_fit)
+        self.num_parameters = self._best_fit_flat.size
+
+    @property
+    def best_fit(self):
+        return self._best_fit
+
+    def hvp(self, vec_flat):
+        """Hessian-vector product with a flattened vector."""
+        vec = self._unravel_fn(vec_flat)
+        hvp = self._diff.hessian_vec_prod(self._best_fit, vec)
+        return ravel_pytree(hvp)[0]
+
+    def inverse_hvp(self, vec_flat, tol=1e-6, maxiter=None):
+        """Product of the inverse Hessian (i.e. the covariance) with a flattened vector,
+        computed with conjugate gradients. The Hessian is assumed to be positive definite."""
+        return cg(self.hvp, vec_flat, tol=tol, maxiter=maxiter)[0]
+
+    def lanczos(self, num_eigenpairs=10, num_iterations=None, seed=0):
+        """Computes the largest eigenvalues and corresponding eigenvectors of the Hessian
+        with the Lanczos algorithm (with full reorthogonalization).
+
+        :param num_eigenpairs: number of eigenpairs to return
+        :param num_iterations: number of Lanczos iterations (i.e. Hessian-vector products),
+        by default min(num_parameters, 2 * num_eigenpairs + 10)
+        :param seed: seed of the random starting vector
+        :return: eigenvalues of shape (num_eigenpairs,) in decreasing order, and
+        eigenvectors of shape (num_parameters, num_eigenpairs), in flattened parameter space
+        """
+        n = self.num_parameters
+        if num_iterations is None:
+            num_iterations = min(n, 2 * num_eigenpairs + 10)
+        if num_eigenpairs > num_iterations or num_iterations > n:
+            raise ValueError("It should be num_eigenpairs <= num_iterations <= num_parameters.")
+        alphas, betas, V = self._lanczos_tridiag(jax.random.PRNGKey(seed), num_iterations)
+        T = jnp.diag(alphas) + jnp.diag(betas[:-1], k=1) + jnp.diag(betas[:-1], k=-1)
+        ritz_values, S = jnp.linalg.eigh(T)
+        order = jnp.argsort(ritz_values)[::-1][:num_eigenpairs]
+        eigenvalues = ritz_values[order]
+        eigenvectors = V.T @ S[:, order]
+        return eigenvalues, eigenvectors
+
+    def _lanczos_tridiag(self, rng_key, num_iterations):
+        n = self.num_parameters
+        v0 = jax.random.normal(rng_key, (n,), dtype=self._best_fit_flat.dtype)
+        V = jnp.zeros((num_iterations, n), dtype=v0.dtype)
+        V = V.at[0].set(v0 / jnp.linalg.norm(v0))
+
+        def step(carry, j):
+            V, v_prev, beta_prev = carry
+            v = V[j]
+            w = self.hvp(v) - beta_prev * v_prev
+            alpha = jnp.dot(w, v)
+            w = w - alpha * v
+            # full reorthogonalization (twice is enough), rows of V not yet filled are zero
+            w = w - V.T @ (V @ w)
+            w = w - V.T @ (V @ w)
+            beta = jnp.linalg.norm(w)
+            v_next = jnp.where(beta > 1e-10, w / beta, 0.)
+            V = jax.lax.cond(j + 1 < num_iterations,
+                             lambda V: V.at[j + 1].set(v_next),
+                             lambda V: V, V)
+            return (V, v, beta), (alpha, beta)
+
+        init = (V, jnp.zeros(n, dtype=v0.dtype), jnp.zeros((), dtype=v0.dtype))
+        (V, _, _), (alphas, betas) = jax.lax.scan(step, init, jnp.arange(num_iterations))
+        return alphas, betas, V
+
+    def inverse_diagonal(self, num_probes=60, method='hutch++', seed=0, cg_tol=1e-6, cg_maxiter=None):
+        """Stochastic estimate of the diagonal of the inverse Hessian, i.e. the marginal
+        variances of the parameters. Each probe requires solving a linear system with
+        conjugate gradients.
+
+        :param num_probes: total number of random probe vectors
+        :param method: 'hutchinson' or 'hutch++'; the latter first captures the dominant
+        subspace of the covariance with a third of the probes and has lower variance
+        :param seed: seed of the random probe vectors
+        :param cg_tol: tolerance of the conjugate gradient solver
+        :param cg_maxiter: maximum number of conjugate gradient iterations
+        :return: marginal variances, with the same structure as the parameters
+        """
+        key_sketch, key_probes = jax.random.split(jax.random.PRNGKey(seed))
+        inv_hvp = jax.jit(jax.vmap(lambda v: self.inverse_hvp(v, tol=cg_tol, maxiter=cg_maxiter),
+                                   in_axes=1, out_axes=1))
+        if method == 'hutchinson':
+            Z = self._rademacher(key_probes, num_probes)
+            diag = jnp.mean(Z * inv_hvp(Z), axis=1)
+        elif method == 'hutch++':
+            num_sketch = max(1, num_probes // 3)
+            num_residual = max(1, num_probes - 2 * num_sketch)
+            Q, _ = jnp.linalg.qr(inv_hvp(self._rademacher(key_sketch, num_sketch)))
+            # exact diagonal of Q Q^T C, plus Hutchinson estimate of the diagonal of (I - Q Q^T) C
+            diag = jnp.sum(Q * inv_hvp(Q), axis=1)
+            Z = self._rademacher(key_probes, num_residual)
+            CZ = inv_hvp(Z)
+            diag = diag + jnp.mean(Z * (CZ - Q @ (Q.T @ CZ)), axis=1)
+        else:
+            raise ValueError(f"Method '{method}' is not supported (choose 'hutchinson' or 'hutch++').")
+        return self._unravel_fn(diag)
+
+    def block_diagonal_hessian(self, blocks=None):
+        """Dense Hessian blocks for groups of parameters, each block being computed
+        from as many Hessian-vector products as parameters in the block.
+        Cross-terms between different blocks are neglected.
+
+        :param blocks: list of blocks; each block is either a list of keys of the parameters
+        dictionary (e.g., all parameters of a given model component), or an array of indices
+        in the flattened parameter space. By default, one block per leaf of the parameters.
+        :return: list of 2D arrays, and list of the flattened indices of each block
+        """
+        indices = self._block_indices(blocks)
+        hessian_blocks = []
+        for idx in indices:
+            idx = jnp.asarray(idx)
+            basis_vec = lambda i: jnp.zeros(self.num_parameters, self._best_fit_flat.dtype).at[i].set(1.)
+            hessian_block = jax.lax.map(lambda i: self.hvp(basis_vec(i))[idx], idx)
+            hessian_blocks.append(0.5 * (hessian_block + hessian_block.T))
+        return hessian_blocks, indices
+
+    def block_diagonal_covariance(self, blocks=None):
+        """Inverse of each Hessian block (see `block_diagonal_hessian()`)."""
+        hessian_blocks, indices = self.block_diagonal_hessian(blocks=blocks)
+        return [jnp.linalg.inv(hessian) for hessian in hessian_blocks], indices
+
+    def compute_low_rank_plus_diagonal(self, num_eigenpairs=10, num_iterations=None, num_probes=30,
+                                       num_refinements=20, hessian_diagonal=None, min_precision=1e-8, seed=0):
+        """Approximates the Hessian as H ~ D + U M U^T, where U spans its top eigenvectors
+        (see `lanczos()`) and D is diagonal. M is such that the approximation has the same action 
+        as H within span(U), i.e. U^T (D + U M U^T) U = diag(lambda), with lambda the top eigenvalues. 
+        D is then obtained by fixed-point iterations such that the approximation (approximately) 
+        matches the diagonal of H, which is estimated with the Hutchinson estimator unless it is provided.
+        This is an approximation even if H is diagonal plus low-rank: the top eigenvectors of H do 
+        not span the low-rank term in general, and the curvature outside of span(U) is only 
+        captured through its diagonal. It is used to draw samples and compute marginal variances.
+
+        :param num_eigenpairs: rank of the low-rank component
+        :param num_iterations: number of Lanczos iterations
+        :param num_probes: number of probes to estimate the diagonal component
+        :param num_refinements: number of fixed-point iterations to estimate the diagonal component
+        :param hessian_diagonal: diagonal of the Hessian, as a flattened array, if known
+        :param min_precision: lower bound on the diagonal component, ensuring
+        the approximation is positive definite
+        :param seed: seed of the random number generator
+        """
+        eigenvalues, U = self.lanczos(num_eigenpairs=num_eigenpairs,
+                                      num_iterations=num_iterations, seed=seed)
+        if hessian_diagonal is None:
+            key_probes = jax.random.fold_in(jax.random.PRNGKey(seed), 1)
+            Z = self._rademacher(key_probes, num_probes)
+            HZ = jax.jit(jax.vmap(self.hvp, in_axes=1, out_axes=1))(Z)
+            residual_diag = jnp.mean(Z * (HZ - U @ (eigenvalues[:, None] * (U.T @ Z))), axis=1)
+        else:
+            residual_diag = jnp.asarray(hessian_diagonal) - jnp.sum(U**2 * eigenvalues[None, :], axis=1)
+        # the remainder (I - P) H (I - P), with P = U U^T, has diagonal D - 2 diag(P) D + diag(P D P)
+        proj_diag = jnp.sum(U**2, axis=1)
+        # parameters (almost) entirely within span(U) are dominated by the low-rank term anyway
+        denom = jnp.maximum(1. - 2. * proj_diag, 0.1)
+        diag = residual_diag
+        for _ in range(num_refinements):
+            diag = (residual_diag - jnp.sum((U @ (U.T @ (diag[:, None] * U))) * U, axis=1)) / denom
+        diag = jnp.maximum(diag, min_precision)
+        M = jnp.diag(eigenvalues) - U.T @ (diag[:, None] * U)
+        eigenvalues, W = jnp.linalg.eigh(M)
+        # negative eigenvalues would come from a best-fit that is not a minimum
+        self._low_rank = (jnp.maximum(eigenvalues, 0.), U @ W, diag)
+
+    @property
+    def low_rank_plus_diagonal(self):
+        """Eigenvalues and eigenvectors of the low-rank component, and diagonal component,
+        of the approximated Hessian."""
+        if not hasattr(self, '_low_rank'):
+            raise ValueError("Call first compute_low_rank_plus_diagonal().")
+        return self._low_rank
+
+    def marginal_variances(self):
+        """Diagonal of the inverse of the low-rank-plus-diagonal Hessian, computed
+        with the Woodbury identity."""
+        eigenvalues, U, diag = self.low_rank_plus_diagonal
+        D_inv_U = U / diag[:, None]
+        inner = jnp.diag(1. / jnp.maximum(eigenvalues, 1e-30)) + U.T @ D_inv_U
+        variances = 1. / diag - jnp.sum(D_inv_U * jnp.linalg.solve(inner, D_inv_U.T).T, axis=1)
+        return self._unravel_fn(variances)
+
+    def get_sigma(self):
+        """Standard deviations of the parameters, with the same structure as the parameters."""
+        return jax.tree_util.tree_map(lambda v: jnp.sqrt(jnp.abs(v)), self.marginal_variances())
+
+    def draw_samples(self, num_samples=10000, seed=0):
+        """Draws samples from the Gaussian approximation of the posterior, centered on the best-fit,
+        whose precision matrix is the low-rank-plus-diagonal approximation of the Hessian.
+
+        :param num_samples: number of samples
+        :param seed: seed of the random number generator
+        :return: samples, with the same structure as the parameters and an additional leading dimension
+        """
+        eigenvalues, U, diag = self.low_rank_plus_diagonal
+        # H = D^1/2 (I + B B^T) D^1/2, with B = D^-1/2 U diag(lambda)^1/2 = P diag(s) R^T
+        d_inv_sqrt = 1. / jnp.sqrt(diag)
+        B = d_inv_sqrt[:, None] * U * jnp.sqrt(eigenvalues)[None, :]
+        P, s, _ = jnp.linalg.svd(B, full_matrices=False)
+        shrink = 1. / jnp.sqrt(1. + s**2) - 1.
+        Z = jax.random.normal(jax.random.PRNGKey(seed), (num_samples, self.num_parameters),
+                              dtype=self._best_fit_flat.dtype)
+        # x = D^-1/2 (I + B B^T)^-1/2 z, such that Cov(x) = H^-1
+        X = d_inv_sqrt[None, :] * (Z + ((Z @ P) * shrink[None, :]) @ P.T)
+        return jax.vmap(self._unravel_fn)(self._best_fit_flat[None, :] + X)
+
+    def _rademacher(self, rng_key, num_probes):
+        return jax.random.rademacher(rng_key, (self.num_parameters, num_probes),
+                                     dtype=self._best_fit_flat.dtype)
+
+    def _block_indices(self, blocks):
+        index_tree = self._unravel_fn(jnp.arange(self.num_parameters, dtype=self._best_fit_flat.dtype))
+        if blocks is None:
+            leaves = jax.tree_util.tree_leaves(index_tree)
+            return [np.round(np.ravel(leaf)).astype(int) for leaf in leaves]
+        indices = []
+        for block in blocks:
+            if isinstance(block, (list, tuple)) and all(isinstance(key, str) for key in block):
+                if not isinstance(index_tree, dict):
+                    raise ValueError("Blocks can be given as keys only if parameters are a dictionary.")
+                idx = np.concatenate([np.ravel(index_tree[key]) for key in block])
+                indices.append(np.round(idx).astype(int))
+            else:
+                indices.append(np.asarray(block, dtype=int))
+        return indices
@@ -8,7 +8,7 @@ __author__ = 'aymgal'
 from copy import deepcopy
 import numpy as np
 import jax.numpy as jnp
-from jax import lax, jit
+from jax import jit
 from functools import partial
 
 from herculens.MassModel.Profiles import pixelated as pixelated_lens
@@ -56,6 +56,7 @@ class Parameters(object):
     """
 
     _unif_prior_penalty = 1e10
+    _prior_type_codes = {None: 0, 'gaussian': 1, 'uniform': 2}
 
     def __init__(self, lens_image, kwargs_init, kwargs_fixed, 
                  kwargs_prior=None, kwargs_joint=None):
@@ -211,13 +212,25 @@ class Parameters(object):
             self._kwargs_prior = kwargs_prior
         self._update_arrays()
 
-    # @partial(jit, static_argnums=(0,))
     def args2kwargs(self, args):
-        i = 0
+        """Converts the parameter vector to keyword arguments, using the precomputed index map."""
         args = jnp.atleast_1d(args)
-        kwargs_lens, i = self._get_params(args, i, 'mass_model_list', 'kwargs_lens')
-        kwargs_source, i = self._get_params(args, i, 'source_model_list', 'kwargs_source')
-        kwargs_lens_light, i = self._get_params(args, i, 'lens_light_model_list', 'kwargs_lens_light')
+        kwargs = {}
+        for kwargs_key, index_map in self._index_map.items():
+            kwargs_list = []
+            for entries in index_map:
+                kwargs_k = {}
+                for name, fixed_value, start, shape in entries:
+                    if start is None:
+                        kwargs_k[name] = fixed_value
+                    elif shape == ():
+                        kwargs_k[name] = args[start]
+                    else:
+                        kwargs_k[name] = args[start:start + int(np.prod(shape))].reshape(shape)
+                kwargs_list.append(kwargs_k)
+            kwargs[kwargs_key] = kwargs_list
+        kwargs_lens, kwargs_source, kwargs_lens_light \
+            = kwargs['kwargs_lens'], kwargs['kwargs_source'], kwargs['kwargs_lens_light']
         # apply joint param rules
         kwargs_lens = self._join_params(kwargs_lens, kwargs_lens, self._kwargs_joint['lens_with_lens'])
         kwargs_source = self._join_params(kwargs_source, kwargs_source, self._kwargs_joint['source_with_source'])
@@ -227,12 +240,27 @@ class Parameters(object):
         kwargs = {'kwargs_lens': kwargs_lens, 'kwargs_source': kwargs_source, 'kwargs_lens_light': kwargs_lens_light}
         return kwargs
 
-    # @partial(jit, static_argnums=(0,))
     def kwargs2args(self, kwargs):
-        args = self._set_params(kwargs, 'mass_model_list', 'kwargs_lens')
-        args += self._set_params(kwargs, 'source_model_list', 'kwargs_source')
-        args += self._set_params(kwargs, 'lens_light_model_list', 'kwargs_lens_light')
-        return jnp.array(args)
+        """Converts keyword arguments to the parameter vector, using the precomputed index map."""
+        args = []
+        for kwargs_key, index_map in self._index_map.items():
+            for k, entries in enumerate(index_map):
+                kwargs_profile = kwargs[kwargs_key][k]
+                for name, _, start, shape in entries:
+                    if start is None:
+                        continue
+                    value = kwargs_profile[name]
+                    if len(shape) == 2:
+                        if isinstance(value, (int, float)):
+                            value = value * np.ones(shape)
+                        elif value.shape != shape:
+                            raise ValueError("Pixelated array is inconsistent with pixelated grid.")
+                    elif len(shape) == 1 and len(value) != shape[0]:
+                        raise ValueError("Number of functions' amplitudes is not the on expected.")
+                    args.append(jnp.ravel(jnp.asarray(value, dtype=float)))
+        if len(args) == 0:
+            return jnp.array([])
+        return jnp.concatenate(args)
 
     def kwargs2args_prior(self, kwargs_prior):
         types_m, lowers_m, uppers_m, means_m, widths_m = self._set_params_prior(kwargs_prior, 'mass_model_list', 'kwargs_lens')
@@ -246,30 +274,24 @@ class Parameters(object):
         return types, np.array(lowers), np.array(uppers), np.array(means), np.array(widths)
 
     def log_prior(self, args):
-        logP = 0
-        for i in range(self.num_parameters):
-            gaussian_prior = self._prior_types[i] == 'gaussian'
-            uniform_prior  = self._prior_types[i] == 'uniform'
-            logP += lax.cond(gaussian_prior, lambda _: - 0.5 * ((args[i] - self._means[i]) / self._widths[i]) ** 2, lambda _: 0., operand=None)
-            logP += lax.cond(uniform_prior, lambda _: lax.cond(args[i] < self._lowers[i], lambda _: - self._unif_prior_penalty, lambda _: 0., operand=None), lambda _: 0., operand=None)
-            logP += lax.cond(uniform_prior, lambda _: lax.cond(args[i] > self._uppers[i], lambda _: - self._unif_prior_penalty, lambda _: 0., operand=None), lambda _: 0., operand=None)
-        return logP
+        args = jnp.atleast_1d(args)
+        log_p_gaussian = jnp.where(self._gaussian_mask,
+                                   - 0.5 * ((args - self._prior_means) / self._prior_widths) ** 2, 0.)
+        out_of_bounds = jnp.logical_and(self._uniform_mask,
+                                        jnp.logical_or(args < self._lowers, args > self._uppers))
+        log_p_uniform = jnp.where(out_of_bounds, - self._unif_prior_penalty, 0.)
+        return jnp.sum(log_p_gaussian) + jnp.sum(log_p_uniform)
 
     def log_prior_gaussian(self, args):
-        logP = 0
-        for i in range(self.num_parameters):
-            gaussian_prior = self._prior_types[i] == 'gaussian'
-            logP += lax.cond(gaussian_prior, lambda _: - 0.5 * ((args[i] - self._means[i]) / self._widths[i]) ** 2, lambda _: 0., operand=None)
-        return logP
+        args = jnp.atleast_1d(args)
+        return jnp.sum(jnp.where(self._gaussian_mask,
+                                 - 0.5 * ((args - self._prior_means) / self._prior_widths) ** 2, 0.))
 
     def log_prior_uniform(self, args):
-        logP = 0.
-        for i in range(self.num_parameters):
-            uniform_prior  = self._prior_types[i] == 'uniform'
-            # logP += lax.cond(uniform_prior, lambda _: lax.cond(args[i] < self._lowers[i], lambda _: - self._unif_prior_penalty, lambda _: 0., operand=None), lambda _: 0., operand=None)
-            # logP += lax.cond(uniform_prior, lambda _: lax.cond(args[i] > self._uppers[i], lambda _: - self._unif_prior_penalty, lambda _: 0., operand=None), lambda _: 0., operand=None)
-            logP += lax.cond(uniform_prior, lambda _: - (args[i] - jnp.clip(args[i], a_min=self._lowers[i], a_max=self._uppers[i]))**2, lambda _: 0., operand=None)
-        return logP
+        args = jnp.atleast_1d(args)
+        # quadratic penalty outside the bounds, such that the gradient pushes back inside
+        distance = args - jnp.clip(args, a_min=self._lowers, a_max=self._uppers)
+        return - jnp.sum(jnp.where(self._uniform_mask, distance**2, 0.))
 
     def apply_bounds(self, args):
         return jnp.clip(args, a_min=self._lowers, a_max=self._uppers)
@@ -341,8 +363,16 @@ class Parameters(object):
 
     def _update_arrays(self):
         self._kwargs_fixed = self._update_fixed_with_joint(self._kwargs_fixed, self._kwargs_joint)
+        self._index_map = self._build_index_map()
         self._prior_types, self._lowers, self._uppers, self._means, self._widths \
             = self.kwargs2args_prior(self._kwargs_prior)
+        # flat arrays for vectorized evaluation of the log-prior
+        self._prior_codes = np.array([self._prior_type_codes[t] for t in self._prior_types], dtype=int)
+        self._gaussian_mask = self._prior_codes == self._prior_type_codes['gaussian']
+        self._uniform_mask = self._prior_codes == self._prior_type_codes['uniform']
+        # neutral values where there is no gaussian prior, to avoid NaNs in gradients
+        self._prior_means = np.where(self._gaussian_mask, self._means, 0.).astype(float)
+        self._prior_widths = np.where(self._gaussian_mask, self._widths, 1.).astype(float)
         self._init_values = self.kwargs2args(self._kwargs_init)
         self._kwargs_init = self.args2kwargs(self._init_values)  # for updating missing fields
         self._num_params = len(self._init_values)
@@ -390,75 +420,46 @@ class Parameters(object):
                 kwargs_list_2[k_2][param_name_2] = kwargs_list_1[i_1][param_name_1]
         return kwargs_list_2
 
-    def _get_params(self, args, i, kwargs_model_key, kwargs_key):
-        kwargs_list = []
-        for k, model in enumerate(self.kwargs_model[kwargs_model_key]):
-            kwargs = {}
-            kwargs_fixed_k = self._kwargs_fixed[kwargs_key][k]
-            param_names = self.get_param_names_for_model(kwargs_key, model)
-            for name in param_names:
-                if not name in kwargs_fixed_k:
-                    if model == 'PIXELATED':
-                        if kwargs_key == 'kwargs_lens':
-                            n_pix_x, n_pix_y = self._image.MassModel.pixelated_shape
-                        elif kwargs_key == 'kwargs_source':
-                            n_pix_x, n_pix_y = self._image.SourceModel.pixelated_shape
-                        elif kwargs_key == 'kwargs_lens_light':
-                            n_pix_x, n_pix_y = self._image.LensLightModel.pixelated_shape
-                        num_param = int(n_pix_x * n_pix_y)
-                        kwargs['pixels'] = args[i:i + num_param].reshape(n_pix_x, n_pix_y)
-                    elif model == 'SHAPELETS' and name == 'amps':
-                        if kwargs_key == 'kwargs_source':
-                            num_param = self._image.SourceModel.num_amplitudes_list[k]
-                        elif kwargs_key == 'kwargs_lens_light':
-                            num_param = self._image.LensLightModel.num_amplitudes_list[k]
-                        else:
-                            raise ValueError("Basis functions can only be in the source or lens light.")
-                        kwargs['amps'] = args[i:i + num_param]
-                    else:
-                        num_param = 1
-                        kwargs[name] = args[i]
-                    i += num_param
-                else:
-                    kwargs[name] = kwargs_fixed_k[name]
-            kwargs_list.append(kwargs)
-        return kwargs_list, i
-
-    def _set_params(self, kwargs, kwargs_model_key, kwargs_key):
-        args = []
-        for k, model in enumerate(self.kwargs_model[kwargs_model_key]):
-            kwargs_profile = kwargs[kwargs_key][k]
-            kwargs_fixed_k = self._kwargs_fixed[kwargs_key][k]
-            param_names = self.get_param_names_for_model(kwargs_key, model)
-            for name in param_names:
-                if not name in kwargs_fixed_k:
+    def _build_index_map(self):
+        """Precomputes, for each profile, the position and shape of each parameter
+        in the parameter vector (or its fixed value), in the order of the parameter vector.
+        """
+        index_map = {}
+        i = 0
+        for kwargs_model_key, kwargs_key in (('mass_model_list', 'kwargs_lens'),
+                                             ('source_model_list', 'kwargs_source'),
+                                             ('lens_light_model_list', 'kwargs_lens_light')):
+            index_map[kwargs_key] = []
+            for k, model in enumerate(self.kwargs_model[kwargs_model_key]):
+                entries = []
+                kwargs_fixed_k = self._kwargs_fixed[kwargs_key][k]
+                param_names = self.get_param_names_for_model(kwargs_key, model)
+                for name in param_names:
+                    if name in kwargs_fixed_k:
+                        entries.append((name, kwargs_fixed_k[name], None, None))
+                        continue
                     if model == 'PIXELATED':
-                        pixels = kwargs_profile['pixels']
                         if kwargs_key == 'kwargs_lens':
                             n_pix_x, n_pix_y = self._image.MassModel.pixelated_shape
                         elif kwargs_key == 'kwargs_source':
                             n_pix_x, n_pix_y = self._image.SourceModel.pixelated_shape
                         elif kwargs_key == 'kwargs_lens_light':
                             n_pix_x, n_pix_y = self._image.LensLightModel.pixelated_shape
-                        if isinstance(pixels, (int, float)):
-                            pixels = pixels * np.ones((n_pix_x, n_pix_y))
-                        elif pixels.shape != (n_pix_x, n_pix_y):
-                            raise ValueError("Pixelated array is inconsistent with pixelated grid.")
-                        args += pixels.flatten().tolist()
+                        name, shape = 'pixels', (int(n_pix_x), int(n_pix_y))
                     elif model == 'SHAPELETS' and name == 'amps':
-                        amps = kwargs_profile['amps']
                         if kwargs_key == 'kwargs_source':
                             num_param = self._image.SourceModel.num_amplitudes_list[k]
                         elif kwargs_key == 'kwargs_lens_light':
                             num_param = self._image.LensLightModel.num_amplitudes_list[k]
                         else:
                             raise ValueError("Basis functions can only be in the source or lens light.")
-                        if len(amps) != num_param:
-                            raise ValueError("Number of functions' amplitudes is not the on expected.")
-                        args += np.asarray(amps).flatten().tolist()
+                        shape = (int(num_param),)
                     else:
-                        args.append(kwargs_profile[name])
-        return args
+                        shape = ()
+                    entries.append((name, None, i, shape))
+                    i += int(np.prod(shape))
+                index_map[kwargs_key].append(entries)
+        return index_map
 
     def _set_params_prior(self, kwargs, kwargs_model_key, kwargs_key):
         types, lowers, uppers, means, widths = [], [], [], [], []
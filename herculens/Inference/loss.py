@@ -6,6 +6,7 @@ __author__ = 'aymgal', 'austinpeel'
 
 
 import numpy as np
+from functools import partial
 import jax.numpy as jnp
 from jax import jit
 import warnings
@@ -30,6 +31,14 @@ class Loss(Differentiable):
         self._constrained = constrained_space
         self._cap_value = cap_value
 
+    @property
+    def prob_model(self):
+        return self._prob_model
+
+    @property
+    def constrained_space(self):
+        return self._constrained
+
     def _func(self, args):
         """negative log-probability"""
         loss = - self._prob_model.log_prob(args, constrained=self._constrained)
@@ -37,3 +46,10 @@ class Loss(Differentiable):
         if self._cap_value is not None:
             loss = jnp.clip(loss, a_min=self._cap_value)
         return loss
+
+    @partial(jit, static_argnums=(0,))
+    def residuals(self, args):
+        """vector of weighted residuals, such that the loss is 0.5 * sum(residuals**2)
+        up to a constant and non-Gaussian prior terms"""
+        residuals = self._prob_model.residuals(args, constrained=self._constrained)
+        return jnp.nan_to_num(residuals, nan=1e15, posinf=1e15, neginf=-1e15)
@@ -11,21 +11,20 @@ import numpy as np
 from skimage import feature
 from functools import partial
 
+import jax
 from jax import grad
 from jax import jit
 import jax.numpy as jnp
+from jax.flatten_util import ravel_pytree
 
 from herculens.LightModel.light_model import LightModel
 from herculens.MassModel.mass_model import MassModel
 from herculens.LensImage.lens_image import LensImage
-from herculens.Inference.legacy.parameters import Parameters
-from herculens.Inference.legacy.loss import Loss
-from herculens.Inference.legacy.optimization import Optimizer
 # from herculens.Inference.legacy.covariance import FisherCovariance
 from herculens.Util import util
 
 
-__all__ = ['MassSensitivityMapping']
+__all__ = ['MassSensitivityMapping', 'SensitivityMapping']
 
 
 
@@ -52,6 +51,8 @@ class MassSensitivityMapping(object):
 
     def sensitivity_map(self, init_mass=0., x_grid=None, y_grid=None, 
                         use_jax_vectorize=False):
+        from herculens.Inference.legacy.loss import Loss
+
         # prepare the new model
         self.prepare_halo_model(init_mass)
 
@@ -119,6 +120,9 @@ class MassSensitivityMapping(object):
         return sensitivity_map, (x_minima, y_minima, z_minima), runtime
 
     def sensitivity_map_optim(self, init_mass=0., x_grid=None, y_grid=None, minimize_method='trust-krylov', **kwargs_optimizer):
+        from herculens.Inference.legacy.loss import Loss
+        from herculens.Inference.legacy.optimization import Optimizer
+
         # prepare the new model
         self.prepare_halo_model(init_mass)
 
@@ -185,6 +189,8 @@ class MassSensitivityMapping(object):
         return sensitivity_map, (x_minima, y_minima, z_minima), logL_map, runtime
 
     def prepare_halo_model(self, init_mass):
+        from herculens.Inference.legacy.parameters import Parameters
+
         # value at which the gradient will be evaluated
         init_mass = init_mass
 
@@ -247,3 +253,128 @@ class MassSensitivityMapping(object):
             print("parameters:", self.halo_param.names)
             print("num. params:", self.halo_param.num_parameters)
             print("init. values:", self.halo_param.initial_values())
+
+
+class SensitivityMapping(object):
+    """Sensitivity of a lens model to a mass perturber (e.g. a dark subhalo),
+    as a function of the position of the perturber.
+
+    The probabilistic model must contain the perturber, whose mass and position are sample sites.
+    For each position on a grid, the sensitivity is computed by a single jitted function, which
+    is vectorized over chunks of positions (with `jax.vmap`) and iterated over the chunks
+    (with `jax.lax.map`), such that the memory footprint is controlled by the chunk size.
+
+    :param prob_model: herculens.Inference.ProbModel.numpyro.NumpyroModel instance that includes the perturber
+    :param params: dictionary of (constrained) parameter values of the macro model, typically a best-fit,
+    at which the sensitivity is evaluated (values of the perturber sites are ignored)
+    :param mass_key: name of the sample site of the perturber mass (e.g. its Einstein radius)
+    :param x_key: name of the sample site of the perturber position along RA
+    :param y_key: name of the sample site of the perturber position along Dec
+    """
+
+    _METHODS = ('gradient', 'fisher', 'delta_loss')
+
+    def __init__(self, prob_model, params, mass_key='perturber_theta_E',
+                 x_key='perturber_center_x', y_key='perturber_center_y'):
+        self._prob_model = prob_model
+        self._params = {key: jnp.asarray(value) for key, value in params.items()}
+        self._mass_key, self._x_key, self._y_key = mass_key, x_key, y_key
+
+    def loss(self, params):
+        """Negative log-probability, given constrained parameters."""
+        return - self._prob_model.log_prob(params, constrained=True)
+
+    def sensitivity_map(self, x_grid, y_grid, method='gradient', mass=0., test_mass=None,
+                        marginalize_keys=None, chunk_size=256):
+        """Computes the sensitivity at each position of the perturber.
+
+        :param x_grid: array of RA coordinates of the perturber (e.g. the pixel coordinates of the image)
+        :param y_grid: array of Dec coordinates of the perturber, same shape as x_grid
+        :param method: 'gradient' for the derivative of the loss with respect to the perturber mass
+        (negative values indicate that adding a perturber improves the fit), 'fisher' for the
+        expected Fisher information of the perturber mass, computed from the Jacobian of the residuals
+        of the model (see `NumpyroModel.residuals()`); its inverse square root is the expected
+        uncertainty on the mass, i.e. higher is more sensitive, or 'delta_loss' for the difference of the loss
+        between a perturber of mass `test_mass` and of mass `mass` (negative values indicate
+        an improvement of the fit)
+        :param mass: perturber mass at which the sensitivity is evaluated, by default 0
+        :param test_mass: perturber mass tested with the 'delta_loss' method
+        :param marginalize_keys: for the 'fisher' method, names of the (macro) parameters whose
+        correlations with the perturber mass are taken into account, by default None (all fixed)
+        :param chunk_size: number of positions evaluated at once
+        :return: sensitivity map (same shape as x_grid), coordinates and values of the most
+        sensitive positions (local extrema), and runtime
+        """
+        if method not in self._METHODS:
+            raise ValueError(f"Method '{method}' is not supported (choose from {self._METHODS}).")
+        if method == 'delta_loss' and test_mass is None:
+            raise ValueError("A test mass must be provided with the 'delta_loss' method.")
+        x_grid, y_grid = np.asarray(x_grid), np.asarray(y_grid)
+        if x_grid.shape != y_grid.shape:
+            raise ValueError("x_grid and y_grid must have the same shape.")
+        sensitivity_fn = self._sensitivity_function(method, mass, test_mass, marginalize_keys)
+
+        # split positions in chunks, padding the last one with the first position
+        num_positions = x_grid.size
+        num_chunks = int(np.ceil(num_positions / chunk_size))
+        pad = num_chunks * chunk_size - num_positions
+        x_flat = np.concatenate([x_grid.ravel(), np.full(pad, x_grid.flat[0])])
+        y_flat = np.concatenate([y_grid.ravel(), np.full(pad, y_grid.flat[0])])
+
+        @jit
+        def evaluate(x_chunks, y_chunks):
+            return jax.lax.map(lambda xy: jax.vmap(sensitivity_fn)(*xy), (x_chunks, y_chunks))
+
+        start = time.time()
+        sensitivity_map = evaluate(x_flat.reshape(num_chunks, chunk_size),
+                                   y_flat.reshape(num_chunks, chunk_size)).block_until_ready()
+        runtime = time.time() - start
+        sensitivity_map = np.array(sensitivity_map).ravel()[:num_positions].reshape(x_grid.shape)
+
+        extrema = self._find_extrema(sensitivity_map, x_grid, y_grid, maximize=(method == 'fisher'))
+        return sensitivity_map, extrema, runtime
+
+    def _sensitivity_function(self, method, mass, test_mass, marginalize_keys):
+        mass_key, x_key, y_key = self._mass_key, self._x_key, self._y_key
+
+        def loss_at(x, y, mass, **others):
+            params = {**self._params, **others, mass_key: mass, x_key: x, y_key: y}
+            return self.loss(params)
+
+        if method == 'gradient':
+            return lambda x, y: grad(loss_at, argnums=2)(x, y, jnp.asarray(mass, dtype=float))
+
+        if method == 'delta_loss':
+            return lambda x, y: loss_at(x, y, test_mass) - loss_at(x, y, mass)
+
+        # Fisher information of the mass, i.e. inverse of its marginal variance in the Gaussian
+        # approximation (Schur complement), from the Jacobian J of the residuals: F = J^T J
+        others = {key: self._params[key] for key in (marginalize_keys or [])}
+        flat_init, unravel_fn = ravel_pytree((jnp.asarray(mass, dtype=float), others))
+
+        def fisher(x, y):
+            def residuals_flat(p):
+                mass, others = unravel_fn(p)
+                params = {**self._params, **others, mass_key: mass, x_key: x, y_key: y}
+                return self._prob_model.residuals(params, constrained=True)
+            jacobian = jax.jacfwd(residuals_flat)(flat_init)
+            fisher_matrix = jacobian.T @ jacobian
+            if fisher_matrix.shape[0] == 1:
+                return fisher_matrix[0, 0]
+            f_mr = fisher_matrix[0, 1:]
+            return fisher_matrix[0, 0] - f_mr @ jnp.linalg.solve(fisher_matrix[1:, 1:], f_mr)
+
+        return fisher
+
+    @staticmethod
+    def _find_extrema(sensitivity_map, x_grid, y_grid, maximize=False):
+        if sensitivity_map.ndim != 2:
+            return None
+        if maximize:
+            peak_indices_2d = feature.peak_local_max(sensitivity_map)
+        else:
+            peak_indices_2d = feature.peak_local_max(-np.clip(sensitivity_map, a_min=None, a_max=0))
+        x_minima = x_grid[peak_indices_2d[:, 0], peak_indices_2d[:, 1]]
+        y_minima = y_grid[peak_indices_2d[:, 0], peak_indices_2d[:, 1]]
+        z_minima = sensitivity_map[peak_indices_2d[:, 0], peak_indices_2d[:, 1]]
+        return x_minima, y_minima, z_minima
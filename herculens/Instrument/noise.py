@@ -10,7 +10,8 @@ __author__ = 'sibirrer', 'austinpeel', 'aymgal'
 import numpy as np
 from functools import partial
 import jax.numpy as jnp
-from jax import random, jit
+from jax import random, jit, vmap
+from jax.scipy.sparse.linalg import cg
 from herculens.Util import image_util
 
 
@@ -28,6 +29,12 @@ class Noise(object):
     the user should provide a (possibly varying) background_rms value when 
     calling the Noise.C_D_model().
 
+    In all cases, the noise can additionally be correlated between pixels, with stationary
+    correlations given by a power spectrum or a correlation kernel (e.g. for drizzled images). 
+    The covariance matrix is then C = V^(1/2) R V^(1/2), where V is the diagonal variance
+    returned by C_D_model() and R is the circulant correlation matrix, such that the likelihood
+    can be evaluated in O(N log N) with FFTs (see Noise.log_likelihood()).
+
     Parameters
     ----------
     nx : int
@@ -46,6 +53,16 @@ class Noise(object):
         By default None.
     variance_boost_map : np.array, optional
         fixed (not model-dependent) variance boost map. By default None.
+    background_power_spectrum : np.array, optional
+        Power spectrum of a stationary, correlated background noise, 
+        sampled on the Fourier modes of the image (i.e. in the layout of numpy.fft.fft2),
+        such that the background variance per pixel is its mean. If provided, it is used 
+        instead of background_rms to draw background noise realizations. Its shape 
+        also defines the correlations of the noise. By default None.
+    correlation_kernel : np.array, optional
+        Correlation function of the noise between a pixel and its neighbours, as an odd-sized 2D
+        array centered on the pixel (e.g. the correlation between adjacent pixels of a drizzled image).
+        If provided, overwrites the correlations derived from background_power_spectrum. By default None.
     verbose : bool, optional
         If True, outputs warning message at construction. By default True.
 
@@ -56,7 +73,8 @@ class Noise(object):
     """
 
     def __init__(self, nx, ny, exposure_time=None, background_rms=None, 
-                 noise_map=None, variance_boost_map=None, verbose=True):
+                 noise_map=None, variance_boost_map=None, background_power_spectrum=None,
+                 correlation_kernel=None, verbose=True):
         self._data = None  # TODO: is that really useful?
         self._nx, self._ny = nx, ny  # TODO: is that really useful?
         if noise_map is not None:
@@ -83,6 +101,23 @@ class Noise(object):
         if variance_boost_map is None:
             variance_boost_map = np.ones((self._nx, self._ny))
         self.global_boost_map = variance_boost_map
+        if background_power_spectrum is not None:
+            assert np.shape(background_power_spectrum) == (nx, ny)
+            assert np.all(background_power_spectrum >= 0.)
+        self._background_power_spectrum = background_power_spectrum
+        if correlation_kernel is not None:
+            correlation_spectrum = self.correlation_spectrum_from_kernel(correlation_kernel, (nx, ny))
+        elif background_power_spectrum is not None:
+            correlation_spectrum = background_power_spectrum / np.mean(background_power_spectrum)
+        else:
+            correlation_spectrum = None
+        if correlation_spectrum is not None:
+            if np.any(correlation_spectrum <= 0.):
+                raise ValueError("The noise correlation matrix must be positive definite "
+                                 "(i.e. its power spectrum must be strictly positive).")
+            # only half of the modes are needed with real FFTs, as the spectrum is symmetric
+            correlation_spectrum = correlation_spectrum[:, :ny//2+1]
+        self._correlation_spectrum = correlation_spectrum
 
     def set_data(self, data):
         assert np.shape(data) == (self._nx, self._ny)
@@ -125,18 +160,88 @@ class Noise(object):
             ValueError
                 If `add_background` is True but `background_rms` is None.
             """
-            noise_real = 0.
-            key1, key2 = random.split(prng_key)
-            if add_poisson_model:
-                if self.exposure_map is None:
-                    raise ValueError("An exposure time (or map) is needed to add Poisson (shot) noise")
-                noise_real += image_util.add_poisson(model, self.exposure_map, key1)
-            if add_background:
-                if self.background_rms is None:
-                    raise ValueError("A background RMS value is needed to add background noise")
-                noise_real += image_util.add_background(model, self.background_rms, key2)
-            return noise_real
-    
+            exposure_map, background = self._check_realisation_settings(add_background, add_poisson_model)
+            return self._draw_realisation(prng_key, model, exposure_map, background,
+                                          add_background, add_poisson_model)
+
+    @partial(jit, static_argnums=(0, 3, 4, 5))
+    def realisations(self, model, prng_key, num_realisations, add_background=True, 
+                     add_poisson_model=True, exposure_map=None):
+        """Draws a batch of independent noise realizations consistent with the model, 
+        in a single vectorized call (e.g. for mock data or Monte Carlo noise propagation).
+        The background noise is correlated if a `background_power_spectrum` has been 
+        provided to the constructor, and white otherwise.
+
+        Parameters
+        ----------
+        model : jax.numpy.array
+            Image model used for the Poisson (shot) noise, either a single 2D image
+            or a batch of images of shape (num_realisations, ny, nx).
+        prng_key : jax.random.PRNGKey
+            The random key used for generating random numbers.
+        num_realisations : int
+            Number of noise realizations.
+        add_background : bool, optional
+            Whether to add background noise to the model. Default is True.
+        add_poisson_model : bool, optional
+            Whether to add Poisson noise (shot noise) to the model. Default is True.
+        exposure_map : jax.numpy.array, optional
+            Exposure time or map that replaces the one provided to the constructor,
+            either common to all realizations or of shape (num_realisations, ny, nx).
+            By default None.
+
+        Returns
+        -------
+        jax.numpy.array
+            Noise realizations, of shape (num_realisations, ny, nx).
+
+        Raises
+        ------
+        ValueError
+            If `add_poisson_model` is True but no exposure map is available.
+        ValueError
+            If `add_background` is True but `background_rms` is None.
+        """
+        default_exposure_map, background = self._check_realisation_settings(
+            add_background, add_poisson_model, check_exposure=exposure_map is None)
+        if exposure_map is None:
+            exposure_map = default_exposure_map
+        batched_model = jnp.ndim(model) == 3
+        batched_exposure = jnp.ndim(exposure_map) == 3
+        keys = random.split(prng_key, num_realisations)
+        draw = lambda key, model, exposure_map: self._draw_realisation(
+            key, model, exposure_map, background, add_background, add_poisson_model)
+        in_axes = (0, 0 if batched_model else None, 0 if batched_exposure else None)
+        return vmap(draw, in_axes=in_axes)(keys, model, exposure_map)
+
+    def _check_realisation_settings(self, add_background, add_poisson_model, check_exposure=True):
+        exposure_map, background = None, None
+        if add_poisson_model and check_exposure:
+            if self.exposure_map is None:
+                raise ValueError("An exposure time (or map) is needed to add Poisson (shot) noise")
+            exposure_map = self.exposure_map
+        if add_background:
+            if self._background_power_spectrum is not None:
+                background = jnp.sqrt(self._background_power_spectrum)
+            elif self.background_rms is None:
+                raise ValueError("A background RMS value is needed to add background noise")
+            else:
+                background = self.background_rms
+        return exposure_map, background
+
+    def _draw_realisation(self, prng_key, model, exposure_map, background, 
+                          add_background, add_poisson_model):
+        noise_real = 0.
+        key1, key2 = random.split(prng_key)
+        if add_poisson_model:
+            noise_real += image_util.add_poisson(model, exposure_map, key1)
+        if add_background:
+            if self._background_power_spectrum is not None:
+                noise_real += image_util.add_correlated_background(model, background, key2)
+            else:
+                noise_real += image_util.add_background(model, background, key2)
+        return noise_real
+
     @property
     def variance_boost_map(self):
         # NOTE: we use a setter for backward compatibility reasons
@@ -255,6 +360,153 @@ class Noise(object):
             c_d = self.total_variance(model, background_rms, self.exposure_map)
         return self.global_boost_map * boost_map * c_d
     
+    @property
+    def is_correlated(self):
+        """Whether the noise is correlated between pixels."""
+        return self._correlation_spectrum is not None
+
+    @partial(jit, static_argnums=(0,))
+    def whitened_residuals(self, data, model, mask=None, background_rms=None, boost_map=1., 
+                           cg_tol=1e-6, cg_maxiter=200):
+        """Returns the whitened residuals w = C^(-1/2) (data - model), such that the chi-square is sum(w**2),
+        where C is the noise covariance matrix (see C_D_model() for the diagonal variance). 
+        For uncorrelated noise, these are the usual normalized residuals. For correlated noise, the 
+        whitening is computed with FFTs. If a mask is given, the chi-square of the unmasked pixels 
+        requires the inverse of the covariance restricted to these pixels. This is obtained by filling 
+        the masked pixels with their conditional mean given the unmasked residuals, computed with 
+        conjugate gradients, which converges in a few iterations when a small fraction of the 
+        pixels is masked.
+
+        Parameters
+        ----------
+        data : jax.numpy.array
+            Observed image.
+        model : jax.numpy.array
+            Image model.
+        mask : jax.numpy.array, optional
+            Array of 1s (pixels included) and 0s (pixels excluded). By default None.
+        background_rms : float, optional
+            Standard deviation of the background noise, see C_D_model(). By default None.
+        boost_map : jax.numpy.array, optional
+            Multiplicative factors for the noise variance, see C_D_model(). By default 1.
+        cg_tol : float, optional
+            Tolerance of the conjugate gradient solver, for correlated noise with a mask. By default 1e-6.
+        cg_maxiter : int, optional
+            Maximum number of conjugate gradient iterations. By default 200.
+
+        Returns
+        -------
+        jax.numpy.array
+            Whitened residuals, with the same shape as the data.
+        """
+        inv_std = 1. / jnp.sqrt(self.C_D_model(model, background_rms=background_rms, boost_map=boost_map))
+        residuals = data - model
+        if mask is not None:
+            residuals = mask * residuals
+        if not self.is_correlated:
+            return inv_std * residuals
+        if mask is not None:
+            # fill the masked pixels with the values minimizing the chi-square
+            mask_out = 1. - mask
+            inv_cov = lambda v: inv_std * self._apply_correlation(inv_std * v, -1.)
+            matvec = lambda v: mask_out * inv_cov(mask_out * v)
+            filling = cg(matvec, - mask_out * inv_cov(residuals), tol=cg_tol, maxiter=cg_maxiter)[0]
+            residuals = residuals + mask_out * filling
+        return self._apply_correlation(inv_std * residuals, -0.5)
+
+    @partial(jit, static_argnums=(0,))
+    def log_likelihood(self, data, model, mask=None, background_rms=None, boost_map=1., 
+                       cg_tol=1e-6, cg_maxiter=200):
+        """Gaussian log-likelihood of the data given the model, for possibly correlated noise.
+        The cost of each evaluation is O(N log N) for N pixels (see whitened_residuals()).
+        With a mask and correlated noise, the log-determinant of the correlation matrix restricted 
+        to the unmasked pixels is approximated by the fraction of unmasked pixels times the 
+        log-determinant of the full correlation matrix (this term does not depend on the model).
+
+        Parameters
+        ----------
+        data : jax.numpy.array
+            Observed image.
+        model : jax.numpy.array
+            Image model.
+        mask : jax.numpy.array, optional
+            Array of 1s (pixels included) and 0s (pixels excluded). By default None.
+        background_rms : float, optional
+            Standard deviation of the background noise, see C_D_model(). By default None.
+        boost_map : jax.numpy.array, optional
+            Multiplicative factors for the noise variance, see C_D_model(). By default 1.
+        cg_tol : float, optional
+            Tolerance of the conjugate gradient solver, see whitened_residuals(). By default 1e-6.
+        cg_maxiter : int, optional
+            Maximum number of conjugate gradient iterations. By default 200.
+
+        Returns
+        -------
+        float
+            Log-likelihood.
+        """
+        whitened = self.whitened_residuals(data, model, mask=mask, background_rms=background_rms, 
+                                           boost_map=boost_map, cg_tol=cg_tol, cg_maxiter=cg_maxiter)
+        log_var = jnp.log(self.C_D_model(model, background_rms=background_rms, boost_map=boost_map))
+        if mask is None:
+            mask = jnp.ones_like(log_var)
+        num_pix = jnp.sum(mask)
+        log_det = jnp.sum(mask * log_var)
+        if self.is_correlated:
+            log_det += num_pix / mask.size * self._correlation_log_det()
+        return - 0.5 * (jnp.sum(whitened**2) + log_det + num_pix * np.log(2. * np.pi))
+
+    def correlated_realisation(self, std_map, prng_key):
+        """Draws a realization of Gaussian noise with a given standard deviation per pixel,
+        and the correlations of this noise model (if any)."""
+        white = random.normal(prng_key, shape=jnp.shape(std_map))
+        if not self.is_correlated:
+            return std_map * white
+        return std_map * self._apply_correlation(white, 0.5)
+
+    def _apply_correlation(self, image, power):
+        """Product of the correlation matrix to the given power with an image."""
+        spectrum = self._correlation_spectrum**power
+        return jnp.fft.irfft2(spectrum * jnp.fft.rfft2(image), s=jnp.shape(image))
+
+    def _correlation_log_det(self):
+        spectrum = self._correlation_spectrum
+        # modes of the missing half of the spectrum (the last one is not duplicated for even sizes)
+        num_dupl = self._ny - spectrum.shape[1]
+        return np.sum(np.log(spectrum)) + np.sum(np.log(spectrum[:, 1:num_dupl+1]))
+
+    @staticmethod
+    def correlation_spectrum_from_kernel(kernel, shape):
+        """Computes the spectrum of the (circulant) correlation matrix of stationary noise 
+        from its correlation kernel.
+
+        Parameters
+        ----------
+        kernel : np.array
+            Odd-sized 2D correlation kernel, centered on the pixel. It is normalized by its central value.
+        shape : tuple
+            Shape of the images.
+
+        Returns
+        -------
+        np.array
+            Spectrum of the correlation matrix, in the layout of numpy.fft.fft2.
+
+        Raises
+        ------
+        ValueError
+            If the kernel is not odd-sized or larger than the images.
+        """
+        kernel = np.asarray(kernel, dtype=float)
+        ky, kx = kernel.shape
+        if ky % 2 == 0 or kx % 2 == 0 or ky > shape[0] or kx > shape[1]:
+            raise ValueError("The correlation kernel must be odd-sized and smaller than the image.")
+        kernel = kernel / kernel[ky//2, kx//2]
+        padded = np.zeros(shape)
+        padded[:ky, :kx] = kernel
+        padded = np.roll(padded, (-(ky//2), -(kx//2)), axis=(0, 1))
+        return np.fft.fft2(padded).real
+
     def _reset_cache(self):
         if hasattr(self, '_C_D'):
             delattr(self, '_C_D')
@@ -17,7 +17,8 @@ from utax.convolution.functions import build_convolution_matrix
 from herculens.Util import util, kernel_util, image_util
 
 
-__all__ = ['PixelKernelConvolution', 'SubgridKernelConvolution', 'GaussianConvolution']
+__all__ = ['PixelKernelConvolution', 'BatchedPixelKernelConvolution', 
+           'SubgridKernelConvolution', 'GaussianConvolution']
 
 
 class PixelKernelConvolution(object):
@@ -82,6 +83,83 @@ class PixelKernelConvolution(object):
     def convolution_matrix(self):
         return self._conv_matrix
 
+    @property
+    def convolution_type(self):
+        return self._conv_type
+
+
+class BatchedPixelKernelConvolution(object):
+    """
+    class to convolve a stack of images, each with its own pixelized kernel, 
+    using a single batched FFT (equivalent to fftconvolve with mode='same' on each slice)
+    """
+
+    def __init__(self, kernel_list, image_shape):
+        """
+
+        :param kernel_list: list of 2d arrays (kernels are zero-padded to a common odd shape)
+        :param image_shape: shape (nx, ny) of the images to be convolved
+        """
+        self._kernel_cube = self.stack_kernels(kernel_list)
+        nx, ny = image_shape
+        kx, ky = self._kernel_cube.shape[1:]
+        self._image_shape = (nx, ny)
+        self._fft_shape = (nx + kx - 1, ny + ky - 1)
+        self._start = ((kx - 1) // 2, (ky - 1) // 2)
+        # the kernel transforms do not depend on model parameters, so we compute them once
+        self._kernel_cube_fft = jnp.fft.rfft2(self._kernel_cube, s=self._fft_shape, axes=(-2, -1))
+
+    @staticmethod
+    def stack_kernels(kernel_list):
+        """
+        zero-pads a list of kernels to a common odd shape, such that convolving with 
+        each padded kernel gives the same result as with the original one. 
+        Kernels with an even axis length are first padded with one row (or column) 
+        of zeros at the start of that axis, which preserves the centering convention 
+        of fftconvolve with mode='same', and all kernels are then padded symmetrically.
+
+        :param kernel_list: list of 2d arrays
+        :return: 3d array of shape (num_kernels, kx, ky), with kx and ky odd
+        """
+        odd_kernel_list = []
+        for kernel in kernel_list:
+            kernel = jnp.asarray(kernel)
+            if kernel.ndim != 2:
+                raise ValueError(f"Kernels should be 2d arrays (got shape {kernel.shape}).")
+            nx, ny = kernel.shape
+            odd_kernel_list.append(jnp.pad(kernel, ((1 - nx % 2, 0), (1 - ny % 2, 0))))
+        kx = max([kernel.shape[0] for kernel in odd_kernel_list])
+        ky = max([kernel.shape[1] for kernel in odd_kernel_list])
+        kernel_cube = []
+        for kernel in odd_kernel_list:
+            px = (kx - kernel.shape[0]) // 2
+            py = (ky - kernel.shape[1]) // 2
+            kernel_cube.append(jnp.pad(kernel, ((px, px), (py, py))))
+        return jnp.stack(kernel_cube, axis=0)
+
+    @property
+    def kernel_cube(self):
+        return self._kernel_cube
+
+    def convolution2d(self, image_cube):
+        """
+
+        :param image_cube: 3d array of shape (num_kernels, nx, ny) to be convolved
+        :return: 3d array of convolved images
+        """
+        image_fft = jnp.fft.rfft2(image_cube, s=self._fft_shape, axes=(-2, -1))
+        full = jnp.fft.irfft2(image_fft * self._kernel_cube_fft, s=self._fft_shape, axes=(-2, -1))
+        (sx, sy), (nx, ny) = self._start, self._image_shape
+        return full[..., sx:sx+nx, sy:sy+ny]
+
+    def re_size_convolve(self, image_low_res, image_high_res=None):
+        """
+
+        :param image_low_res: 3d array of regularly sampled images to be convolved
+        :return: 3d array of convolved images
+        """
+        return self.convolution2d(image_low_res)
+
 
 
 class SubgridKernelConvolution(object):
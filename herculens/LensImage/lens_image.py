@@ -14,6 +14,8 @@ from jax import jit
 from jax import random
 
 from herculens.LensImage.Numerics.numerics import Numerics
+from herculens.LensImage.Numerics.convolution import (PixelKernelConvolution, 
+                                                       BatchedPixelKernelConvolution)
 from herculens.LensImage.lensing_operator import LensingOperator
 
 
@@ -40,7 +42,9 @@ class LensImage(object):
         :param point_source_model_class: point source model, instance of PointSourceModel() from herculens.PointSource.point_source
         :param source_arc_mask: 2D boolean array to define the region over which the (pixelated) lensed source is modeled
         :param kwargs_numerics: keyword arguments for various numerical settings (see herculens.Numerics.numerics)
-        :param kwargs_lens_equation_solver: TODO
+        :param kwargs_lens_equation_solver: keyword arguments of the lens equation solver (see helens),
+        which may also contain 'duplicate_tolerance', the distance below which two predicted images 
+        of a point source are considered duplicates (see PointSource.image_positions_and_amplitudes())
         """
         self.Grid = grid_class
         self.PSF = psf_class
@@ -428,9 +432,15 @@ class LensImage3D(object):
     pixelated source models. In case you use a 3D pixelated source model 
     (such as CorrelatedField model) on an adaptive grid, you may want to set 
     `join_source_coords=True` to ensure that the source model gets evaluated on the same grid.
+
+    NOTE: When all LensImage instances share the same pixel grid, supersampling 
+    and mass model, the lens equation is solved only once for all bands, and, 
+    if all PSFs are 'PIXEL' kernels convolved with 'jax_scipy_fft', all bands 
+    are convolved with a single batched FFT over the stacked PSF kernels.
     """
 
-    def __init__(self, lens_image_list, mode='stack', reference_lens_image=0, join_source_coords=True):
+    def __init__(self, lens_image_list, mode='stack', reference_lens_image=0, join_source_coords=True,
+                 share_grid=None):
         """
         Initialize a LensImage object.
 
@@ -446,6 +456,12 @@ class LensImage3D(object):
             If set to True, the adaptive source pixelated grid of the 
             reference LensImage instance (if any) will be used to define 
             all source pixelated grids. By default True.
+        share_grid : bool or None, optional
+            If all LensImage instances are defined on the same (supersampled) 
+            coordinates grid with the same mass model, ray-shooting is performed 
+            once for all bands. If None, this is done whenever possible; if True, 
+            an error is raised if it is not possible; if False, it is never done. 
+            By default None.
 
         Raises
         ------
@@ -456,6 +472,9 @@ class LensImage3D(object):
         ValueError
             If the reference LensImage instance does not have an adaptive source grid
             and joint_source_coords was set to True.
+        ValueError
+            If `share_grid` is True but the LensImage instances do not share 
+            the same coordinates grid and mass model.
 
         Notes
         -----
@@ -489,6 +508,76 @@ class LensImage3D(object):
         if self._join_source_coords and not self.ref_lens_image.SourceModel.pixel_is_adaptive:
             raise ValueError("The reference LensImage instance must have an "
                              "adaptive source grid to join source coordinates.")
+        self._shared_grid = False
+        if share_grid is not False:
+            mismatch = self._shared_grid_mismatch()
+            if mismatch is not None and share_grid is True:
+                raise ValueError(f"The grid cannot be shared between bands: {mismatch}.")
+            self._shared_grid = mismatch is None
+        self._batched_conv = None
+        if self._shared_grid:
+            self._batched_conv = self._setup_batched_convolution()
+
+    @property
+    def shared_grid(self):
+        """Whether ray-shooting and convolution are performed jointly for all bands."""
+        return self._shared_grid
+
+    def _shared_grid_mismatch(self):
+        """Returns the reason why ray-shooting cannot be shared by all bands, or None."""
+        ref = self.ref_lens_image
+        ref_x, ref_y = ref.ImageNumerics.coordinates_evaluate
+        ref_pixel_x, ref_pixel_y = ref.Grid.pixel_coordinates
+        for i, lens_image in enumerate(self.lens_images):
+            if lens_image.Grid.num_pixel_axes != ref.Grid.num_pixel_axes:
+                return f"the pixel grid of band {i} has a different shape"
+            pixel_x, pixel_y = lens_image.Grid.pixel_coordinates
+            if not (np.allclose(pixel_x, ref_pixel_x) and np.allclose(pixel_y, ref_pixel_y)):
+                return f"the pixel grid of band {i} has different coordinates"
+            if lens_image.ImageNumerics.grid_supersampling_factor != ref.ImageNumerics.grid_supersampling_factor:
+                return f"band {i} has a different supersampling factor"
+            x, y = lens_image.ImageNumerics.coordinates_evaluate
+            if not (np.allclose(x, ref_x) and np.allclose(y, ref_y)):
+                return f"band {i} is evaluated on different (supersampled) coordinates"
+            mismatch = self._mass_model_mismatch(lens_image.MassModel, ref.MassModel)
+            if mismatch is not None:
+                return f"the mass model of band {i} has {mismatch}"
+        return None
+
+    @staticmethod
+    def _mass_model_mismatch(mass_model, ref_mass_model):
+        if mass_model is ref_mass_model:
+            return None
+        profiles = mass_model.profile_type_list
+        ref_profiles = ref_mass_model.profile_type_list
+        if len(profiles) != len(ref_profiles):
+            return "a different number of profiles"
+        for profile, ref_profile in zip(profiles, ref_profiles):
+            # profile instances are only equivalent to themselves
+            if not (profile is ref_profile or (isinstance(profile, str) and profile == ref_profile)):
+                return "different profiles"
+        if mass_model.has_pixels:
+            pixel_grid, ref_pixel_grid = mass_model.pixel_grid, ref_mass_model.pixel_grid
+            if (pixel_grid is None) != (ref_pixel_grid is None):
+                return "a different pixel grid"
+            if pixel_grid is not None:
+                if pixel_grid.num_pixel_axes != ref_pixel_grid.num_pixel_axes:
+                    return "a different pixel grid"
+                pixel_x, pixel_y = pixel_grid.pixel_coordinates
+                ref_pixel_x, ref_pixel_y = ref_pixel_grid.pixel_coordinates
+                if not (np.allclose(pixel_x, ref_pixel_x) and np.allclose(pixel_y, ref_pixel_y)):
+                    return "a different pixel grid"
+        return None
+
+    def _setup_batched_convolution(self):
+        kernel_list = []
+        for lens_image in self.lens_images:
+            conv = lens_image.ImageNumerics.convolution_class
+            if (not isinstance(conv, PixelKernelConvolution) 
+                or conv.convolution_type != 'jax_scipy_fft'):
+                return None
+            kernel_list.append(conv.pixel_kernel())
+        return BatchedPixelKernelConvolution(kernel_list, self.ref_lens_image.Grid.num_pixel_axes)
 
     @property
     def ref_lens_image(self):
@@ -599,6 +688,16 @@ class LensImage3D(object):
             source_coords = (src_x_coord, src_y_coord)
         else:
             source_coords = None
+        if self._shared_grid and not supersampled:
+            model_multi_band = self._model_shared_grid(
+                kwargs_lens, kwargs_source_list, kwargs_lens_light_list,
+                kwargs_point_source_list, unconvolved, source_add, lens_light_add,
+                point_source_add, k_lens, k_source_list, k_lens_light_list,
+                k_point_source_list, source_coords,
+            )
+            if self.mode == 'stack':
+                return model_multi_band
+            return list(model_multi_band)
         model_multi_band = []
         for i in range(self.num_bands):
             model_sgl_band = self.lens_images[i].model(
@@ -618,6 +717,77 @@ class LensImage3D(object):
             return jnp.stack(model_multi_band, axis=0)
         return model_multi_band
 
+    def _model_shared_grid(self, kwargs_lens, kwargs_source_list, kwargs_lens_light_list,
+                           kwargs_point_source_list, unconvolved, source_add, lens_light_add,
+                           point_source_add, k_lens, k_source_list, k_lens_light_list,
+                           k_point_source_list, source_coords):
+        """
+        Same as .model() for bands sharing the same coordinates grid: the lens equation
+        is solved once, and all bands are re-sized and convolved together.
+        Returns a 3D array of shape (num_bands, nx, ny).
+        """
+        ref = self.ref_lens_image
+        x_grid_img, y_grid_img = ref.ImageNumerics.coordinates_evaluate
+        num_points = ref.ImageNumerics.grid_class.num_grid_points
+        source_flux = jnp.zeros((self.num_bands, num_points))
+        lens_flux = jnp.zeros((self.num_bands, num_points))
+        if source_add is True:
+            x_grid_src, y_grid_src = ref.MassModel.ray_shooting(x_grid_img, y_grid_img, kwargs_lens, k=k_lens)
+            source_flux_list = []
+            for i, lens_image in enumerate(self.lens_images):
+                if len(lens_image.SourceModel.profile_type_list) == 0:
+                    source_flux_list.append(jnp.zeros(num_points))
+                    continue
+                if not lens_image._src_adaptive_grid:
+                    pixels_x_coord, pixels_y_coord = None, None
+                elif source_coords is not None:
+                    pixels_x_coord, pixels_y_coord = source_coords
+                else:
+                    pixels_x_coord, pixels_y_coord, _ = lens_image.adapt_source_coordinates(kwargs_lens, k_lens=k_lens)
+                source_flux_list.append(lens_image.SourceModel.surface_brightness(
+                    x_grid_src, y_grid_src, kwargs_source_list[i], k=k_source_list[i],
+                    pixels_x_coord=pixels_x_coord, pixels_y_coord=pixels_y_coord,
+                ))
+            source_flux = jnp.stack(source_flux_list, axis=0)
+        if lens_light_add is True:
+            lens_flux = jnp.stack([
+                lens_image.LensLightModel.surface_brightness(
+                    x_grid_img, y_grid_img, kwargs_lens_light_list[i], k=k_lens_light_list[i],
+                )
+                for i, lens_image in enumerate(self.lens_images)
+            ], axis=0)
+        arc_masks = [lens_image.source_arc_mask for lens_image in self.lens_images]
+        if all([arc_mask is None for arc_mask in arc_masks]):
+            # convolution is linear: source and lens light can be convolved together
+            model = self._re_size_convolve_bands(source_flux + lens_flux, unconvolved)
+        else:
+            arc_masks = jnp.stack([jnp.ones(ref.Grid.num_pixel_axes) if arc_mask is None else arc_mask
+                                   for arc_mask in arc_masks], axis=0)
+            model = (self._re_size_convolve_bands(source_flux, unconvolved) * arc_masks
+                     + self._re_size_convolve_bands(lens_flux, unconvolved))
+        if point_source_add:
+            model += jnp.stack([
+                lens_image.point_source_image(kwargs_point_source_list[i], kwargs_lens,
+                                              kwargs_solver=lens_image.kwargs_lens_equation_solver,
+                                              k=k_point_source_list[i])
+                for i, lens_image in enumerate(self.lens_images)
+            ], axis=0)
+        return model
+
+    def _re_size_convolve_bands(self, flux_arrays, unconvolved):
+        if self._batched_conv is None or unconvolved is True:
+            return jnp.stack([
+                lens_image.ImageNumerics.re_size_convolve(flux_arrays[i], unconvolved=unconvolved)
+                for i, lens_image in enumerate(self.lens_images)
+            ], axis=0)
+        numerics = self.ref_lens_image.ImageNumerics
+        image_low_res = jnp.stack([
+            numerics.grid_class.flux_array2image_low_high(flux_array)[0]
+            for flux_array in flux_arrays
+        ], axis=0)
+        image_conv = self._batched_conv.re_size_convolve(image_low_res)
+        return image_conv * numerics.grid_class.pixel_width ** 2
+
     def simulation(self, *args, **kwargs):
         raise NotImplementedError("The .simulation() method is not supported for 3D models. "
                                   "Please use the standard LensImage class.")
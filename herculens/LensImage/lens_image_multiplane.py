@@ -11,6 +11,7 @@ import scipy.ndimage
 
 from functools import partial
 from herculens.LensImage.Numerics.numerics import Numerics
+from herculens.Util.jax_util import hash_pytree
 
 
 class MPLensImage(object):
@@ -126,6 +127,9 @@ class MPLensImage(object):
             -1
         ).astype(bool)
 
+        # cache of ray positions used by `model_incremental`
+        self._ray_cache = None
+
     def k_extend(self, k, amount):
         if k is None:
             return jnp.arange(amount)
@@ -194,6 +198,135 @@ class MPLensImage(object):
             kwargs_mass,
             k=k_mass
         )
+        return self._model_from_planes(
+            ra_grid_planes,
+            dec_grid_planes,
+            kwargs_light,
+            supersampled=supersampled,
+            k_light=k_light,
+            k_planes=k_planes,
+            return_pixel_scale=return_pixel_scale
+        )
+
+    def model_incremental(
+        self,
+        eta_flat=None,
+        kwargs_mass=None,
+        kwargs_light=None,
+        supersampled=False,
+        k_light=None,
+        k_planes=None,
+        return_pixel_scale=False
+    ):
+        '''Same as `model()`, but ray positions on each plane are cached between
+        calls such that rays are only re-traced from the first mass plane whose
+        parameters (or eta values) changed since the previous call. This is useful
+        when only the back planes are being optimized while the front plane(s) are
+        kept fixed. Note: this method must be called outside of jitted functions,
+        as the cache is keyed on the (concrete) values of the parameters.
+
+        Parameters
+        ----------
+        eta_flat : jax.numpy array
+            upper triangular elements of eta matrix (see `model()`).
+        kwargs_mass : list of list
+            List of lists of parameter dictionaries of lens mass model parameters
+            corresponding to each mass plane.
+        kwargs_light : list of list
+            List of lists of parameter dictionaries corresponding to each light plane.
+        supersampled : bool, optional
+            If True returns the unconvolved model on the higher resolution grid, by default False
+        k_light : list of list, optional
+            Only evaluate the k-th light model (list of list of index values) for each light
+            plane, by default None
+        k_planes : list, optional
+            List of light plane index values to include in the output, by default None
+        return_pixel_scale : bool, optional
+            If True returns the pixel scale (arcsec/pixel) of each source plane, by default False.
+
+        Returns
+        -------
+        model : jax.numpy array
+            The 2D model image for the lens system
+        pixel_scale : list, optional
+            The pixel scale (arcsec/pixel) of each source plane (see `model()`).
+        '''
+        ra_grid_planes, dec_grid_planes = self.ray_shooting_cached(eta_flat, kwargs_mass)
+        return self._model_from_planes(
+            ra_grid_planes,
+            dec_grid_planes,
+            kwargs_light,
+            supersampled=supersampled,
+            k_light=k_light,
+            k_planes=k_planes,
+            return_pixel_scale=return_pixel_scale
+        )
+
+    def ray_shooting_cached(self, eta_flat, kwargs_mass):
+        '''Ray shoot the (supersampled) image plane coordinates to each plane, re-using
+        the cached positions for the front mass planes whose parameters did not change
+        since the previous call (see `model_incremental`).
+
+        Parameters
+        ----------
+        eta_flat : jax.numpy array
+            upper triangular elements of eta matrix (see `model()`).
+        kwargs_mass : list of list
+            List of lists of parameter dictionaries of lens mass model parameters
+            corresponding to each mass plane.
+
+        Returns
+        -------
+        ra_grid_planes, dec_grid_planes : jax.numpy array
+            Positions on each plane, same as `MPMassModel.ray_shooting`.
+        '''
+        N = self.MPMassModel.number_mass_planes
+        # a mass plane only changes the positions through its parameters and its row
+        # in the eta matrix, so both are used to identify changes plane by plane
+        eta_full = np.asarray(
+            self.MPMassModel.base_eta.at[self.MPMassModel.eta_idx].set(eta_flat)
+        )
+        plane_keys = [hash_pytree((eta_full[j], kwargs_mass[j])) for j in range(N)]
+        if self._ray_cache is None:
+            ra_grid_img, dec_grid_img = self.ImageNumerics.coordinates_evaluate
+            self._ray_cache = {
+                'keys': [None] * N,
+                # positions on each plane after adding the deflection of each mass plane
+                'ra_steps': [jnp.stack([ra_grid_img] * (N + 1), axis=0)],
+                'dec_steps': [jnp.stack([dec_grid_img] * (N + 1), axis=0)],
+            }
+        # index of the first mass plane whose parameters changed
+        start = next((j for j in range(N) if plane_keys[j] != self._ray_cache['keys'][j]), N)
+        if start < N:
+            ra_steps, dec_steps = self.MPMassModel.ray_shooting_from_plane(
+                self._ray_cache['ra_steps'][start],
+                self._ray_cache['dec_steps'][start],
+                eta_flat,
+                kwargs_mass,
+                start
+            )
+            self._ray_cache['keys'] = plane_keys
+            self._ray_cache['ra_steps'] = self._ray_cache['ra_steps'][:start + 1] + list(ra_steps)
+            self._ray_cache['dec_steps'] = self._ray_cache['dec_steps'][:start + 1] + list(dec_steps)
+        return self._ray_cache['ra_steps'][-1], self._ray_cache['dec_steps'][-1]
+
+    def clear_ray_cache(self):
+        '''Deletes the ray positions cached by `model_incremental`.'''
+        self._ray_cache = None
+
+    @partial(jax.jit, static_argnums=(0, 4, 5, 6, 7))
+    def _model_from_planes(
+        self,
+        ra_grid_planes,
+        dec_grid_planes,
+        kwargs_light,
+        supersampled=False,
+        k_light=None,
+        k_planes=None,
+        return_pixel_scale=False
+    ):
+        '''Evaluates the light on each plane given the positions traced to each plane,
+        and sums their contributions in the image plane.'''
         # (masked) light contribution from each plane
         pixels_x_coord, pixels_y_coord, _ = self.adapt_source_coordinates(
             ra_grid_planes,
@@ -238,9 +371,9 @@ class MPLensImage(object):
         model = self.model(**model_kwargs)
         noise = self.Noise.realisation(
             model,
-            noise_seed,
-            add_poisson=add_poisson,
-            add_gaussian=add_gaussian
+            jax.random.PRNGKey(noise_seed),
+            add_poisson_model=add_poisson,
+            add_background=add_gaussian
         )
         simu = model + noise
         self.Noise.set_data(simu)
@@ -0,0 +1,215 @@
+# Defines the model of a stack of dithered exposures of a strong lens
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from functools import partial
+from jax import jit
+from jax.scipy.ndimage import map_coordinates
+
+from herculens.LensImage.Numerics.convolution import BatchedPixelKernelConvolution
+from herculens.Util import kernel_util
+
+
+__all__ = ['LensImageStack']
+
+
+class LensImageStack(object):
+    """
+    Joint model of multiple exposures (e.g., dithered or multi-epoch) of the same lens,
+    observed in the same band.
+
+    The unconvolved model is ray-traced and evaluated only once, on the supersampled
+    grid of a reference LensImage instance. It is then resampled onto the pixel grid of each
+    exposure, given its sub-pixel offset, and convolved with the corresponding PSF.
+    The resampling and convolution of all exposures are performed as batched operations.
+
+    NOTE: each exposure is assumed to have the same pixel grid as the reference LensImage,
+    up to a translation given by the exposure offsets. Point sources are not supported yet.
+    """
+
+    def __init__(self, lens_image, exposure_offsets, psf_list=None, noise_list=None,
+                 interpolation_order=1):
+        """
+        Parameters
+        ----------
+        lens_image : LensImage
+            Reference LensImage instance, that holds the pixel grid, the models, and
+            the supersampling factor (through its `kwargs_numerics`) defining the common grid.
+        exposure_offsets : array_like
+            Array of shape (num_exposures, 2) containing the offsets (in arcsec)
+            of the pixel grid of each exposure, along RA and Dec,
+            with respect to the pixel grid of the reference LensImage.
+        psf_list : list of PSF, optional
+            PSF of each exposure. If None, the PSF of the reference LensImage is used
+            for all exposures. By default None. 'GAUSSIAN' PSFs are converted to pixelated 
+            kernels sampled at the pixel size of the exposures.
+        noise_list : list of Noise, optional
+            Noise of each exposure. If None, the Noise of the reference LensImage is used
+            for all exposures. By default None.
+        interpolation_order : int, optional
+            Order of the spline interpolation (0 or 1) used to resample the supersampled model
+            onto each exposure grid. By default 1.
+
+        Raises
+        ------
+        ValueError
+            If the number of exposures is not consistent between offsets, PSFs and noises.
+        ValueError
+            If a PSF type is not supported.
+        NotImplementedError
+            If the reference LensImage contains a point source model.
+        """
+        exposure_offsets = np.atleast_2d(np.asarray(exposure_offsets, dtype=float))
+        if exposure_offsets.ndim != 2 or exposure_offsets.shape[1] != 2:
+            raise ValueError("exposure_offsets should have shape (num_exposures, 2).")
+        if len(lens_image.PointSourceModel.type_list) > 0:
+            raise NotImplementedError("Point sources are not yet supported by LensImageStack.")
+        self.lens_image = lens_image
+        self.num_exposures = len(exposure_offsets)
+        if psf_list is None:
+            psf_list = [lens_image.PSF] * self.num_exposures
+        if noise_list is None:
+            noise_list = [lens_image.Noise] * self.num_exposures
+        if len(psf_list) != self.num_exposures or len(noise_list) != self.num_exposures:
+            raise ValueError("There should be one PSF and one Noise per exposure.")
+        if interpolation_order not in (0, 1):
+            raise ValueError("interpolation_order should be either 0 or 1.")
+        self.psf_list = psf_list
+        self.noise_list = noise_list
+        self._order = interpolation_order
+        self._exposure_offsets = jnp.asarray(exposure_offsets)
+
+        self.nx, self.ny = lens_image.Grid.num_pixel_axes
+        self._supersampling_factor = lens_image.ImageNumerics.grid_supersampling_factor
+        self._pixel_area = lens_image.Grid.pixel_area
+        # linear mapping from angular offsets to offsets in units of supersampled pixels
+        self._coord2subpix = self._supersampling_factor * np.linalg.inv(lens_image.Grid.transform_pix2angle)
+        pixel_width = lens_image.Grid.pixel_width
+        self._conv = BatchedPixelKernelConvolution(
+            [self._pixel_kernel(psf, pixel_width) for psf in psf_list], (self.ny, self.nx),
+        )
+
+    @staticmethod
+    def _pixel_kernel(psf, pixel_width):
+        """Pixelated kernel of a PSF, sampled at the pixel size of the exposures."""
+        if psf.psf_type in ('PIXEL', 'NONE'):
+            return psf.kernel_point_source
+        elif psf.psf_type == 'GAUSSIAN':
+            # same size as the kernel computed by PSF, but at the pixel size of the exposures
+            npix = int(round(psf._truncation * psf.fwhm / pixel_width))
+            npix += 1 - npix % 2
+            return kernel_util.kernel_gaussian(npix, pixel_width, psf.fwhm)
+        raise ValueError(f"PSF type '{psf.psf_type}' is not supported by LensImageStack.")
+
+    @property
+    def exposure_offsets(self):
+        """Offsets (in arcsec) of the pixel grid of each exposure."""
+        return self._exposure_offsets
+
+    @partial(jit, static_argnums=(0, 4, 5, 6, 7, 8, 9))
+    def model(self, kwargs_lens=None, kwargs_source=None, kwargs_lens_light=None,
+              unconvolved=False, source_add=True, lens_light_add=True,
+              k_lens=None, k_source=None, k_lens_light=None,
+              exposure_offsets=None):
+        """
+        Create the stack of model images from parameter values.
+        Note: due to JIT compilation, the first call to this method will be slower.
+
+        :param kwargs_lens: list of keyword arguments corresponding to the superposition of different lens profiles
+        :param kwargs_source: list of keyword arguments corresponding to the superposition of different source light profiles
+        :param kwargs_lens_light: list of keyword arguments corresponding to different lens light surface brightness profiles
+        :param unconvolved: if True: returns the unconvolved light distribution (prefect seeing)
+        :param source_add: if True, compute source, otherwise without
+        :param lens_light_add: if True, compute lens light, otherwise without
+        :param k_lens: list of bool or list of int to select which lens mass profiles to include
+        :param k_source: list of bool or list of int to select which source profiles to include
+        :param k_lens_light: list of bool or list of int to select which lens light profiles to include
+        :param exposure_offsets: array of shape (num_exposures, 2) to override the offsets given at initialization
+        (e.g., to optimize them)
+        :return: 3d array of shape (num_exposures, nx, ny) of surface brightness pixels
+        """
+        flux_super = self.lens_image.model(
+            kwargs_lens=kwargs_lens, kwargs_source=kwargs_source, kwargs_lens_light=kwargs_lens_light,
+            supersampled=True, source_add=source_add, lens_light_add=lens_light_add,
+            point_source_add=False, k_lens=k_lens, k_source=k_source, k_lens_light=k_lens_light,
+        )
+        if exposure_offsets is None:
+            exposure_offsets = self._exposure_offsets
+        image_stack = self.resample(flux_super, exposure_offsets)
+        if not unconvolved:
+            image_stack = self._conv.convolution2d(image_stack)
+        return image_stack * self._pixel_area
+
+    def resample(self, flux_super, exposure_offsets):
+        """
+        Resample the supersampled flux onto the (low resolution) pixel grid of each exposure.
+
+        :param flux_super: 1d array of flux values evaluated on the supersampled grid of the reference LensImage
+        :param exposure_offsets: array of shape (num_exposures, 2) of exposure offsets in arcsec
+        :return: 3d array of shape (num_exposures, nx, ny) of pixel-averaged fluxes
+        """
+        s = self._supersampling_factor
+        image_super = flux_super.reshape(self.ny * s, self.nx * s)
+        rows, cols = jnp.meshgrid(jnp.arange(self.ny * s), jnp.arange(self.nx * s), indexing='ij')
+        # offsets in units of supersampled pixels, along columns (x) and rows (y)
+        shifts = jnp.asarray(exposure_offsets) @ self._coord2subpix.T
+
+        def _shift(shift):
+            return map_coordinates(image_super, [rows + shift[1], cols + shift[0]],
+                                   order=self._order, mode='nearest')
+
+        image_super_stack = jax.vmap(_shift)(shifts)
+        return image_super_stack.reshape(self.num_exposures, self.ny, s, self.nx, s).mean(axis=(2, 4))
+
+    def simulation(self, prng_key, add_poisson_noise=True, add_background_noise=True, **model_kwargs):
+        """
+        Simulate the stack of exposures with independent noise realisations.
+
+        :param prng_key: JAX PRNG key
+        :return: 3d array of shape (num_exposures, nx, ny)
+        """
+        model = self.model(**model_kwargs)
+        keys = jax.random.split(prng_key, self.num_exposures)
+        simu = []
+        for i, noise in enumerate(self.noise_list):
+            simu.append(model[i] + noise.realisation(
+                model[i], keys[i],
+                add_poisson_model=add_poisson_noise,
+                add_background=add_background_noise,
+            ))
+        return jnp.stack(simu, axis=0)
+
+    def C_D_model(self, model):
+        """Noise variance of each exposure, given the stack of model images."""
+        return jnp.stack([noise.C_D_model(model[i]) for i, noise in enumerate(self.noise_list)], axis=0)
+
+    def log_likelihood(self, data, model, mask=None):
+        """
+        Gaussian log-likelihood of the stack of exposures, summed over all exposures.
+
+        :param data: 3d array of shape (num_exposures, nx, ny) of observed exposures
+        :param model: 3d array of shape (num_exposures, nx, ny) of model exposures
+        :param mask: optional 2d or 3d array of 1s (pixels included) and 0s (pixels excluded)
+        :return: scalar log-likelihood
+        """
+        if mask is None:
+            mask = jnp.ones_like(data)
+        noise_var = self.C_D_model(model)
+        log_like = - 0.5 * ((data - model)**2 / noise_var + jnp.log(2. * np.pi * noise_var))
+        return jnp.sum(log_like * mask)
+
+    def reduced_chi2(self, data, model, mask=None):
+        """
+        compute the reduced chi2 of the stack of exposures given the model
+        """
+        if mask is None:
+            mask = jnp.ones_like(data)
+        mask = jnp.broadcast_to(mask, data.shape)
+        noise_var = self.C_D_model(model)
+        chi2 = jnp.sum((data - model)**2 / noise_var * mask)
+        return chi2 / jnp.sum(mask)
@@ -76,6 +76,15 @@ class LensingOperator(object):
     def lensing_transpose(self, image):
         return self.image2source_2d(image)
 
+    @partial(jit, static_argnums=(0,))
+    def lensing_transpose_variance(self, image_var):
+        """propagates a map of independent pixel variances through lensing_transpose(), 
+        i.e. applies the element-wise squared transposed mapping"""
+        image_var_1d = self.ImagePlane.extract(util.image2array(image_var))
+        mapping_sq = jsparse.BCOO((self._mapping.data**2, self._mapping.indices), shape=self._mapping.shape)
+        source_var = (mapping_sq.T @ image_var_1d) / self._norm_image2source**2
+        return util.array2image(source_var)
+
     @property
     def source_plane_coordinates(self):
         return self.SourcePlane.theta_x, self.SourcePlane.theta_y
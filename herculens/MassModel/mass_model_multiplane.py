@@ -12,8 +12,30 @@ from functools import partial
 from herculens.MassModel.mass_model import MassModel
 
 
+def alpha_plane_stacked(x, y, alpha_func):
+    # deflection angles as a single array, such that all planes return the same
+    # structure (as required by jax.lax.switch)
+    return jnp.stack(alpha_func(x, y))
+
+
+def alpha_plane_for_scan(
+        x, y,
+        etas,
+        alpha_list,
+        alphas,
+        j
+    ):
+    # positions on plane j, given the deflections of all planes in front of it
+    # (deflections of planes j and beyond are still zero, as are the etas)
+    x_j = x - jnp.tensordot(etas[:, j], alphas[0], axes=1)
+    y_j = y - jnp.tensordot(etas[:, j], alphas[1], axes=1)
+    alpha_j = jax.lax.switch(j, alpha_list, x_j, y_j)
+    alphas = alphas.at[:, j].set(alpha_j)
+    return alphas, None
+
+
 class MPMassModel(object):
-    def __init__(self, mp_mass_model_list, **mass_model_kwargs):
+    def __init__(self, mp_mass_model_list, scan_planes=False, **mass_model_kwargs):
         '''
         Create a MPMassModel object.
 
@@ -23,6 +45,12 @@ class MPMassModel(object):
             List of lists containing Lens model profiles for each plane of
             the lens system. One inner list per plane with the outer list
             sorted by distance from observer.
+        scan_planes : bool, optional
+            If True, uses jax.lax.scan to iterate the lens equation over the mass
+            planes, which avoids unrolling the loop over planes and may speed up
+            compilation for systems with 3 or more planes, by default False.
+            NOTE: the number of operations and the memory usage are the same as 
+            with the unrolled loop.
         mass_model_kwargs : dictionary for settings related to PIXELATED
             profiles.
         '''
@@ -42,6 +70,7 @@ class MPMassModel(object):
                 "MPMassModel needs to be initialized either with a list of lists of strings, "
                 "or directly with a list of (single plane) MassModel instances.")
         self.number_mass_planes = len(self.mass_models)
+        self._scan_planes = scan_planes
         
         # Eta will be passed in flattened to `ray_shooting`, use these
         # index values to un-flatten it back into an array
@@ -93,6 +122,8 @@ class MPMassModel(object):
             N = self.number_mass_planes
         if k is None:
             k = [None] * N
+        if self._scan_planes:
+            return self._ray_shooting_scan(x, y, eta_flat, kwargs, N, k)
         # un-flatten eta_flat into full eta array
         etas_t = self.base_eta.at[self.eta_idx].set(eta_flat)[:-1, :(N + 1)].T
 
@@ -102,35 +133,128 @@ class MPMassModel(object):
 
         # iterate the lensing equation for each mass plane
         for j in range(N):
-            dx, dy = self.mass_models[j].alpha(
-                xs[j],
-                ys[j],
-                kwargs=kwargs[j],
-                k=k[j]
-            )
-            etas_j = etas_t[:, j:j + 1]
-            xs = xs - etas_j * dx
-            ys = ys - etas_j * dy
+            xs, ys = self._deflect_from_plane(xs, ys, etas_t, kwargs, k, j)
         return xs, ys
 
-    def _ray_shooting_slice(self, x, y, eta_flat, kwargs):
-        '''Helper function that give *scaler* inputs of x and y give a *vector*
-        output for each mass plane. Used for the vectorization of the `A` method'''
-        return jnp.stack(
-            self.ray_shooting(jnp.array([x]), jnp.array([y]), eta_flat, kwargs)
-        ).T.squeeze()
+    @partial(jax.jit, static_argnums=(0, 5, 6))
+    def ray_shooting_from_plane(self, xs, ys, eta_flat, kwargs, start, k=None):
+        '''Continues the ray tracing from a given mass plane onward, starting from
+        positions that already include the deflections of all planes in front of it.
+        This allows to re-use the ray tracing through front planes whose parameters
+        are kept fixed (see `MPLensImage.model_incremental`).
+
+        Parameters
+        ----------
+        xs : jax.numpy array
+            x-positions on each plane (including the image plane) with shape
+            (N+1, *(x.shape)), that include the deflections of planes 0 to `start`-1.
+            For `start=0`, these are the image plane positions repeated N+1 times.
+        ys : jax.numpy array
+            y-positions on each plane, same format as `xs`
+        eta_flat : jax.numpy array
+            upper triangular elements of eta matrix (see `ray_shooting`)
+        kwargs: list of list
+            List of lists of parameter dictionaries of lens mass model parameters
+            corresponding to each mass plane.
+        start : int
+            index of the first mass plane to ray trace through
+        k : list of list, optional
+            only evaluate the k-th lens model (list of list of index values) for a particular
+            plane, by default None
+
+        Returns
+        -------
+        xs_steps : jax.numpy array
+            x-positions on each plane after having added the deflection of each
+            mass plane from `start` onward, with shape (N-start, N+1, *(x.shape)).
+            The last element corresponds to the output of `ray_shooting`.
+        ys_steps : jax.numpy array
+            y-positions on each plane, same format as `xs_steps`
+        '''
+        N = self.number_mass_planes
+        if k is None:
+            k = [None] * N
+        etas_t = self.base_eta.at[self.eta_idx].set(eta_flat)[:-1, :(N + 1)].T
+        xs_steps, ys_steps = [], []
+        for j in range(start, N):
+            xs, ys = self._deflect_from_plane(xs, ys, etas_t, kwargs, k, j)
+            xs_steps.append(xs)
+            ys_steps.append(ys)
+        return jnp.stack(xs_steps), jnp.stack(ys_steps)
+
+    def _deflect_from_plane(self, xs, ys, etas_t, kwargs, k, j):
+        '''Adds the deflection of the j-th mass plane to the positions on all planes.'''
+        dx, dy = self.mass_models[j].alpha(
+            xs[j],
+            ys[j],
+            kwargs=kwargs[j],
+            k=k[j]
+        )
+        etas_j = etas_t[:, j:j + 1]
+        return xs - etas_j * dx, ys - etas_j * dy
+
+    def _ray_shooting_scan(self, x, y, eta_flat, kwargs, N, k):
+        '''Same as `ray_shooting` but iterating over the mass planes with
+        jax.lax.scan, such that the deflection of each plane is compiled only once.
+        The deflection angles of all planes are carried through the iterations, and the 
+        positions on each plane are obtained by contracting them with the corresponding 
+        column of the eta matrix. Since the eta matrix is arbitrary (it is a free parameter), 
+        the position on a plane depends on the deflections of all planes in front of it, 
+        such that the cost remains O(N^2) for N planes, as with the unrolled loop.'''
+        etas = self.base_eta.at[self.eta_idx].set(eta_flat)[:N, :(N + 1)]
+        x, y = jnp.broadcast_arrays(jnp.asarray(x), jnp.asarray(y))
+
+        # list of deflection functions (one per plane) with keywords filled in
+        alpha_list = [
+            partial(
+                alpha_plane_stacked,
+                alpha_func=partial(
+                    self.mass_models[j].alpha,
+                    kwargs=kwargs[j],
+                    k=k[j]
+                )
+            ) for j in range(N)
+        ]
+        # recursive function with keywords filled in
+        partial_alpha = partial(
+            alpha_plane_for_scan,
+            x, y,
+            etas,
+            alpha_list
+        )
 
-    def _A_stack(self, x, y, eta_flat, kwargs, kind='auto'):
+        # deflection angles of each plane, shape (2, N, *x.shape)
+        alphas = jnp.zeros((2, N) + x.shape, dtype=jnp.result_type(x, float))
+        alphas, _ = jax.lax.scan(partial_alpha, alphas, jnp.arange(N))
+
+        # positions on all planes (including the last one)
+        xs = x - jnp.tensordot(etas.T, alphas[0], axes=1)
+        ys = y - jnp.tensordot(etas.T, alphas[1], axes=1)
+        return xs, ys
+
+    def _A_batched(self, x, y, eta_flat, kwargs):
+        '''Helper function that computes the jacobian of the ray shooting for all
+        positions at once. Since each position is ray-traced independently of the 
+        others, the full jacobian is obtained with two forward-mode passes (JVPs) 
+        over the full input arrays, instead of one per position.'''
+        x, y = jnp.broadcast_arrays(jnp.asarray(x, dtype=float), jnp.asarray(y, dtype=float))
+        shape = x.shape
+
+        def ray_shooting_stack(x_, y_):
+            return jnp.stack(self.ray_shooting(x_, y_, eta_flat, kwargs), axis=-1)
+
+        x, y = x.ravel(), y.ravel()
+        ones, zeros = jnp.ones_like(x), jnp.zeros_like(x)
+        _, d_dx = jax.jvp(ray_shooting_stack, (x, y), (ones, zeros))
+        _, d_dy = jax.jvp(ray_shooting_stack, (x, y), (zeros, ones))
+        # same convention as `_A_stack`, shape (N+1, *x.shape, 2, 2)
+        A = jnp.stack([d_dx, d_dy], axis=-2)
+        return A.reshape((A.shape[0],) + shape + (2, 2))
+
+    def _A_stack(self, x, y, eta_flat, kwargs, kind='direct'):
         '''Helper function that takes the jacobian of the ray shooting give *scaler*
         inputs for x and y and returns a 2x2 array.'''
-        if kind == 'auto':
-            return jnp.stack(
-                jax.jacfwd(
-                    self._ray_shooting_slice,
-                    argnums=(0, 1)
-                )(x, y, eta_flat, kwargs)
-            )
-        elif kind == 'direct':
+        if kind == 'direct':
             N = self.number_mass_planes
             A = jnp.kron(jnp.eye(2), jnp.ones((N + 1, 1))).reshape(2, N + 1, 2)
             xs, ys = self.ray_shooting(jnp.array([x]), jnp.array([y]), eta_flat, kwargs)
@@ -169,8 +293,8 @@ class MPMassModel(object):
             corresponding to each mass plane.
         kind : str, optional
             either "auto" or "direct". Determines how the distortion matrix is
-            computed, "auto" will using automatic differentiation using using JAX's
-            `jaxfwd` function. "direct" will using the `hessian` method for each
+            computed, "auto" will using automatic differentiation using JAX's
+            forward-mode (batched over all positions). "direct" will using the `hessian` method for each
             mass plane. "auto" is typically faster and is the default and recommended
             method.
 
@@ -181,6 +305,10 @@ class MPMassModel(object):
             and each mass plane (including the image plane) with shape
             (N+1, *(x.shape), 2, 2) where N is the number of mass planes.
         '''
+        if kind == 'auto':
+            return self._A_batched(x, y, eta_flat, kwargs)
+        elif kind != 'direct':
+            raise ValueError(f"Unknown kind '{kind}' (must be 'auto' or 'direct').")
         A_stack_part = partial(
             self._A_stack,
             eta_flat=eta_flat,
@@ -214,8 +342,8 @@ class MPMassModel(object):
             corresponding to each mass plane.
         kind : str, optional
             either "auto" or "direct". Determines how the distortion matrix is
-            computed, "auto" will using automatic differentiation using using JAX's
-            `jaxfwd` function. "direct" will using the `hessian` method for each
+            computed, "auto" will using automatic differentiation using JAX's
+            forward-mode (batched over all positions). "direct" will using the `hessian` method for each
             mass plane. "auto" is typically faster and is the default and recommended
             method.
 
@@ -251,8 +379,8 @@ class MPMassModel(object):
             corresponding to each mass plane.
         kind : str, optional
             either "auto" or "direct". Determines how the distortion matrix is
-            computed, "auto" will using automatic differentiation using using JAX's
-            `jaxfwd` function. "direct" will using the `hessian` method for each
+            computed, "auto" will using automatic differentiation using JAX's
+            forward-mode (batched over all positions). "direct" will using the `hessian` method for each
             mass plane. "auto" is typically faster and is the default and recommended
             method.
 
@@ -288,8 +416,8 @@ class MPMassModel(object):
             corresponding to each mass plane.
         kind : str, optional
             either "auto" or "direct". Determines how the distortion matrix is
-            computed, "auto" will using automatic differentiation using using JAX's
-            `jaxfwd` function. "direct" will using the `hessian` method for each
+            computed, "auto" will using automatic differentiation using JAX's
+            forward-mode (batched over all positions). "direct" will using the `hessian` method for each
             mass plane. "auto" is typically faster and is the default and recommended
             method.
 
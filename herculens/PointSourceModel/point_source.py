@@ -3,7 +3,6 @@
 __author__ = 'austinpeel'
 
 import functools
-import numpy as np
 import jax.numpy as jnp
 
 try:
@@ -27,6 +26,10 @@ class PointSource(object):
 
     """
 
+    # images closer than this factor times the lens equation solver accuracy
+    # are considered as duplicates of each other
+    _duplicate_tolerance_factor = 3.
+
     def __init__(self, point_source_type, mass_model, image_plane):
         """Instantiate a point source.
 
@@ -58,7 +61,8 @@ class PointSource(object):
 
     def image_positions_and_amplitudes(self, kwargs_point_source, 
                                        kwargs_lens=None, kwargs_solver=None,
-                                       zero_amp_duplicates=True, re_compute=False):
+                                       zero_amp_duplicates=True, re_compute=False,
+                                       duplicate_tolerance=None):
         """Compute image plane positions and corresponding amplitudes
         of the point source, optionally "turning-off" (zeroing their amplitude)
         potentially duplicated images predicted by the lens equation solver.
@@ -72,13 +76,18 @@ class PointSource(object):
         kwargs_solver : dict, optional
             Keyword arguments for the lens equation solver. Default is None.
         zero_amp_duplicates : bool, optional
-            If True, amplitude of duplicated images are forced to be zero.
-            Note that it may affect point source ordering!.
-            Default is True.
+            If True, amplitude of duplicated images are (smoothly) forced to be zero
+            (see `_zero_amp_duplicated_images()`). Default is True.
         re_compute : bool, optional
             If True, re-compute (solving the lens equation) image positions,
             even for point source models of type 'IMAGE_POSITIONS'.
             Default is False.
+        duplicate_tolerance : float, optional
+            Distance (in arcsec) below which two images are considered duplicates.
+            Genuine images closer than about 1.5 times this distance are damped.
+            If None, the value of `kwargs_solver['duplicate_tolerance']` is used if present,
+            otherwise it is estimated from the accuracy of the lens equation solver.
+            Default is None.
         
         Return
         ------
@@ -94,8 +103,10 @@ class PointSource(object):
             theta_x, theta_y, kwargs_point_source, kwargs_lens=kwargs_lens,
         )
         if zero_amp_duplicates and self.type == 'SOURCE_POSITION':
+            if duplicate_tolerance is None and kwargs_solver is not None:
+                duplicate_tolerance = kwargs_solver.get('duplicate_tolerance', None)
             amp, theta_x, theta_y = self._zero_amp_duplicated_images(
-                amp, theta_x, theta_y, kwargs_solver,
+                amp, theta_x, theta_y, kwargs_solver, tolerance=duplicate_tolerance,
             )
         return theta_x, theta_y, amp
 
@@ -125,6 +136,9 @@ class PointSource(object):
             beta = jnp.array([beta_x, beta_y])
             if kwargs_solver is None:
                 kwargs_solver = {}  # fall back to default lens equation solver settings
+            # not a setting of the solver itself (see image_positions_and_amplitudes())
+            kwargs_solver = {key: value for key, value in kwargs_solver.items() 
+                             if key != 'duplicate_tolerance'}
             theta, beta = self.solver.solve(
                 beta, kwargs_lens, **kwargs_solver,
             )
@@ -228,12 +242,27 @@ class PointSource(object):
         error_source = self.error_source_plane(kwargs_point_source, kwargs_lens)
         return - jnp.sum((error_source / sigma_source)**2)
 
-    def _zero_amp_duplicated_images(self, amp_in, theta_x_in, theta_y_in, kwargs_solver):
+    def _zero_amp_duplicated_images(self, amp_in, theta_x_in, theta_y_in, kwargs_solver,
+                                    tolerance=None):
         """This function takes as input the list of multiply lensed images 
-        (amplitudes and positions) and assign zero amplitude to any image 
-        that have a x coordinate equal to up to `decimals` decimals.
-
-        WARNING: this function may change the original ordering of images!
+        (amplitudes and positions) and smoothly assigns zero amplitude to any 
+        image that lies within a given tolerance of another image appearing 
+        earlier in the list.
+
+        The duplicates are found from the (fixed-size) matrix of pairwise 
+        distances d between images, such that the operation is fully jittable. 
+        The amplitude of each image is multiplied by 1 - exp(-(d / tolerance)**4) 
+        for each image appearing earlier in the list, which avoids discontinuities 
+        in the likelihood (e.g. during HMC sampling) when images start or stop 
+        being considered as duplicates. As a consequence, genuine images that are 
+        close to each other are damped as well: by a factor 0.63 at a distance 
+        equal to the tolerance, 0.994 at 1.5 times the tolerance, and by less than 
+        1e-6 beyond twice the tolerance. The tolerance should thus be smaller than 
+        half the separation of the closest genuine images.
+
+        The positions are returned in the same order as the input, i.e. as given 
+        by the lens equation solver. Which copy of a duplicated image is kept 
+        (the first one) thus depends on that order.
 
         Parameters
         ----------
@@ -245,35 +274,42 @@ class PointSource(object):
             Y position of point sources in the image plane.
         kwargs_solver : dict
             Keyword arguments for the LensEquation solver, used to estimate the
-            accuracy of point source positions and use it to find duplicated images. 
+            accuracy of point source positions if `tolerance` is None. 
+        tolerance : float, optional
+            Distance (in arcsec) below which two images are considered duplicates.
+            By default, a few times the estimated accuracy of the lens equation solver.
 
         Returns
         -------
         amp_out, theta_x_out, theta_y_out : tuple of 3 1D arrays
             Amplitudes (potentially some being zero-ed) and positions in image plane.
         """
-        # TODO: find a way not to change the image ordering (might be slower though).
-        num_images = kwargs_solver['nsolutions']
+        if tolerance is None:
+            tolerance = self._duplicate_tolerance(kwargs_solver)
+        # pairwise distances between images (squared and normalized)
+        delta_x = theta_x_in[:, None] - theta_x_in[None, :]
+        delta_y = theta_y_in[:, None] - theta_y_in[None, :]
+        dist2 = (delta_x**2 + delta_y**2) / tolerance**2
+        # smooth indicator (~1 when closer than the tolerance) of image j being 
+        # a copy of image i, only for i < j so the first occurrence is kept
+        is_copy = jnp.triu(jnp.exp(- dist2**2), k=1)
+        weights = jnp.prod(1. - is_copy, axis=0)
+        amp_out = amp_in * weights
+        return amp_out, theta_x_in, theta_y_in
+
+    def _duplicate_tolerance(self, kwargs_solver):
+        """Distance below which two predicted images are considered the same,
+        based on the estimated accuracy of the lens equation solver."""
+        kwargs_accuracy = {'niter': 5, 'scale_factor': 2, 'nsubdivisions': 1}  # solver defaults
+        if kwargs_solver is not None:
+            kwargs_accuracy.update({key: kwargs_solver[key] for key in kwargs_accuracy 
+                                    if key in kwargs_solver})
         position_accuracy = self.solver.estimate_accuracy(
-            kwargs_solver['niter'], 
-            kwargs_solver['scale_factor'], 
-            kwargs_solver['nsubdivisions'], 
-        )
-        # TODO: the following choice for truncation the digits may not be general enough!
-        position_decimals = np.floor(- np.log10(position_accuracy)).astype(int) - 1
-        unique_theta_x, unique_indices = jnp.unique(
-            jnp.round(theta_x_in, decimals=position_decimals),  # TODO: issue when original value close to zero -> rounded to exactly zero!
-            return_index=True, 
-            fill_value=False,   # effectively zero
-            size=num_images,
+            kwargs_accuracy['niter'], 
+            kwargs_accuracy['scale_factor'], 
+            kwargs_accuracy['nsubdivisions'], 
         )
-        condition = jnp.where(unique_theta_x, True, False)
-        unique_amp = amp_in[unique_indices]  # order amplitudes as the positions
-        zero_amp = 1e-20  # not exactly 0 to avoid problems with autodiff gradients
-        amp_out = jnp.where(condition, unique_amp, jnp.full(num_images, zero_amp))
-        theta_x_out = theta_x_in[unique_indices]
-        theta_y_out = theta_y_in[unique_indices]
-        return amp_out, theta_x_out, theta_y_out
+        return self._duplicate_tolerance_factor * position_accuracy
 
     def _check_solver_install(self, feature):
         if not _solver_installed:
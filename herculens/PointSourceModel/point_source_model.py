@@ -48,7 +48,7 @@ class PointSourceModel(object):
 
     def get_multiple_images(self, kwargs_point_source, kwargs_lens=None,
                             kwargs_solver=None, k=None, with_amplitude=True,
-                            zero_amp_duplicates=True, re_compute=False):
+                            zero_amp_duplicates=True, re_compute=False, duplicate_tolerance=None):
         """Compute point source positions and amplitudes in the image plane.
 
         For point sources defined in the source plane, solving the lens
@@ -70,13 +70,18 @@ class PointSourceModel(object):
             Whether to return the (magnified) amplitude of each point source.
             Default is True.
         zero_amp_duplicates : bool, optional
-            If True, amplitude of duplicated images are forced to be zero.
-            Note that it may affect point source ordering!.
-            Default is True.
+            If True, amplitude of duplicated images are (smoothly) forced to be zero
+            (see `PointSource._zero_amp_duplicated_images()`). Default is True.
         re_compute : bool, optional
             If True, re-compute (solving the lens equation) image positions,
             even for point source models of type 'IMAGE_POSITIONS'.
             Default is False.
+        duplicate_tolerance : float, optional
+            Distance (in arcsec) below which two images are considered duplicates.
+            Genuine images closer than about 1.5 times this distance are damped.
+            If None, the value of `kwargs_solver['duplicate_tolerance']` is used if present,
+            otherwise it is estimated from the accuracy of the lens equation solver.
+            Default is None.
 
         Returns
         -------
@@ -90,7 +95,8 @@ class PointSourceModel(object):
             ps = self.point_sources[i]
             ra, dec, amp = ps.image_positions_and_amplitudes(
                 kwargs_point_source[i], kwargs_lens=kwargs_lens, kwargs_solver=kwargs_solver,
-                zero_amp_duplicates=zero_amp_duplicates, re_compute=re_compute,
+                zero_amp_duplicates=zero_amp_duplicates, duplicate_tolerance=duplicate_tolerance,
+                re_compute=re_compute,
             )
             theta_x.append(ra)
             theta_y.append(dec)
@@ -6,6 +6,9 @@
 __author__ = 'aymgal'
 
 
+import copy
+import numpy as np
+import jax
 import jax.numpy as jnp
 
 from herculens.RegulModel.Methods.base import BaseRegularization
@@ -31,8 +34,17 @@ class BaseSparsityWaveletAnalysis(BaseRegularization):
         self.weights = None
         self._transform_name = None
         self._second_gen = None
+        self._cache = None
 
     def initialize(self, lens_image, kwargs_params, **kwargs_weights):
+        """
+        Computes the regularization weights by propagating the data noise to the wavelet coefficients
+        (see regul_util). The weights are always recomputed; use update() to reuse them when possible.
+
+        :param lens_image: LensImage instance
+        :param kwargs_params: model parameters
+        :param kwargs_weights: keyword arguments passed to the noise propagation function
+        """
         if self.model_type in ('source', 'lens_light'):
             fn = regul_util.data_noise_to_wavelet_light
         elif self.model_type == 'lens_mass' and self._mass_form == 'potential':
@@ -47,6 +59,39 @@ class BaseSparsityWaveletAnalysis(BaseRegularization):
                                           **kwargs_weights)
         self.transform = transform_list[0]
         self.weights = weights_list[0]
+        self._cache = (lens_image, _noise_state(lens_image), copy.deepcopy(kwargs_params), 
+                       copy.deepcopy(kwargs_weights))
+
+    def update(self, lens_image, kwargs_params, cache_tolerance=0., **kwargs_weights):
+        """
+        Updates the weights, e.g. during an optimization. The weights computed by the last call 
+        to initialize() or update() are reused if none of the inputs of the noise propagation has changed, 
+        i.e. the LensImage instance and the state of its noise model, the settings, and all model 
+        parameters (which determine the model image, hence the noise variance), up to an absolute 
+        difference of `cache_tolerance` for any parameter value.
+
+        :param lens_image: LensImage instance
+        :param kwargs_params: model parameters
+        :param cache_tolerance: tolerance on the model parameters for reusing the cached weights
+        :param kwargs_weights: keyword arguments passed to the noise propagation function
+        """
+        if not self._cache_is_valid(lens_image, kwargs_params, cache_tolerance, kwargs_weights):
+            self.initialize(lens_image, kwargs_params, **kwargs_weights)
+
+    def _cache_is_valid(self, lens_image, kwargs_params, tolerance, kwargs_weights):
+        if self._cache is None:
+            return False
+        lens_image_cache, noise_state_cache, kwargs_params_cache, kwargs_weights_cache = self._cache
+        if lens_image is not lens_image_cache or not _settings_equal(kwargs_weights, kwargs_weights_cache):
+            return False
+        if not _settings_equal(_noise_state(lens_image), noise_state_cache):
+            return False
+        if jax.tree_util.tree_structure(kwargs_params) != jax.tree_util.tree_structure(kwargs_params_cache):
+            return False
+        within_tol = jax.tree_util.tree_map(
+            lambda p, p_cache: bool(np.all(np.abs(np.asarray(p) - np.asarray(p_cache)) <= tolerance)),
+            kwargs_params, kwargs_params_cache)
+        return all(jax.tree_util.tree_leaves(within_tol))
 
 
 class SparsityStarlet(BaseSparsityWaveletAnalysis):
@@ -99,3 +144,28 @@ class SparsityBLWavelet(BaseSparsityWaveletAnalysis):
         l1_weighted_coeffs0 = jnp.sum(jnp.abs(W[0] * coeffs[0]))
         log_prob = - lambda_0 * l1_weighted_coeffs0
         return log_prob
+
+
+def _noise_state(lens_image):
+    """Copy of the attributes of the noise model that determine the data variance."""
+    noise = lens_image.Noise
+    if noise is None:
+        return {}
+    return {
+        'noise_map': copy.deepcopy(noise._noise_map),
+        'background_rms': noise._background_rms,
+        'exposure_map': copy.deepcopy(noise._exp_map),
+        'boost_map': copy.deepcopy(noise.global_boost_map),
+    }
+
+
+def _settings_equal(kwargs_1, kwargs_2):
+    if kwargs_1.keys() != kwargs_2.keys():
+        return False
+    for key, value in kwargs_1.items():
+        if isinstance(value, (np.ndarray, jnp.ndarray)) or isinstance(kwargs_2[key], (np.ndarray, jnp.ndarray)):
+            if not np.array_equal(value, kwargs_2[key]):
+                return False
+        elif value != kwargs_2[key]:
+            return False
+    return True
@@ -0,0 +1,135 @@
+# Finite-difference operators for the regularization of pixelated models
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+import numpy as np
+from functools import partial
+import jax
+import jax.numpy as jnp
+from jax import jit
+from jax.experimental import sparse as jsparse
+
+
+__all__ = ['DifferentialOperator']
+
+
+# 3x3 stencils, for arrays indexed as [y, x], in units of the pixel size
+_STENCILS = {
+    'gradient_x': np.array([[0., 0., 0.], [-0.5, 0., 0.5], [0., 0., 0.]]),
+    'gradient_y': np.array([[0., -0.5, 0.], [0., 0., 0.], [0., 0.5, 0.]]),
+    'laplacian': np.array([[0., 1., 0.], [1., -4., 1.], [0., 1., 0.]]),
+    'hessian_xx': np.array([[0., 0., 0.], [1., -2., 1.], [0., 0., 0.]]),
+    'hessian_yy': np.array([[0., 1., 0.], [0., -2., 0.], [0., 1., 0.]]),
+    # including a factor sqrt(2), such that the sum of squares is the Frobenius norm of the Hessian
+    'hessian_xy': np.sqrt(2.) * np.array([[0.25, 0., -0.25], [0., 0., 0.], [-0.25, 0., 0.25]]),
+}
+
+_KINDS = {
+    'gradient': (['gradient_x', 'gradient_y'], 1),
+    'curvature': (['laplacian'], 2),
+    'hessian': (['hessian_xx', 'hessian_yy', 'hessian_xy'], 2),
+}
+
+
+class DifferentialOperator(object):
+    """
+    Linear finite-difference operator D acting on a regular grid of pixels (e.g. of a pixelated source
+    or a pixelated potential), applied as 3x3 convolution stencils. Typical regularization terms are
+    quadratic forms 0.5 * ||D p||^2, for which this class provides the value, the gradient D^T D p,
+    and the diagonal of the Hessian D^T D, e.g. to precondition linear solvers.
+    Everything is written in JAX, such that operators can be built within jitted functions.
+
+    Supported kinds of operators are:
+    - 'gradient': first derivatives along x and y (central differences);
+    - 'curvature': Laplacian (e.g. Suyu et al. 2006);
+    - 'hessian': second derivatives xx, yy and (sqrt(2) times) xy, such that ||D p||^2 is
+    the squared Frobenius norm of the Hessian summed over pixels.
+
+    :param shape: shape (ny, nx) of the grid of pixels
+    :param kind: 'gradient', 'curvature' or 'hessian'
+    :param pixel_size: size of the pixels, to get derivatives in proper units
+    :param boundary: 'valid' to only consider pixels whose stencil is entirely contained in the grid,
+    or 'zero' to assume that the pixels outside of the grid are zero
+    """
+
+    def __init__(self, shape, kind='curvature', pixel_size=1., boundary='valid'):
+        if kind not in _KINDS:
+            raise ValueError(f"Operator kind '{kind}' is not supported (choose from {list(_KINDS.keys())}).")
+        if boundary not in ('valid', 'zero'):
+            raise ValueError(f"Boundary '{boundary}' is not supported ('valid' or 'zero' only).")
+        self.shape = tuple(shape)
+        self.kind = kind
+        self.boundary = boundary
+        names, order = _KINDS[kind]
+        self.stencils = jnp.array([_STENCILS[name] for name in names]) / pixel_size**order
+        self._mode = 'valid' if boundary == 'valid' else 'same'
+
+    @classmethod
+    def from_pixel_grid(cls, pixel_grid, kind='curvature', boundary='valid'):
+        """Operator for the pixels of a PixelGrid (e.g. lens_image.MassModel.pixel_grid)."""
+        x_grid, _ = pixel_grid.pixel_coordinates
+        return cls(x_grid.shape, kind=kind, pixel_size=pixel_grid.pixel_width, boundary=boundary)
+
+    @property
+    def num_components(self):
+        return self.stencils.shape[0]
+
+    @property
+    def output_shape(self):
+        ny, nx = self.shape
+        if self.boundary == 'valid':
+            return (self.num_components, ny - 2, nx - 2)
+        return (self.num_components, ny, nx)
+
+    @partial(jit, static_argnums=(0,))
+    def apply(self, pixels):
+        """D p, of shape (num_components, ...)"""
+        return jax.vmap(lambda s: jax.scipy.signal.correlate(pixels, s, mode=self._mode))(self.stencils)
+
+    @partial(jit, static_argnums=(0,))
+    def transpose(self, coeffs):
+        """D^T c, for c of shape output_shape"""
+        return self._transpose(coeffs, self.stencils)
+
+    @partial(jit, static_argnums=(0,))
+    def quadratic_form(self, pixels):
+        """0.5 * ||D p||^2"""
+        return 0.5 * jnp.sum(self.apply(pixels)**2)
+
+    @partial(jit, static_argnums=(0,))
+    def quadratic_form_gradient(self, pixels):
+        """D^T D p, which is also the Hessian-vector product of the quadratic form"""
+        return self.transpose(self.apply(pixels))
+
+    @partial(jit, static_argnums=(0,))
+    def diagonal(self):
+        """diagonal of D^T D, i.e. sum_i D_ij^2, e.g. for Jacobi preconditioning"""
+        ones = jnp.ones((self.num_components,) + self.output_shape[1:])
+        return self._transpose(ones, self.stencils**2)
+
+    def _transpose(self, coeffs, stencils):
+        mode = 'full' if self.boundary == 'valid' else 'same'
+        return jnp.sum(jax.vmap(lambda c, s: jax.scipy.signal.convolve(c, s, mode=mode))(coeffs, stencils), axis=0)
+
+    def to_bcoo(self):
+        """D as a sparse BCOO matrix of shape (num_components * num_outputs, num_pixels),
+        acting on flattened pixels (entries outside of the grid are stored as explicit zeros)"""
+        ny, nx = self.shape
+        _, ny_out, nx_out = self.output_shape
+        offset = 1 if self.boundary == 'valid' else 0
+        iy, ix = jnp.meshgrid(jnp.arange(ny_out), jnp.arange(nx_out), indexing='ij')
+        data, rows, cols = [], [], []
+        for c in range(self.num_components):
+            for dy in range(3):
+                for dx in range(3):
+                    y, x = iy + offset + dy - 1, ix + offset + dx - 1
+                    inside = (y >= 0) & (y < ny) & (x >= 0) & (x < nx)
+                    data.append(jnp.where(inside, self.stencils[c, dy, dx], 0.).ravel())
+                    rows.append((c * ny_out * nx_out + iy * nx_out + ix).ravel())
+                    cols.append(jnp.where(inside, y * nx + x, 0).ravel())
+        indices = jnp.stack([jnp.concatenate(rows), jnp.concatenate(cols)], axis=1)
+        return jsparse.BCOO((jnp.concatenate(data), indices),
+                            shape=(self.num_components * ny_out * nx_out, ny * nx))
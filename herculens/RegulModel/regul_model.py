@@ -58,6 +58,16 @@ class RegularizationModel(object):
         for method in self.method_list:
             method.initialize(lens_image, kwargs_params, **kwargs)
 
+    def update_weights(self, lens_image, kwargs_params, cache_tolerance=0., **kwargs):
+        """
+        Updates the weights of the regularization methods, e.g. during an optimization.
+        Weights are only recomputed if the model parameters have changed by more than
+        `cache_tolerance`, or if the noise model or settings have changed, since they were 
+        last computed (see SparsityStarlet.update()). Use initialize() to always recompute them.
+        """
+        for method in self.method_list:
+            method.update(lens_image, kwargs_params, cache_tolerance=cache_tolerance, **kwargs)
+
     def log_prob(self, kwargs_params, kwargs_hyperparams):
         """
         Returns the log-probability term associated to regularization methods,
@@ -21,6 +21,10 @@ from herculens.Util import vkl_util
 
 
 
+# rough factor accounting for intermediate arrays when propagating a noise realization
+_MEMORY_OVERHEAD = 4
+
+
 def interp_unstruct_grid(image, x, y, new_x, new_y):
     interpolated_image = griddata((x.flatten(), y.flatten()), 
                                   image.flatten(), 
@@ -35,7 +39,31 @@ def data_noise_to_wavelet_light(lens_image, kwargs_res, model_type='source',
                                 num_samples=1000, vmap_loop=True, sigma_clipping=True, seed=0,
                                 starlet_num_scales=None, starlet_second_gen=False, 
                                 noise_var=None, arc_mask=None, 
-                                median_per_scale=False, delensing_type='operator'):
+                                median_per_scale=False, delensing_type='operator',
+                                method='MC', num_refinement_samples=0,
+                                batch_size=None, memory_budget=None):
+    """
+    Propagates the data noise to the wavelet coefficients of a pixelated light profile,
+    and returns the standard deviation of the coefficients for each wavelet type,
+    along with the corresponding wavelet transforms.
+
+    The noise can be propagated through the (transposed) convolution, lensing and wavelet operators
+    either by Monte Carlo with `num_samples` noise realizations (method='MC'), or analytically 
+    (method='analytic'), neglecting the correlations between pixels introduced by the convolution 
+    and lensing operators: the variance map is propagated with the element-wise squared operators, 
+    and the variance of each wavelet scale is the convolution of the resulting variance map 
+    with the squared filter coefficients of that scale. If `num_refinement_samples` > 0, 
+    the analytic maps are rescaled by the median ratio (per scale) with a Monte Carlo estimate 
+    based on this number of noise realizations, to approximately account for these correlations.
+
+    By default, all noise realizations are propagated at once. To bound the memory usage, 
+    realizations can instead be propagated by batches of `batch_size` (or as many as fit 
+    in `memory_budget` bytes), accumulating the statistics with Welford updates (see streaming_std()).
+    The same realizations are drawn in both cases, such that results only differ by round-off errors.
+    """
+    if method not in ('MC', 'analytic'):
+        raise ValueError(f"Method '{method}' for noise propagation is not supported.")
+
     # get the data noise
     nx, ny = lens_image.Grid.num_pixel_axes
     if noise_var is None:
@@ -59,15 +87,20 @@ def data_noise_to_wavelet_light(lens_image, kwargs_res, model_type='source',
         if delensing_type == 'operator':
             # construct the lensing operator
             lensing_op = lens_image.get_lensing_operator(
-                kwargs_lens=kwargs_res['kwargs_lens'], update=False, arc_mask=arc_mask,
+                kwargs_lens=kwargs_res['kwargs_lens'], update=True, arc_mask=arc_mask,
             )
             def F_T(n): # de-lensing operation
                 return lensing_op.lensing_transpose(n)
+            def F_T_var(v): # propagation of variances through de-lensing
+                return lensing_op.lensing_transpose_variance(v)
             
         elif delensing_type == 'interpol':
             if vmap_loop is True:
                 raise NotImplementedError("Delensing operation via interpolation "
                                           "is not yet compatible with JAX's vmap")
+            if method == 'analytic':
+                raise NotImplementedError("Analytic noise propagation is not supported "
+                                          "for delensing via interpolation")
             # TODO: update the following once it is possible to perform
             # interpolation on unstructured grids using JAX
             theta_x, theta_y = lens_image.Grid.pixel_coordinates 
@@ -79,6 +112,8 @@ def data_noise_to_wavelet_light(lens_image, kwargs_res, model_type='source',
     elif model_type == 'lens_light':
         def F_T(n): # identity operation
             return n
+        def F_T_var(v):
+            return v
         
     # setup the transposed convolution
     kernel = jnp.copy(lens_image.PSF.kernel_point_source)
@@ -90,7 +125,7 @@ def data_noise_to_wavelet_light(lens_image, kwargs_res, model_type='source',
                                     dimension_numbers)
     kernel_rot = jnp.rot90(jnp.rot90(kernel, axes=(0, 1)), axes=(0, 1))
     
-    def B_T(n): # transposed convolution
+    def transposed_convolution(n, kernel_rot):
         res = lax.conv_general_dilated(n[jnp.newaxis, :, :, jnp.newaxis], 
                                        kernel_rot, 
                                        (1,1), #(k//2,k//2),  # window strides
@@ -100,6 +135,15 @@ def data_noise_to_wavelet_light(lens_image, kwargs_res, model_type='source',
                                        dn)     # dimension_numbers = lhs, rhs, out dimension permutation
         return jnp.squeeze(res)
 
+    def B_T(n): # transposed convolution
+        return transposed_convolution(n, kernel_rot)
+
+    def B_T_var(v): # propagation of variances through the transposed convolution
+        return transposed_convolution(v, kernel_rot**2)
+
+    # variance of the normalized noise, i.e. of sigma * C_d^{-1}
+    var_d_norm = 1. / diag_cov_d
+
     wavelet_class_list = []
     std_per_scale_list = []
 
@@ -126,26 +170,52 @@ def data_noise_to_wavelet_light(lens_image, kwargs_res, model_type='source',
             if sigma_clipping is True:
                 # here we clip values that are 5 times the standard deviation
                 thresh = 5. * jnp.std(tmp)
-                tmp = jnp.where(jnp.abs(tmp) > thresh, x=thresh, y=tmp)
+                tmp = jnp.where(jnp.abs(tmp) > thresh, thresh, tmp)
             return Phi_T(tmp)
 
-        # draw many realizations of the noise, scaled by the inverse cov matrix
-        std_d_norm = 1. / np.sqrt(diag_cov_d) # = sigma * C_d^{-1}
-        std_d_norm = std_d_norm[jnp.newaxis, :, :]
-        noise_samples = std_d_norm * jax.random.normal(jax.random.PRNGKey(seed),
-                                                       shape=(num_samples, nx, ny))
+        def propagate_noise_sample(key):
+            # draw a realization of the noise, scaled by the inverse cov matrix
+            noise = jnp.sqrt(var_d_norm) * jax.random.normal(key, shape=(nx, ny))
+            return propagate_noise(noise)
+
+        def propagate_noise_mc(num_samples):
+            # one key per noise realization, such that results do not depend on the batching
+            keys = jax.random.split(jax.random.PRNGKey(seed), num_samples)
+
+            # propagate the noise to wavelet space for each of them
+            if batch_size is not None or memory_budget is not None:
+                if batch_size is None:
+                    bytes_per_sample = 4 * (nx * ny + (nscales + 1) * nx_out * ny_out)
+                    batch_size_ = max(1, int(memory_budget // (_MEMORY_OVERHEAD * bytes_per_sample)))
+                else:
+                    batch_size_ = batch_size
+                return streaming_std(propagate_noise_sample, keys, batch_size_)
+            elif vmap_loop is True:
+                noise_samples_prop = vmap(jit(propagate_noise_sample))(keys)
+            else:
+                noise_samples_prop = []
+                for key in keys:
+                    noise_samples_prop.append(propagate_noise_sample(key))
+                noise_samples_prop = jnp.array(noise_samples_prop)
+
+            # take the standard deviation
+            return jnp.std(noise_samples_prop, axis=0)
 
-        # propagate the noise to wavelet space for each of them
-        if vmap_loop is True:
-            noise_samples_prop = vmap(jit(propagate_noise))(noise_samples)
+        if method == 'MC':
+            std_per_scale = propagate_noise_mc(num_samples)
         else:
-            noise_samples_prop = []
-            for noise in noise_samples:
-                noise_samples_prop.append(propagate_noise(noise))
-            noise_samples_prop = jnp.array(noise_samples_prop)
-
-        # take the standard deviation
-        std_per_scale = jnp.std(noise_samples_prop, axis=0)
+            if model_type == 'lens_light':
+                # without lensing, the convolution and wavelet filters can be combined exactly
+                var_per_scale = wavelet_variance_per_scale(var_d_norm, wavelet, kernel=kernel_rot[:, :, 0, 0])
+            else:
+                var_per_scale = wavelet_variance_per_scale(F_T_var(B_T_var(var_d_norm)), wavelet)
+            std_per_scale = jnp.sqrt(var_per_scale)
+            if num_refinement_samples > 0:
+                # correct for the correlations neglected by the analytic propagation
+                std_mc = propagate_noise_mc(num_refinement_samples)
+                valid = jnp.logical_and(std_per_scale > 0., std_mc > 0.)
+                ratio = jnp.where(valid, std_mc / jnp.where(valid, std_per_scale, 1.), jnp.nan)
+                std_per_scale = std_per_scale * jnp.nanmedian(ratio, axis=(-2, -1))[:, jnp.newaxis, jnp.newaxis]
 
         if median_per_scale is True:
             # single uniform value for each wavelet scale, we take the median value
@@ -158,6 +228,75 @@ def data_noise_to_wavelet_light(lens_image, kwargs_res, model_type='source',
     return std_per_scale_list, wavelet_class_list
 
 
+def streaming_std(fn, keys, batch_size):
+    """
+    Standard deviation of fn(key) over the given keys, without holding all outputs in memory.
+    The outputs are evaluated by batches of `batch_size` keys (vectorized), and the statistics
+    are accumulated with the parallel version of Welford's algorithm (Chan et al. 1979) inside
+    a `jax.lax.scan`, which is numerically stable and deterministic.
+
+    :param fn: function of a PRNG key that returns an array
+    :param keys: array of PRNG keys, one for each sample
+    :param batch_size: number of samples evaluated at once
+    :return: standard deviation (with zero degrees of freedom, as jnp.std), same shape as the output of fn
+    """
+    num_samples = keys.shape[0]
+    batch_size = min(batch_size, num_samples)
+    num_batches = num_samples // batch_size
+    fn_batched = vmap(fn)
+    out_shape = jax.eval_shape(fn, keys[0])
+
+    def batch_stats(batch_keys):
+        out = fn_batched(batch_keys)
+        mean = jnp.mean(out, axis=0)
+        return out.shape[0], mean, jnp.sum((out - mean)**2, axis=0)
+
+    def merge(state, stats):
+        count, mean, m2 = state
+        count_b, mean_b, m2_b = stats
+        count_new = count + count_b
+        delta = mean_b - mean
+        mean = mean + delta * (count_b / count_new)
+        m2 = m2 + m2_b + delta**2 * (count * count_b / count_new)
+        return count_new, mean, m2
+
+    def body_fn(state, batch_keys):
+        return merge(state, batch_stats(batch_keys)), None
+
+    zeros = jnp.zeros(out_shape.shape, dtype=out_shape.dtype)
+    init_state = (jnp.zeros((), dtype=out_shape.dtype), zeros, zeros)
+    full_keys = keys[:num_batches * batch_size].reshape((num_batches, batch_size) + keys.shape[1:])
+    state, _ = jax.jit(lambda state, keys: lax.scan(body_fn, state, keys))(init_state, full_keys)
+    if num_samples > num_batches * batch_size:
+        # remaining samples
+        state = merge(state, batch_stats(keys[num_batches * batch_size:]))
+    count, _, m2 = state
+    return jnp.sqrt(m2 / count)
+
+
+def wavelet_variance_per_scale(var_map, wavelet, kernel=None):
+    """
+    Variance of the wavelet coefficients of each scale, for an image made of independent pixels 
+    with variances `var_map`, i.e. the convolution of the variance map with the squared 
+    filter coefficients of each scale (boundary effects are neglected).
+
+    :param var_map: 2D array of pixel variances
+    :param wavelet: WaveletTransform instance
+    :param kernel: optional 2D convolution kernel applied to the image before the wavelet transform,
+    which is combined with the filters of each scale
+    :return: array of shape (num_scales + 1, nx, ny)
+    """
+    nx, ny = var_map.shape
+    # filters of each scale, large enough to contain the whole support
+    dirac = jnp.zeros((2*nx + 1, 2*ny + 1)).at[nx, ny].set(1.)
+    filters = wavelet.decompose(dirac)
+    if kernel is not None:
+        filters = vmap(lambda f: jax.scipy.signal.fftconvolve(f, kernel, mode='same'))(filters)
+    var_per_scale = vmap(lambda f: jax.scipy.signal.fftconvolve(var_map, f**2, mode='same'))(filters)
+    # remove negative round-off errors of the FFT
+    return jnp.maximum(var_per_scale, 0.)
+
+
 
 def data_noise_to_wavelet_potential(lens_image, kwargs_res, k_src=None,
                                     likelihood_type='chi2',
@@ -0,0 +1,79 @@
+# Utilities to save and restore the state of long-running inference tasks
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+import os
+import tempfile
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+
+__all__ = ['save_checkpoint', 'load_checkpoint', 'get_resume_path']
+
+
+def save_checkpoint(path, pytree):
+    """Writes a pytree of arrays (parameters, optimizer or sampler state,
+    history, PRNG keys, etc.) to a .npz file.
+
+    The file is first written to a temporary file in the same directory,
+    and then atomically renamed, such that an interrupted write never
+    corrupts an existing checkpoint.
+
+    :param path: path of the checkpoint file
+    :param pytree: pytree whose leaves are arrays or scalars
+    """
+    leaves, treedef = jax.tree_util.tree_flatten(pytree)
+    arrays = {f'leaf_{i}': np.asarray(leaf) for i, leaf in enumerate(leaves)}
+    arrays['treedef'] = np.array(str(treedef))
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path, like):
+    """Reads a pytree written with `save_checkpoint()`.
+
+    :param path: path of the checkpoint file
+    :param like: pytree with the same structure as the saved one
+    (leaf values are ignored), used to restore the tree structure
+    :return: pytree of JAX arrays
+    """
+    treedef = jax.tree_util.tree_structure(like)
+    with np.load(path) as data:
+        if str(data['treedef']) != str(treedef):
+            raise ValueError(f"The checkpoint '{path}' does not have the expected structure "
+                             "(was it created with different settings?).")
+        leaves = [jnp.asarray(data[f'leaf_{i}']) for i in range(treedef.num_leaves)]
+    return jax.tree_util.tree_unflatten(treedef, leaves)
+
+
+def get_resume_path(resume, checkpoint_path):
+    """Returns the path of the checkpoint to resume from, if any.
+
+    :param resume: None or False (do not resume), a path to a checkpoint file,
+    or True to resume from `checkpoint_path` if that file exists
+    :param checkpoint_path: path where checkpoints are written
+    :return: path or None
+    """
+    if resume is None or resume is False:
+        return None
+    if resume is True:
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            return checkpoint_path
+        return None
+    if not os.path.exists(resume):
+        raise FileNotFoundError(f"Checkpoint file '{resume}' does not exist.")
+    return resume
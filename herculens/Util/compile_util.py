@@ -0,0 +1,330 @@
+# Utilities to monitor and limit the cost of JAX compilation
+#
+# Copyright (c) 2024, herculens developers and contributors
+
+__author__ = 'aymgal'
+
+
+import os
+import re
+import json
+import time
+import hashlib
+from functools import partial
+from collections import Counter
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jax.experimental.compilation_cache import compilation_cache
+
+
+__all__ = ['model_fingerprint', 'enable_compilation_cache', 'compilation_cache_stats', 'warm_start',
+           'profile_compilation', 'format_compilation_report']
+
+
+_CACHE_EVENTS = {
+    '/jax/compilation_cache/compile_requests_use_cache': 'requests',
+    '/jax/compilation_cache/cache_hits': 'hits',
+    '/jax/compilation_cache/cache_misses': 'misses',
+}
+_cache_stats = {name: 0 for name in _CACHE_EVENTS.values()}
+_listener_registered = False
+
+
+def _cache_event_listener(event, **kwargs):
+    if event in _CACHE_EVENTS:
+        _cache_stats[_CACHE_EVENTS[event]] += 1
+
+
+def _register_cache_listener():
+    global _listener_registered
+    if not _listener_registered:
+        jax.monitoring.register_event_listener(_cache_event_listener)
+        _listener_registered = True
+
+
+def _profile_names(profile_list):
+    return [p if isinstance(p, str) else type(p).__name__ for p in profile_list]
+
+
+def _model_description(model):
+    description = {
+        'profiles': _profile_names(model.profile_type_list),
+        'repeated_profile_mode': getattr(model, '_repeated_profile_mode', False),
+        'use_jax_scan': getattr(model, '_use_jax_scan', False),
+    }
+    if model.has_pixels:
+        description['pixel_grid_shape'] = model.pixel_grid.num_pixel_axes
+    return description
+
+
+def model_fingerprint(lens_image, **extra):
+    """Returns a stable identifier of the structure of a LensImage model, i.e. of all
+    the settings that define the computational graph of its methods: types of profiles,
+    shape and resolution of the pixel grid, PSF type, numerics settings, etc., as well
+    as the versions of JAX and the backend. Two LensImage instances with the same
+    fingerprint lead to the same compiled functions, provided that data-dependent arrays
+    (e.g. the observed image) are passed as arguments rather than stored in the instances.
+
+    :param lens_image: LensImage instance
+    :param extra: additional (JSON-serializable) settings to include in the fingerprint
+    :return: hexadecimal string
+    """
+    psf = lens_image.PSF
+    description = {
+        'jax': jax.__version__,
+        'backend': jax.default_backend(),
+        'grid': {
+            'shape': lens_image.Grid.num_pixel_axes,
+            'transform_pix2angle': np.round(np.asarray(lens_image.Grid.transform_pix2angle), 10).tolist(),
+        },
+        'psf': {
+            'type': psf.psf_type,
+            'kernel_shape': np.shape(psf.kernel_point_source) if psf.psf_type == 'PIXEL' else None,
+        },
+        'noise': type(lens_image.Noise).__name__,
+        'mass': _model_description(lens_image.MassModel),
+        'source': _model_description(lens_image.SourceModel),
+        'lens_light': _model_description(lens_image.LensLightModel),
+        'point_source': list(lens_image.PointSourceModel.type_list),
+        'source_arc_mask': (None if lens_image.source_arc_mask is None
+                            else np.shape(lens_image.source_arc_mask)),
+        'kwargs_numerics': lens_image.kwargs_numerics,
+        'extra': extra,
+    }
+    serialized = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()[:16]
+
+
+def enable_compilation_cache(cache_dir, fingerprint=None, min_compile_time_secs=1.):
+    """Enables JAX's persistent compilation cache, such that compiled functions
+    are written to disk and re-used by subsequent Python processes.
+
+    :param cache_dir: directory of the cache
+    :param fingerprint: optional model fingerprint (see `model_fingerprint()`); if provided,
+    the cache of each model structure is stored in its own sub-directory
+    :param min_compile_time_secs: only functions whose compilation takes longer are cached
+    :return: path of the cache directory
+    """
+    if fingerprint is not None:
+        cache_dir = os.path.join(cache_dir, fingerprint)
+    os.makedirs(cache_dir, exist_ok=True)
+    jax.config.update('jax_compilation_cache_dir', cache_dir)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', min_compile_time_secs)
+    # such that a change of directory is taken into account
+    compilation_cache.reset_cache()
+    _register_cache_listener()
+    return cache_dir
+
+
+def compilation_cache_stats():
+    """Number of compilation requests, cache hits and cache misses of the persistent
+    compilation cache, since `enable_compilation_cache()` has been called.
+
+    :return: dictionary with keys 'requests', 'hits' and 'misses'
+    """
+    return dict(_cache_stats)
+
+
+@partial(jax.jit, static_argnums=(0, 1))
+def _loss_method_of_data(make_loss, name, params, data):
+    return getattr(make_loss(data), name)(params)
+
+
+def warm_start(loss, params, lens_image=None, kwargs_model=None,
+               methods=('function', 'gradient', 'value_and_gradient'), hessian=False,
+               make_loss=None, data=None):
+    """Lowers and compiles ahead-of-time the hot methods of a loss function (and of the
+    LensImage model), such that they are written to the persistent compilation cache
+    (see `enable_compilation_cache()`), or read from it if already compiled
+    by a previous process.
+
+    Ahead-of-time compilation does not populate the dispatch cache of the jitted methods:
+    subsequent calls such as `loss.gradient(params)` are traced and compiled again (possibly
+    from the persistent cache). The executables to use are those returned under the
+    'compiled' key of the report.
+
+    Arrays stored in the loss (e.g. the observed image and the noise map captured by the
+    probabilistic model) are embedded as constants in the compiled executables, which are
+    therefore only valid for that loss. To compile executables that can be re-used for other
+    lenses with the same model structure and array shapes, provide instead `make_loss` and
+    `data`: the data-dependent arrays are then arguments of the executables.
+
+    :param loss: Differentiable instance, typically herculens.Inference.loss.Loss;
+    ignored (and can be None) if `make_loss` is provided
+    :param params: parameters with the same structure, shapes and dtypes as those used during inference
+    :param lens_image: optional LensImage instance whose model() method should be compiled too
+    :param kwargs_model: keyword arguments passed to `lens_image.model()`
+    :param methods: names of the jitted methods of the loss to compile
+    :param hessian: if True, also compiles the Hessian (expensive for many parameters)
+    :param make_loss: optional callable that takes `data` and returns a Differentiable instance;
+    it must be hashable (e.g. a module-level function), and should not depend on other arrays
+    :param data: pytree of data-dependent arrays (e.g. observed image and noise map) passed to `make_loss`
+    :return: report with, for each compiled function, lowering and compilation times,
+    number of cache hits and misses, and the compiled executable under the 'compiled' key.
+    The latter is called without the instance, i.e. `compiled(params)` for the loss methods,
+    or `compiled(params, data)` if `make_loss` is provided, and `compiled(**kwargs_model)`
+    for the model.
+    """
+    _register_cache_listener()
+    targets = {}
+    for name in tuple(methods) + (('hessian',) if hessian else ()):
+        if make_loss is None:
+            targets[f'loss.{name}'] = (getattr(type(loss), name), (loss, params), {})
+        else:
+            targets[f'loss.{name}'] = (_loss_method_of_data, (make_loss, name, params, data), {})
+    if lens_image is not None:
+        targets['lens_image.model'] = (type(lens_image).model, (lens_image,), kwargs_model or {})
+    report = {}
+    for name, (jitted_fn, args, kwargs) in targets.items():
+        stats_before = compilation_cache_stats()
+        start = time.time()
+        lowered = jitted_fn.lower(*args, **kwargs)
+        lower_time = time.time() - start
+        start = time.time()
+        compiled = lowered.compile()
+        compile_time = time.time() - start
+        stats_after = compilation_cache_stats()
+        report[name] = {
+            'lower_time': lower_time,
+            'compile_time': compile_time,
+            'cache_hits': stats_after['hits'] - stats_before['hits'],
+            'cache_misses': stats_after['misses'] - stats_before['misses'],
+            'compiled': compiled,
+        }
+    return report
+
+
+_HLO_OP_REGEX = re.compile(r'(?:^|=\s*)"?((?:stablehlo|chlo|mhlo)\.\w+|func\.call)\b')
+
+
+def _count_hlo_ops(hlo_text):
+    counts = Counter()
+    for line in hlo_text.splitlines():
+        match = _HLO_OP_REGEX.search(line.strip())
+        if match is not None:
+            counts[match.group(1).split('.', 1)[1]] += 1
+    return counts
+
+
+def _count_jaxpr_eqns(jaxpr):
+    count = 0
+    for eqn in jaxpr.eqns:
+        count += 1
+        for param in eqn.params.values():
+            for sub in (param if isinstance(param, (list, tuple)) else (param,)):
+                if isinstance(sub, jax.core.ClosedJaxpr):
+                    count += _count_jaxpr_eqns(sub.jaxpr)
+                elif isinstance(sub, jax.core.Jaxpr):
+                    count += _count_jaxpr_eqns(sub)
+    return count
+
+
+def _profile_jitted(jitted_fn, args, kwargs):
+    start = time.time()
+    traced = jitted_fn.trace(*args, **kwargs)
+    trace_time = time.time() - start
+    start = time.time()
+    lowered = traced.lower()
+    lower_time = time.time() - start
+    start = time.time()
+    compiled = lowered.compile()
+    compile_time = time.time() - start
+    op_counts = _count_hlo_ops(lowered.as_text())
+    memory = compiled.memory_analysis()
+    cost = compiled.cost_analysis()
+    if isinstance(cost, (list, tuple)):
+        cost = cost[0] if len(cost) > 0 else None
+    return {
+        'trace_time': trace_time,
+        'lower_time': lower_time,
+        'compile_time': compile_time,
+        'jaxpr_eqn_count': _count_jaxpr_eqns(traced.jaxpr.jaxpr),
+        'hlo_op_count': sum(op_counts.values()),
+        'hlo_op_counts': dict(op_counts.most_common()),
+        'temp_size_in_bytes': getattr(memory, 'temp_size_in_bytes', None),
+        'generated_code_size_in_bytes': getattr(memory, 'generated_code_size_in_bytes', None),
+        'argument_size_in_bytes': getattr(memory, 'argument_size_in_bytes', None),
+        'output_size_in_bytes': getattr(memory, 'output_size_in_bytes', None),
+        'flops': None if cost is None else cost.get('flops'),
+    }
+
+
+def profile_compilation(lens_image, kwargs_lens=None, kwargs_source=None, kwargs_lens_light=None,
+                        kwargs_point_source=None, loss=None, params=None):
+    """Measures the cost of compiling the model of a LensImage, in total and for each
+    of its components, to identify what dominates the compilation time
+    (e.g., Python loops over profiles that are unrolled, versus `use_jax_scan`
+    or the repeated-profile mode of mass and light models).
+
+    Each component is jitted on its own and goes through the tracing, lowering and compilation
+    stages separately. The components are: 'mass' (ray-shooting of the coordinates grid),
+    'source' (evaluation of the source on ray-shot coordinates), 'lens_light', 'convolution'
+    (resizing and PSF convolution), 'point_source' (only if the model contains point sources),
+    and the full 'model'. If a loss and parameters are provided, 'loss.function' and
+    'loss.gradient' are profiled too.
+
+    :param lens_image: LensImage instance
+    :param kwargs_lens: keyword arguments of the lens mass model
+    :param kwargs_source: keyword arguments of the source model
+    :param kwargs_lens_light: keyword arguments of the lens light model
+    :param kwargs_point_source: keyword arguments of the point source model
+    :param loss: optional Differentiable instance, typically herculens.Inference.loss.Loss
+    :param params: parameters of the loss, required if loss is provided
+    :return: dictionary with one entry per component, each being a dictionary with tracing,
+    lowering and compilation times (in seconds), the number of jaxpr equations (including nested ones),
+    the number of (StableHLO) operations in total and per operation type, and memory and cost estimates
+    of the compiled executable (e.g., 'temp_size_in_bytes', the peak size of temporary buffers)
+    """
+    x, y = lens_image.ImageNumerics.coordinates_evaluate
+    x, y = jnp.asarray(x), jnp.asarray(y)
+    targets = {}
+    has_mass = len(lens_image.MassModel.profile_type_list) > 0
+    if has_mass:
+        targets['mass'] = (jax.jit(lens_image.MassModel.ray_shooting), (x, y, kwargs_lens))
+    if len(lens_image.SourceModel.profile_type_list) > 0:
+        if has_mass and not lens_image.SourceModel.has_pixels:
+            x_src, y_src = lens_image.MassModel.ray_shooting(x, y, kwargs_lens)
+        else:
+            x_src, y_src = x, y
+        if lens_image.SourceModel.has_pixels:
+            # the pixelated source may depend on the lens model (adaptive grid)
+            fn = lambda kwargs_source, kwargs_lens: lens_image.eval_source_surface_brightness(
+                x, y, kwargs_source, kwargs_lens=kwargs_lens)
+            targets['source'] = (jax.jit(fn), (kwargs_source, kwargs_lens))
+        else:
+            targets['source'] = (jax.jit(lens_image.SourceModel.surface_brightness),
+                                 (x_src, y_src, kwargs_source))
+    if len(lens_image.LensLightModel.profile_type_list) > 0:
+        targets['lens_light'] = (jax.jit(lens_image.LensLightModel.surface_brightness),
+                                 (x, y, kwargs_lens_light))
+    targets['convolution'] = (jax.jit(lens_image.ImageNumerics.re_size_convolve), (jnp.ones_like(x),))
+    if len(lens_image.PointSourceModel.type_list) > 0:
+        fn = lambda kwargs_point_source, kwargs_lens: lens_image.point_source_image(
+            kwargs_point_source, kwargs_lens, kwargs_solver=lens_image.kwargs_lens_equation_solver)
+        targets['point_source'] = (jax.jit(fn), (kwargs_point_source, kwargs_lens))
+    kwargs_model = dict(kwargs_lens=kwargs_lens, kwargs_source=kwargs_source,
+                        kwargs_lens_light=kwargs_lens_light, kwargs_point_source=kwargs_point_source)
+    report = {name: _profile_jitted(fn, args, {}) for name, (fn, args) in targets.items()}
+    report['model'] = _profile_jitted(type(lens_image).model, (lens_image,), kwargs_model)
+    if loss is not None:
+        if params is None:
+            raise ValueError("Parameters must be provided to profile the loss function.")
+        for name in ('function', 'gradient'):
+            report[f'loss.{name}'] = _profile_jitted(getattr(type(loss), name), (loss, params), {})
+    return report
+
+
+def format_compilation_report(report):
+    """Formats the output of `profile_compilation()` as a table.
+
+    :param report: dictionary returned by `profile_compilation()`
+    :return: string
+    """
+    header = f"{'component':<16}{'trace (s)':>11}{'lower (s)':>11}{'compile (s)':>13}{'eqns':>9}{'HLO ops':>10}{'temp (MB)':>11}"
+    lines = [header, '-' * len(header)]
+    for name, r in report.items():
+        temp_mb = np.nan if r['temp_size_in_bytes'] is None else r['temp_size_in_bytes'] / 1e6
+        lines.append(f"{name:<16}{r['trace_time']:>11.3f}{r['lower_time']:>11.3f}{r['compile_time']:>13.3f}"
+                     f"{r['jaxpr_eqn_count']:>9d}{r['hlo_op_count']:>10d}{temp_mb:>11.3f}")
+    return '\n'.join(lines)
@@ -102,6 +102,17 @@ def add_poisson(image, exp_time, seed):
     # poisson = np.random.randn(*image.shape) * sigma
     return poisson
 
+def add_correlated_background(image, sqrt_power_spectrum, seed):
+    """
+    adds stationary correlated (Gaussian) background noise to image
+    :param image: pixel values of image
+    :param sqrt_power_spectrum: square root of the power spectrum of the noise, sampled on the
+    Fourier modes of the image (layout of numpy.fft.fft2), normalized such that its mean is the pixel variance
+    :return: a realisation of correlated Gaussian noise of the same size as image
+    """
+    white = random.normal(seed, shape=jnp.shape(image))
+    return jnp.fft.ifft2(sqrt_power_spectrum * jnp.fft.fft2(white)).real
+
 def cut_edges(image, numPix):
     """
     cuts out the edges of a 2d image and returns re-sized image to numPix
@@ -5,8 +5,10 @@
 __author__ = 'austinpeel', 'aymgal', 'duxfrederic'
 
 
+import hashlib
 from copy import deepcopy
 import numpy as np
+import jax
 import jax.numpy as jnp
 from jax import jit, lax
 from jax.scipy.special import gammaln
@@ -38,6 +40,23 @@ def unjaxify_kwargs(kwargs_params):
     return kwargs_params_new
 
 
+def hash_pytree(pytree):
+    """
+    Utility to compute a hash of the values contained in a pytree (e.g. a 
+    list of model kwargs), for instance to use as key for caching results.
+    It must be called outside of jitted functions, on concrete values.
+    """
+    leaves, treedef = jax.tree_util.tree_flatten(pytree)
+    hasher = hashlib.sha1(str(treedef).encode())
+    for leaf in leaves:
+        if isinstance(leaf, jax.core.Tracer):
+            raise ValueError("Values cannot be hashed within a jitted function.")
+        leaf = np.asarray(leaf)
+        hasher.update(str((leaf.dtype, leaf.shape)).encode())
+        hasher.update(leaf.tobytes())
+    return hasher.hexdigest()
+
+
 def R_omega(z, t, q, nmax):
     """Angular dependency of the deflection angle in the EPL lens profile.
 
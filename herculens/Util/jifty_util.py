@@ -1,3 +1,4 @@
+import numpy as np
 import jax.numpy as jnp
 import jax.scipy.stats as jstats
 
@@ -179,3 +180,54 @@ def ExpCroppedFieldTransform(key, cf, bxy, bwl):
         lambda x: {key: jnp.exp(crop(x))},  # here the target key is different from domain keys below
         domain=cf.domain,
     )
+
+
+def fourier_mode_binning(shape):
+    """Fixed properties of the harmonic grid of a correlated field along dimensions of the given shape,
+    with the same distances as in `prepare_correlated_field()`.
+
+    Returns
+    -------
+    tuple of (np.ndarray, float)
+        Index of the power spectrum bin of each Fourier mode, and the total volume of the grid.
+    """
+    grid = jft.correlated_field.make_grid(shape, 1./shape[0], 'fourier')
+    return np.asarray(grid.harmonic_grid.power_distributor), grid.total_volume
+
+
+def real_hartley(x, axes, upper_index):
+    """Hartley transform of a real array along the given axes, identical to nifty.re's
+    `hartley()` but based on a real-input FFT, which is about twice cheaper than the complex FFT.
+    The modes of the missing half of the spectrum are obtained from the Hermitian symmetry
+    of the Fourier transform of real inputs.
+
+    Parameters
+    ----------
+    x : jnp.ndarray
+        Real array to be transformed.
+    axes : tuple of int
+        Axes over which the transform is computed (must be contiguous and in increasing order).
+    upper_index : np.ndarray
+        Indices along the last transformed axis of the modes in the missing half of the spectrum,
+        as returned by `real_hartley_upper_index()` (to be computed once).
+
+    Returns
+    -------
+    jnp.ndarray
+        Hartley transform of `x`, with the same shape.
+    """
+    f = jnp.fft.rfftn(x, axes=axes)
+    if jft.config._config.get("hartley_convention") == "non_canonical_hartley":
+        h_lower, h_conj = f.real + f.imag, f.real - f.imag
+    else:
+        h_lower, h_conj = f.real - f.imag, f.real + f.imag
+    # F(-k) = conj(F(k)), so the missing modes are taken at the opposite frequencies
+    for ax in axes[:-1]:
+        h_conj = jnp.roll(jnp.flip(h_conj, axis=ax), 1, axis=ax)
+    h_upper = jnp.take(h_conj, upper_index, axis=axes[-1])
+    return jnp.concatenate([h_lower, h_upper], axis=axes[-1])
+
+
+def real_hartley_upper_index(num_pix):
+    """Indices used by `real_hartley()` along an axis of size `num_pix`."""
+    return num_pix - np.arange(num_pix // 2 + 1, num_pix)
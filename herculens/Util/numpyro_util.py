@@ -2,16 +2,88 @@
 # In the future, these may be incorporated within numpyro 
 
 
+import math
+import jax
 import jax.numpy as jnp
 from functools import partial
 
 import numpyro
 from numpyro import handlers
+from numpyro import distributions as dist
 from numpyro.distributions import transforms, constraints
 from numpyro.distributions.util import sum_rightmost
 from numpyro.infer import util
 
 
+class NoiseNormal(dist.Distribution):
+    """
+    Gaussian distribution of an image with the noise covariance of a Noise instance,
+    which can be correlated between pixels. This is meant to be used for the likelihood,
+    e.g. numpyro.sample('obs', NoiseNormal(lens_image.Noise, model, mask=mask), obs=data),
+    for which the log-probability is Noise.log_likelihood() and the residuals (used by
+    site_residuals()) are Noise.whitened_residuals().
+    NOTE: the mask must be given here, and not with numpyro's mask handler, because
+    masking the whitened residuals of correlated noise would not give the correct chi-square.
+
+    :param noise: instance of herculens.Instrument.noise.Noise
+    :param loc: image model
+    :param mask: array of 1s (pixels included) and 0s (pixels excluded)
+    :param kwargs_noise: keyword arguments passed to Noise.log_likelihood(), e.g. background_rms
+    """
+    arg_constraints = {"loc": constraints.real}
+    support = constraints.independent(constraints.real, 2)
+    reparametrized_params = ["loc"]
+
+    def __init__(self, noise, loc, mask=None, kwargs_noise=None, validate_args=None):
+        self.noise = noise
+        self.loc = loc
+        self.pixel_mask = mask
+        self.kwargs_noise = {} if kwargs_noise is None else kwargs_noise
+        super().__init__(batch_shape=(), event_shape=jnp.shape(loc), validate_args=validate_args)
+
+    def sample(self, key, sample_shape=()):
+        std_map = jnp.sqrt(self.noise.C_D_model(self.loc, **self.kwargs_noise))
+        keys = jax.random.split(key, math.prod(sample_shape))
+        noise = jax.vmap(partial(self.noise.correlated_realisation, std_map))(keys)
+        return self.loc + noise.reshape(sample_shape + self.event_shape)
+
+    def log_prob(self, value):
+        return self.noise.log_likelihood(value, self.loc, mask=self.pixel_mask, **self.kwargs_noise)
+
+    def whitened_residuals(self, value):
+        return self.noise.whitened_residuals(value, self.loc, mask=self.pixel_mask, **self.kwargs_noise)
+
+
+class ResidualFactor(dist.Unit):
+    """
+    Factor term of log-probability -0.5 * sum(r**2), which keeps the vector of residuals r,
+    such that site_residuals() returns r instead of the single residual sqrt(-2 * log_factor).
+    This should be used through residual_factor().
+
+    :param residuals: array of residuals
+    """
+
+    def __init__(self, residuals, validate_args=None):
+        self.residuals = jnp.ravel(residuals)
+        super().__init__(- 0.5 * jnp.sum(self.residuals**2), validate_args=validate_args)
+
+
+def residual_factor(name, residuals):
+    """
+    Same as numpyro.factor(name, -0.5 * sum(residuals**2)), but for which the residuals
+    (see site_residuals()) are the full vector `residuals`, e.g. sqrt(strength) * D p for the
+    regularization of pixels p with a finite-difference operator D (see RegulModel.operators).
+    This gives a Jacobian of the residuals of full rank to least-squares optimizers such as
+    GaussNewtonOptimizer, while the Jacobian of the single residual of a factor site has rank one.
+
+    :param name: name of the site
+    :param residuals: array of residuals
+    """
+    unit_dist = ResidualFactor(residuals)
+    unit_value = unit_dist.sample(None)
+    numpyro.sample(name, unit_dist, obs=unit_value, infer={"is_auxiliary": True})
+
+
 def unconstrain_reparam(params, site):
     """added support for numpyro.param sites"""
     name = site["name"]
@@ -84,3 +156,56 @@ def potential_energy(model, model_args, model_kwargs, params):
         substituted_model, model_args, model_kwargs, {}
     )
     return -log_joint
+
+
+def site_residuals(site):
+    """
+    Returns the flattened vector of residuals r of a sample site, such that its
+    log-probability is -0.5 * sum(r**2), up to a constant. This is supported for:
+    - Normal distributions (possibly expanded, masked or reinterpreted as independent),
+    e.g. an observed site with (data - model) / sigma as residuals, or a Gaussian prior;
+    - factor sites, with sqrt(-2 * log_factor), which assumes that the factor is non-positive
+    (e.g. a quadratic regularization term). This single residual has a Jacobian of rank one,
+    hence factor sites added with residual_factor() return instead their full vector of residuals;
+    - NoiseNormal distributions, with the whitened residuals of (possibly correlated) noise.
+    For all other distributions, returns None.
+
+    :param site: site of a numpyro trace
+    """
+    fn, mask = site["fn"], True
+    while isinstance(fn, (dist.MaskedDistribution, dist.Independent, dist.ExpandedDistribution)):
+        if isinstance(fn, dist.MaskedDistribution):
+            mask = jnp.logical_and(mask, fn._mask)
+        fn = fn.base_dist
+    if isinstance(fn, dist.Normal):
+        value = jnp.asarray(site["value"])
+        residuals = jnp.broadcast_to((value - fn.loc) / fn.scale, value.shape)
+    elif isinstance(fn, NoiseNormal):
+        residuals = fn.whitened_residuals(jnp.asarray(site["value"]))
+    elif isinstance(fn, ResidualFactor):
+        residuals = fn.residuals
+    elif isinstance(fn, dist.Unit):
+        # safe square root, for the gradient to be defined where the factor vanishes
+        minus_2_log_factor = - 2. * fn.log_factor
+        positive = minus_2_log_factor > 0.
+        residuals = jnp.where(positive, jnp.sqrt(jnp.where(positive, minus_2_log_factor, 1.)), 0.)
+    else:
+        return None
+    if site.get("mask") is not None:
+        mask = jnp.logical_and(mask, site["mask"])
+    residuals = jnp.where(mask, residuals, 0.)
+    if site.get("scale") is not None:
+        residuals = jnp.sqrt(site["scale"]) * residuals
+    return jnp.ravel(residuals)
+
+
+def site_log_prob(site):
+    """
+    Returns the (summed) log-probability of a sample site, including its scale.
+
+    :param site: site of a numpyro trace
+    """
+    log_prob = site["fn"].log_prob(site["value"])
+    if site.get("scale") is not None:
+        log_prob = site["scale"] * log_prob
+    return jnp.sum(log_prob)
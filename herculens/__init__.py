@@ -35,10 +35,15 @@ from .PointSourceModel.point_source_model import PointSourceModel
 from .GenericModel.correlated_field import CorrelatedField
 
 from .LensImage.lens_image import LensImage, LensImage3D
+from .LensImage.lens_image_stack import LensImageStack
 from .Inference.loss import Loss
 from .Inference.ProbModel.numpyro import NumpyroModel
 from .Inference.Optimization.jaxopt import JaxoptOptimizer
 from .Inference.Optimization.optax import OptaxOptimizer
+from .Inference.Optimization.multistart import MultiStartOptimizer
+from .Inference.Optimization.gauss_newton import GaussNewtonOptimizer
+from .Inference.SVI.svi import SVI
+from .Inference.covariance import LowRankFisherCovariance
 from .Analysis.plot import Plotter
 
 from .Util import param_util as prmu
@@ -0,0 +1,54 @@
+# Testing the correlated field model
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+import jax
+
+from herculens.LightModel.light_model import LightModel
+from herculens.GenericModel.correlated_field import CorrelatedField
+
+
+jax.config.update("jax_enable_x64", True)
+
+
+def random_params(field, seed=0):
+    models = [field._jft_model] if field._jft_model is not None else field._jft_model_list
+    key = jax.random.PRNGKey(seed)
+    params = {}
+    for model in models:
+        for name, shape_dtype in model.domain.items():
+            key, subkey = jax.random.split(key)
+            params[name] = jax.random.normal(subkey, shape_dtype.shape)
+    return params
+
+
+@pytest.mark.parametrize(
+    "kwargs_field", 
+    [
+        {},
+        {'cropped_border_size': 5, 'prior_flexibility': (1., 0.5), 'prior_asperity': (0.5, 0.2)},
+        {'num_pix_wl': 4, 'correlation_type_wl': 'power', 'cropped_border_size': 3, 'cropped_border_size_wl': 1},
+        {'num_pix_wl': 3},
+    ]
+)
+def test_cached_model(kwargs_field):
+    light_model = LightModel(['PIXELATED'], kwargs_pixelated={'num_pixels': 21})
+    field = CorrelatedField('source', light_model, **kwargs_field)
+    field_ref = CorrelatedField('source', light_model, cache_harmonic_transform=False, **kwargs_field)
+    params = random_params(field)
+    model = jax.jit(field.model)(params)
+    assert model.shape == field.final_shape
+    npt.assert_allclose(model, field_ref.model(params), rtol=1e-10)
+
+
+def test_model_and_log_prior():
+    light_model = LightModel(['PIXELATED'], kwargs_pixelated={'num_pixels': 10})
+    field = CorrelatedField('source', light_model, num_pix_wl=2)
+    params = random_params(field)
+    model, log_prior = jax.jit(field.model_and_log_prior)(params)
+    npt.assert_allclose(model, field.model(params))
+    values = np.concatenate([np.ravel(v) for v in params.values()])
+    npt.assert_allclose(log_prior, - 0.5 * np.sum(values**2) - 0.5 * values.size * np.log(2. * np.pi))
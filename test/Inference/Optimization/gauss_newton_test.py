@@ -0,0 +1,126 @@
+# Testing the Gauss-Newton / Levenberg-Marquardt optimizer
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax
+import jax.numpy as jnp
+import numpyro
+import numpyro.distributions as dist
+
+from herculens.Inference.loss import Loss
+from herculens.Inference.ProbModel.numpyro import NumpyroModel
+from herculens.Inference.Optimization.gauss_newton import GaussNewtonOptimizer
+from herculens.Inference.Optimization.optax import OptaxOptimizer
+from herculens.RegulModel.operators import DifferentialOperator
+from herculens.Util.numpyro_util import residual_factor
+
+
+class ExponentialModel(NumpyroModel):
+    """Exponential decay with a Gaussian prior and a quadratic regularization term."""
+
+    x = jnp.linspace(0., 5., 40)
+    data = 3. * jnp.exp(-0.7 * x) + 0.05 * jnp.cos(11. * x)
+    sigma = 0.05 * jnp.ones_like(x)
+
+    def model(self):
+        amp = numpyro.sample('amp', dist.Normal(2., 10.))
+        rate = numpyro.sample('rate', dist.Normal(1., 1.))
+        offsets = numpyro.sample('offsets', dist.Normal(jnp.zeros(2), 1.).to_event(1))
+        numpyro.factor('regul', - 0.5 * 100. * jnp.sum(offsets**2))
+        model = amp * jnp.exp(- rate * self.x) + offsets[0]
+        numpyro.sample('obs', dist.Normal(model, self.sigma), obs=self.data)
+
+
+def test_residuals():
+    prob_model = ExponentialModel()
+    params_1 = {'amp': 2.5, 'rate': 0.5, 'offsets': jnp.array([0.1, -0.2])}
+    params_2 = {'amp': 3.2, 'rate': 0.8, 'offsets': jnp.array([0., 0.3])}
+    r_1 = prob_model.residuals(params_1)
+    assert r_1.shape == (40 + 1 + 1 + 2 + 1,)
+    # last residuals are the normalized data residuals
+    model_1 = 2.5 * np.exp(-0.5 * prob_model.x) + 0.1
+    npt.assert_allclose(r_1[-40:], (prob_model.data - model_1) / prob_model.sigma, rtol=1e-5)
+    # all terms are Gaussian, so -0.5 * sum(r**2) equals the log-probability up to a constant
+    r_2 = prob_model.residuals(params_2)
+    delta_log_prob = prob_model.log_prob(params_1) - prob_model.log_prob(params_2)
+    npt.assert_allclose(-0.5 * (jnp.sum(r_1**2) - jnp.sum(r_2**2)), delta_log_prob, rtol=1e-4)
+    loss = Loss(prob_model)
+    npt.assert_allclose(loss.residuals(params_1), r_1, rtol=1e-5)
+
+
+@pytest.mark.parametrize("method", ['LM', 'GN'])
+def test_gauss_newton(method):
+    loss = Loss(ExponentialModel())
+    if method == 'LM':
+        init_params = {'amp': 1., 'rate': 1.5, 'offsets': jnp.array([0.5, 0.5])}
+    else:
+        # undamped Gauss-Newton steps are only reliable close enough to the minimum
+        init_params = {'amp': 2.5, 'rate': 0.8, 'offsets': jnp.array([0.1, 0.1])}
+    optimizer = GaussNewtonOptimizer(loss)
+    best_fit, logL, extra_fields, runtime = optimizer.run(init_params, method=method, max_iterations=50)
+    assert extra_fields['converged']
+    assert extra_fields['num_iterations'] < 30
+    assert extra_fields['loss_history'].shape == (extra_fields['num_iterations'],)
+    npt.assert_allclose(best_fit['amp'], 3., atol=0.1)
+    npt.assert_allclose(best_fit['rate'], 0.7, atol=0.05)
+    # the gradient of the loss vanishes at the best-fit
+    grads = jax.tree_util.tree_leaves(loss.gradient(best_fit))
+    assert all(np.all(np.abs(g) < 1e-1) for g in grads)
+    npt.assert_allclose(logL, - loss.function(best_fit))
+    # same minimum as a first-order optimizer with many more iterations
+    best_fit_adam, logL_adam, _, _ = OptaxOptimizer(loss).run(
+        init_params, max_iterations=3000, init_learning_rate=1e-2)
+    assert logL >= logL_adam - 1e-2 * abs(logL_adam)
+
+
+def test_gauss_newton_errors():
+    optimizer = GaussNewtonOptimizer(Loss(ExponentialModel()))
+    with pytest.raises(ValueError):
+        optimizer.run({'amp': 1., 'rate': 1., 'offsets': jnp.zeros(2)}, method='BFGS')
+
+
+class DenoisingModel(NumpyroModel):
+    """Pixels of an image constrained by noisy data and a gradient regularization."""
+
+    operator = DifferentialOperator((8, 8), kind='gradient', boundary='zero')
+    data = jnp.asarray(np.random.RandomState(0).normal(size=(8, 8)))
+    strength = 10.
+
+    def __init__(self, full_residuals):
+        self.full_residuals = full_residuals
+        super().__init__()
+
+    def model(self):
+        pixels = numpyro.sample('pixels', dist.Normal(jnp.zeros((8, 8)), 10.).to_event(2))
+        regul_residuals = jnp.sqrt(self.strength) * self.operator.apply(pixels)
+        if self.full_residuals:
+            residual_factor('regul', regul_residuals)
+        else:
+            numpyro.factor('regul', - 0.5 * jnp.sum(regul_residuals**2))
+        numpyro.sample('obs', dist.Normal(pixels, 1.).to_event(2), obs=self.data)
+
+
+def test_residual_factor():
+    params = {'pixels': jnp.asarray(np.random.RandomState(1).normal(size=(8, 8)))}
+    prob_model, prob_model_factor = DenoisingModel(True), DenoisingModel(False)
+    r, r_factor = prob_model.residuals(params), prob_model_factor.residuals(params)
+    num_regul = DenoisingModel.operator.apply(params['pixels']).size
+    assert r.shape == (64 + num_regul + 64,)
+    assert r_factor.shape == (64 + 1 + 64,)
+    npt.assert_allclose(jnp.sum(r**2), jnp.sum(r_factor**2), rtol=1e-5)
+    npt.assert_allclose(prob_model.log_prob(params), prob_model_factor.log_prob(params), rtol=1e-5)
+    # the problem is linear: with the full residuals, Gauss-Newton converges in a couple of steps,
+    # while the rank-one Jacobian of the factor misses most of the curvature of the regularization
+    init_params = {'pixels': jnp.zeros((8, 8))}
+    best_fit, logL, extra_fields, _ = GaussNewtonOptimizer(Loss(prob_model)).run(
+        init_params, method='GN', init_damping=1e-6, max_iterations=10, cg_maxiter=500)
+    assert extra_fields['converged'] and extra_fields['num_iterations'] <= 3
+    grads = jax.tree_util.tree_leaves(Loss(prob_model).gradient(best_fit))
+    assert all(np.all(np.abs(g) < 1e-3) for g in grads)
+    _, logL_factor, _, _ = GaussNewtonOptimizer(Loss(prob_model_factor)).run(
+        init_params, method='GN', init_damping=1e-6, max_iterations=3, cg_maxiter=500)
+    assert logL_factor < logL - 1.
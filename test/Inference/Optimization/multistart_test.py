@@ -0,0 +1,51 @@
+# Testing the multi-start optimizer
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax.numpy as jnp
+
+from herculens.Inference.loss import Loss
+from herculens.Inference.Optimization.multistart import MultiStartOptimizer
+
+
+class DoubleWellModel(object):
+    """Log-probability with a global minimum at x = 2 and a local one at x = -2"""
+
+    def log_prob(self, args, constrained=False):
+        x, y = args['x'], args['y']
+        return - ((x**2 - 4.)**2 + 0.5 * (x - 2.)**2 + y**2)
+
+
+@pytest.mark.parametrize("algorithm", ['adam', 'BFGS'])
+def test_multistart(algorithm):
+    loss = Loss(DoubleWellModel())
+    optimizer = MultiStartOptimizer(loss)
+    init_params = [{'x': jnp.array(x0), 'y': jnp.array(0.5)} for x0 in [-3., -1.5, 1., 3.]]
+    kwargs = {'init_learning_rate': 5e-2} if algorithm == 'adam' else {}
+    best_fit, logL, extra_fields, _ = optimizer.run(init_params, algorithm=algorithm, 
+                                                    max_iterations=300, **kwargs)
+    npt.assert_allclose(best_fit['x'], 2., atol=1e-2)
+    npt.assert_allclose(logL, 0., atol=1e-3)
+    assert extra_fields['loss_history'].shape == (4, 300)
+    assert extra_fields['best_index'] == np.argmin(extra_fields['final_loss'])
+    # some starting points converge to the local minimum
+    assert np.any(np.abs(extra_fields['final_params']['x'] + 1.866) < 1e-2)
+
+
+def test_early_rejection():
+    loss = Loss(DoubleWellModel())
+    optimizer = MultiStartOptimizer(loss)
+    init_params = {'x': jnp.array([-3., -1.5, 1., 3.]), 'y': jnp.zeros(4)}
+    best_fit, _, extra_fields, _ = optimizer.run(init_params, algorithm='adam', max_iterations=200,
+                                                 num_stages=2, keep_fraction=0.5, init_learning_rate=5e-2)
+    npt.assert_allclose(best_fit['x'], 2., atol=1e-2)
+    # the two starting points trapped in the local well are rejected after the first stage
+    npt.assert_array_equal(extra_fields['rejected_at_stage'], [0, 0, -1, -1])
+    assert np.all(np.isnan(extra_fields['loss_history'][:2, 100:]))
+    assert np.all(np.isfinite(extra_fields['loss_history'][2:]))
+    with pytest.raises(ValueError):
+        optimizer.run(init_params, keep_fraction=0.)
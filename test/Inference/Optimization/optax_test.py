@@ -0,0 +1,54 @@
+# Testing the optax optimizer
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+
+import jax.numpy as jnp
+
+from herculens.Inference.loss import Loss
+from herculens.Inference.Optimization.optax import OptaxOptimizer
+
+
+class QuadraticModel(object):
+
+    def log_prob(self, args, constrained=False):
+        return - jnp.sum((args['x'] - jnp.array([1., -2., 0.5]))**2)
+
+
+def test_run_compiled():
+    loss = Loss(QuadraticModel())
+    optimizer = OptaxOptimizer(loss)
+    init_params = {'x': jnp.zeros(3)}
+    kwargs = dict(algorithm='adam', max_iterations=150, init_learning_rate=5e-2)
+    _, _, extra_fields, _ = optimizer.run(init_params, progress_bar=False, **kwargs)
+    best_fit, logL, extra_fields_c, _ = optimizer.run_compiled(
+        init_params, return_param_history=True, **kwargs)
+    # without early stopping, both loops perform the same iterations
+    assert extra_fields_c['num_iterations'] == 150
+    assert not extra_fields_c['converged']
+    npt.assert_allclose(extra_fields_c['loss_history'], extra_fields['loss_history'], rtol=1e-5)
+    npt.assert_allclose(logL, - loss(best_fit))
+    npt.assert_allclose(logL, - np.nanmin(extra_fields_c['loss_history']), rtol=1e-6)
+    assert extra_fields_c['param_history']['x'].shape == (150, 3)
+
+    # ring buffer only keeps the last iterations
+    _, _, extra_fields_r, _ = optimizer.run_compiled(init_params, history_size=40, **kwargs)
+    npt.assert_allclose(extra_fields_r['loss_history'], extra_fields['loss_history'][-40:], rtol=1e-5)
+
+
+def test_run_compiled_early_stopping():
+    optimizer = OptaxOptimizer(Loss(QuadraticModel()))
+    init_params = {'x': jnp.zeros(3)}
+    kwargs = dict(algorithm='adam', max_iterations=5000, init_learning_rate=5e-2, 
+                  schedule_learning_rate=False)
+    best_fit, _, extra_fields, _ = optimizer.run_compiled(init_params, grad_norm_tolerance=1e-2, **kwargs)
+    assert extra_fields['converged']
+    assert extra_fields['num_iterations'] < 5000
+    assert extra_fields['grad_norm'] < 1e-2
+    npt.assert_allclose(best_fit['x'], [1., -2., 0.5], atol=1e-2)
+    _, _, extra_fields, _ = optimizer.run_compiled(init_params, patience=10, loss_tolerance=1e-2, 
+                                                   progress_every=100, **kwargs)
+    assert extra_fields['converged']
+    assert extra_fields['num_iterations'] < 5000
@@ -3,11 +3,18 @@
 # Copyright (c) 2023, herculens developers and contributors
 
 
+import numpy as np
+import numpy.testing as npt
+import jax
+import jax.numpy as jnp
 import numpyro
 import numpyro.distributions as dist
 from numpyro.distributions import constraints
 
+from herculens.Instrument.noise import Noise
 from herculens.Inference.ProbModel.numpyro import NumpyroModel
+from herculens.Inference.loss import Loss
+from herculens.Util.numpyro_util import NoiseNormal
 
 
 def test_num_parameters_numpyro():
@@ -59,3 +66,32 @@ def test_num_parameters_numpyro():
     prob_model = MyProbModel()
 
     assert prob_model.num_parameters == 22
+
+
+def test_correlated_noise_likelihood():
+    npix = 8
+    kernel = np.array([[0.05, 0.2, 0.05], [0.2, 1., 0.2], [0.05, 0.2, 0.05]])
+    noise = Noise(npix, npix, exposure_time=100., background_rms=0.1, correlation_kernel=kernel)
+    mask = np.ones((npix, npix))
+    mask[:2, :2] = 0.
+    x = jnp.linspace(-1., 1., npix)
+    profile = jnp.exp(- (x[:, None]**2 + x[None, :]**2))
+    data = 2. * profile + noise.correlated_realisation(0.1 * jnp.ones((npix, npix)), jax.random.PRNGKey(0))
+
+    class CorrelatedNoiseModel(NumpyroModel):
+        def model(self):
+            amp = numpyro.sample('amp', dist.Normal(1., 1.))
+            numpyro.sample('obs', NoiseNormal(noise, amp * profile, mask=mask), obs=data)
+
+    prob_model = CorrelatedNoiseModel()
+    params = {'amp': jnp.array(1.5)}
+    log_prior, log_like = prob_model.log_prior_likelihood(params)
+    npt.assert_allclose(log_like, noise.log_likelihood(data, 1.5 * profile, mask=mask), rtol=1e-6)
+    npt.assert_allclose(log_prior + log_like, prob_model.log_prob(params), rtol=1e-6)
+    # the residuals give the chi-square of the correlated noise
+    residuals = Loss(prob_model).residuals(params)
+    whitened = noise.whitened_residuals(data, 1.5 * profile, mask=mask)
+    npt.assert_allclose(jnp.sum(residuals**2), jnp.sum(whitened**2) + 0.5**2, rtol=1e-5)
+    # prior predictive samples
+    samples = NoiseNormal(noise, profile).sample(jax.random.PRNGKey(1), (3,))
+    assert samples.shape == (3, npix, npix)
@@ -0,0 +1,73 @@
+# Testing the stochastic variational inference front-end
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax.numpy as jnp
+import numpyro
+import numpyro.distributions as dist
+
+from herculens.Inference.ProbModel.numpyro import NumpyroModel
+from herculens.Inference.SVI.svi import SVI
+
+
+class LinearModel(NumpyroModel):
+    """Straight line fit with Gaussian noise, whose posterior is Gaussian."""
+
+    x = jnp.linspace(-1., 1., 50)
+    y = 0.5 + 2. * x + 0.1 * jnp.sin(17. * x)
+    sigma = 0.1
+
+    def model(self):
+        a = numpyro.sample('a', dist.Normal(0., 10.))
+        b = numpyro.sample('b', dist.Normal(0., 10.))
+        numpyro.sample('obs', dist.Normal(a + b * self.x, self.sigma), obs=self.y)
+
+
+@pytest.mark.parametrize("guide", ['mean_field', 'low_rank', 'full_rank'])
+def test_svi_gaussian_guides(guide):
+    prob_model = LinearModel()
+    guide_kwargs = {'rank': 1} if guide == 'low_rank' else {}
+    svi = SVI(prob_model, guide=guide, **guide_kwargs)
+    samples, logL, extra_fields, runtime = svi.run(
+        0, num_steps=2000, init_learning_rate=5e-2, num_particles=4, num_samples=2000)
+    assert set(samples.keys()) == {'a', 'b'}
+    assert samples['a'].shape == (2000,)
+    assert logL.shape == (2000,)
+    assert np.all(np.isfinite(logL))
+    assert extra_fields['loss_history'].shape == (2000,)
+    # the ELBO should have improved substantially
+    assert extra_fields['loss_history'][-100:].mean() < extra_fields['loss_history'][:100].mean()
+    # analytical posterior from weighted least squares
+    A = np.stack([np.ones_like(prob_model.x), prob_model.x], axis=1)
+    cov = np.linalg.inv(A.T @ A) * prob_model.sigma**2
+    mean = cov @ A.T @ prob_model.y / prob_model.sigma**2
+    npt.assert_allclose([samples['a'].mean(), samples['b'].mean()], mean, atol=0.02)
+    npt.assert_allclose([samples['a'].std(), samples['b'].std()], np.sqrt(np.diag(cov)), rtol=0.25)
+    npt.assert_allclose(extra_fields['median']['a'], mean[0], atol=0.02)
+
+
+def test_svi_bnaf_and_init():
+    prob_model = LinearModel()
+    svi = SVI(prob_model, guide='bnaf', num_flows=1, hidden_factors=[4])
+    samples, logL, _, _ = svi.run(0, num_steps=1000, init_learning_rate=1e-2, num_samples=500)
+    assert samples['b'].shape == (500,)
+    assert np.all(np.isfinite(logL))
+    npt.assert_allclose(samples['b'].mean(), 2., atol=0.2)
+
+    svi = SVI(prob_model, guide='mean_field', init_params={'a': 0.5, 'b': 2.})
+    samples, _, _, _ = svi.run(1, num_steps=10, elbo='mean_field', num_samples=10)
+    npt.assert_allclose(samples['b'].mean(), 2., atol=0.2)
+
+
+def test_svi_errors():
+    with pytest.raises(ValueError):
+        SVI(LinearModel(), guide='unknown')
+    svi = SVI(LinearModel())
+    with pytest.raises(ValueError):
+        svi.guide_params
+    with pytest.raises(ValueError):
+        svi.run(0, num_steps=10, elbo='unknown')
@@ -0,0 +1,188 @@
+# Testing the samplers
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import os
+import subprocess
+import sys
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax
+import jax.numpy as jnp
+import numpyro
+import numpyro.distributions as dist
+from scipy.stats import norm
+
+from herculens.Inference.loss import Loss
+from herculens.Inference.ProbModel.numpyro import NumpyroModel
+from herculens.Inference.Sampling.sampling import Sampler
+
+
+class GaussianModel(object):
+
+    mean = jnp.array([1., -2.])
+    std = jnp.array([0.5, 2.])
+
+    def log_prob(self, args, constrained=False):
+        return - 0.5 * jnp.sum(((args['x'] - self.mean) / self.std)**2)
+
+
+@pytest.mark.parametrize("adaptation", ['per_chain', 'pooled'])
+def test_hmc_blackjax_multichain(adaptation):
+    pytest.importorskip("blackjax")
+    sampler = Sampler(Loss(GaussianModel()))
+    num_chains = 4
+    init_params = {'x': jnp.array([[0., 0.], [1., 1.], [-1., 2.], [2., -3.]])}
+    samples, logL, extra_fields, _ = sampler.hmc_blackjax(
+        0, init_params, num_warmup=200, num_samples=500, num_chains=num_chains, adaptation=adaptation)
+    assert samples['x'].shape == (num_chains, 500, 2)
+    assert logL.shape == (num_chains, 500)
+    step_size = extra_fields['adapted_kernel_params']['step_size']
+    assert step_size.shape == ((num_chains,) if adaptation == 'per_chain' else ())
+    npt.assert_allclose(extra_fields['r_hat']['x'], 1., atol=0.05)
+    assert np.all(extra_fields['ess']['x'] > 200)
+    npt.assert_allclose(samples['x'].mean(axis=(0, 1)), GaussianModel.mean, atol=0.2)
+    npt.assert_allclose(samples['x'].std(axis=(0, 1)), GaussianModel.std, rtol=0.15)
+
+
+def test_hmc_blackjax_parallel():
+    pytest.importorskip("blackjax")
+    # the number of CPU devices must be set before JAX is initialized
+    script = """
+import jax, jax.numpy as jnp, numpy as np
+from herculens.Inference.loss import Loss
+from herculens.Inference.Sampling.sampling import Sampler
+class M:
+    def log_prob(self, args, constrained=False):
+        return - 0.5 * jnp.sum(args['x']**2)
+assert jax.local_device_count() == 2
+sampler = Sampler(Loss(M()))
+init_params = {'x': jnp.zeros((4, 3))}
+kwargs = dict(num_warmup=50, num_samples=30, num_chains=4)
+s_par, _, _, _ = sampler.hmc_blackjax(0, init_params, chain_method='parallel', **kwargs)
+s_vec, _, _, _ = sampler.hmc_blackjax(0, init_params, chain_method='vectorized', **kwargs)
+assert s_par['x'].shape == (4, 30, 3)
+np.testing.assert_allclose(s_par['x'], s_vec['x'], rtol=1e-4, atol=1e-5)
+"""
+    env = dict(os.environ, XLA_FLAGS="--xla_force_host_platform_device_count=2")
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+    result = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+@pytest.mark.parametrize("move", ['stretch', 'de'])
+def test_mcmc_ensemble(move):
+    sampler = Sampler(Loss(GaussianModel()))
+    num_walkers = 16
+    init_params = {'x': jnp.array(sampler._init_emcee_ball(np.array([1., -2.]), np.array([0.1, 0.1]), 
+                                                          size=num_walkers, dist='normal'))}
+    samples, logL, extra_fields, _ = sampler.mcmc_ensemble(
+        0, init_params, num_warmup=500, num_samples=2000, move=move)
+    assert samples['x'].shape == (2000 * num_walkers, 2)
+    assert logL.shape == (2000 * num_walkers,)
+    assert 0.2 < extra_fields['mean_acceptance_rate'] < 0.9
+    npt.assert_allclose(samples['x'].mean(axis=0), GaussianModel.mean, atol=0.15)
+    npt.assert_allclose(samples['x'].std(axis=0), GaussianModel.std, rtol=0.15)
+    npt.assert_allclose(logL, jax.vmap(lambda x: GaussianModel().log_prob({'x': x}))(samples['x']), rtol=1e-5)
+
+
+def test_mcmc_ensemble_no_recompilation():
+    from herculens.Inference.Sampling.ensemble import run_ensemble
+    sampler = Sampler(Loss(GaussianModel()))
+    init_params = {'x': jnp.array(sampler._init_emcee_ball(np.array([1., -2.]), np.array([0.1, 0.1]),
+                                                          size=8, dist='normal'))}
+    sampler.mcmc_ensemble(0, init_params, num_warmup=10, num_samples=10)
+    cache_size = run_ensemble._cache_size()
+    # new seed and initial positions, same shapes: the compiled sampler is re-used
+    samples, _, _, _ = sampler.mcmc_ensemble(1, {'x': init_params['x'] + 0.1}, num_warmup=10, num_samples=10)
+    assert run_ensemble._cache_size() == cache_size
+    assert samples['x'].shape == (10 * 8, 2)
+
+
+class LinearGaussianModel(NumpyroModel):
+
+    data_x = jnp.array([1., -0.5])
+    data_y = 1.
+    sigma_x, sigma_y = 0.3, 0.5
+
+    def model(self):
+        x = numpyro.sample('x', dist.Normal(jnp.zeros(2), 1.).to_event(1))
+        y = numpyro.sample('y', dist.Uniform(-5., 5.))
+        numpyro.sample('obs', dist.Normal(x, self.sigma_x).to_event(1), obs=self.data_x)
+        numpyro.sample('obs_y', dist.Normal(y, self.sigma_y), obs=self.data_y)
+
+
+def test_nested_sampling():
+    prob_model = LinearGaussianModel()
+    sampler = Sampler(Loss(prob_model, constrained_space=True))
+    samples, logL, extra_fields, _ = sampler.nested_sampling(0, num_live_points=200, num_delete=20)
+    # analytical evidence (the uniform prior is wide enough to contain the whole likelihood)
+    sigma_evidence = np.sqrt(1. + LinearGaussianModel.sigma_x**2)
+    true_log_z = np.sum(norm.logpdf(LinearGaussianModel.data_x, scale=sigma_evidence)) - np.log(10.)
+    assert extra_fields['converged']
+    assert 0. < extra_fields['log_evidence_err'] < 0.5
+    npt.assert_allclose(extra_fields['log_evidence'], true_log_z, atol=3 * extra_fields['log_evidence_err'])
+    # samples are returned in constrained space
+    assert samples['x'].shape == (logL.size, 2)
+    posterior_mean = LinearGaussianModel.data_x / (1. + LinearGaussianModel.sigma_x**2)
+    npt.assert_allclose(samples['x'].mean(axis=0), posterior_mean, atol=0.05)
+    npt.assert_allclose(samples['y'].mean(), LinearGaussianModel.data_y, atol=0.1)
+    npt.assert_allclose(samples['y'].std(), LinearGaussianModel.sigma_y, rtol=0.15)
+
+
+def test_nested_sampling_plateau():
+    from herculens.Inference.Sampling.nested import run_nested_sampling, nested_sampling_evidence
+    # standard normal prior, and a likelihood that is constant over all live points
+    def log_prior_likelihood_fn(x):
+        log_prior = - 0.5 * jnp.sum(x**2) - 0.5 * x.size * jnp.log(2. * jnp.pi)
+        return log_prior, jnp.where(jnp.all(jnp.abs(x) < 10.), 0., -jnp.inf)
+    num_live, num_delete = 50, 5
+    init_positions = jax.random.normal(jax.random.PRNGKey(1), (num_live, 2))
+    result = run_nested_sampling(log_prior_likelihood_fn, jax.random.PRNGKey(0), init_positions,
+                                 num_delete, 4, 30)
+    num_dead = int(result['num_iterations']) * num_delete
+    assert result['converged']
+    assert np.all(np.isfinite(result['live_positions']))
+    # new points start from surviving live points drawn uniformly, so that dead points follow the prior
+    npt.assert_allclose(np.std(result['dead_positions'][:num_dead], axis=0), 1., atol=0.3)
+    log_like = jnp.concatenate([result['dead_log_likelihood'][:num_dead], result['live_log_likelihood']])
+    num_live_list = jnp.concatenate([result['dead_num_live'][:num_dead], jnp.arange(num_live, 0, -1)])
+    log_z, _, _, _ = nested_sampling_evidence(log_like, num_live_list, rng_key=jax.random.PRNGKey(2))
+    npt.assert_allclose(log_z, 0., atol=1e-2)
+
+
+class BimodalModel(NumpyroModel):
+    """The sign of x is not constrained by the data."""
+
+    def model(self):
+        x = numpyro.sample('x', dist.Uniform(-3., 3.))
+        numpyro.sample('obs', dist.Normal(x**2, 0.1), obs=1.)
+
+
+@pytest.mark.parametrize("kernel", ['rw', 'hmc'])
+def test_smc(kernel):
+    prob_model = LinearGaussianModel()
+    sampler = Sampler(Loss(prob_model, constrained_space=True))
+    samples, logL, extra_fields, _ = sampler.smc(0, num_particles=1000, kernel=kernel, num_mutation_steps=10)
+    assert extra_fields['converged']
+    assert extra_fields['betas'][-1] == 1.
+    assert np.all(np.diff(extra_fields['betas']) > 0.)
+    sigma_evidence = np.sqrt(1. + LinearGaussianModel.sigma_x**2)
+    true_log_z = np.sum(norm.logpdf(LinearGaussianModel.data_x, scale=sigma_evidence)) - np.log(10.)
+    npt.assert_allclose(extra_fields['log_evidence'], true_log_z, atol=0.2)
+    assert samples['x'].shape == (1000, 2)
+    assert logL.shape == (1000,)
+    posterior_mean = LinearGaussianModel.data_x / (1. + LinearGaussianModel.sigma_x**2)
+    npt.assert_allclose(samples['x'].mean(axis=0), posterior_mean, atol=0.05)
+    npt.assert_allclose(samples['y'].std(), LinearGaussianModel.sigma_y, rtol=0.15)
+
+
+def test_smc_multimodal():
+    sampler = Sampler(Loss(BimodalModel(), constrained_space=True))
+    samples, _, _, _ = sampler.smc(0, num_particles=1000, kernel='rw')
+    # both modes, at x = -1 and x = 1, are populated
+    npt.assert_allclose(np.abs(samples['x']).mean(), 1., atol=0.05)
+    npt.assert_allclose(np.mean(samples['x'] > 0.), 0.5, atol=0.1)
@@ -0,0 +1,111 @@
+# Testing the matrix-free covariance estimation
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax
+import jax.numpy as jnp
+from jax.flatten_util import ravel_pytree
+
+from herculens.Inference.base_differentiable import Differentiable
+from herculens.Inference.covariance import LowRankFisherCovariance
+
+
+jax.config.update("jax_enable_x64", True)
+
+
+class QuadraticLoss(Differentiable):
+
+    def __init__(self, hessian):
+        self.H = jnp.asarray(hessian)
+
+    def _func(self, args):
+        x, _ = ravel_pytree(args)
+        return 0.5 * x @ self.H @ x
+
+
+def random_hessian(num_low_rank=3, num_params=30, seed=0):
+    rng = np.random.default_rng(seed)
+    U, _ = np.linalg.qr(rng.normal(size=(num_params, num_low_rank)))
+    eigenvalues = np.array([1e4, 3e3, 1e3])[:num_low_rank]
+    diag = rng.uniform(0.5, 2., size=num_params)
+    return np.diag(diag) + U @ np.diag(eigenvalues) @ U.T
+
+
+@pytest.fixture
+def fisher():
+    hessian = random_hessian()
+    best_fit = {'a': jnp.ones(10), 'b': jnp.zeros(20)}
+    return LowRankFisherCovariance(QuadraticLoss(hessian), best_fit), hessian
+
+
+def test_lanczos(fisher):
+    fisher, hessian = fisher
+    eigenvalues, eigenvectors = fisher.lanczos(num_eigenpairs=5, num_iterations=30)
+    true_eigenvalues, true_eigenvectors = np.linalg.eigh(hessian)
+    npt.assert_allclose(eigenvalues, true_eigenvalues[::-1][:5], rtol=1e-6)
+    overlap = np.abs(np.sum(eigenvectors * true_eigenvectors[:, ::-1][:, :5], axis=0))
+    npt.assert_allclose(overlap, 1., rtol=1e-6)
+    with pytest.raises(ValueError):
+        fisher.lanczos(num_eigenpairs=5, num_iterations=31)
+
+
+def test_inverse_diagonal(fisher):
+    fisher, hessian = fisher
+    true_variances = np.diag(np.linalg.inv(hessian))
+    # with a sketch spanning the whole space, Hutch++ is exact
+    variances = fisher.inverse_diagonal(num_probes=90, method='hutch++', cg_tol=1e-10)
+    npt.assert_allclose(ravel_pytree(variances)[0], true_variances, rtol=1e-6)
+    assert variances['a'].shape == (10,)
+    variances = fisher.inverse_diagonal(num_probes=2000, method='hutchinson')
+    npt.assert_allclose(ravel_pytree(variances)[0], true_variances, rtol=0.3)
+    with pytest.raises(ValueError):
+        fisher.inverse_diagonal(method='unknown')
+
+
+def test_block_diagonal(fisher):
+    fisher, hessian = fisher
+    blocks, indices = fisher.block_diagonal_hessian()
+    npt.assert_array_equal(indices[1], np.arange(10, 30))
+    npt.assert_allclose(blocks[0], hessian[:10, :10], rtol=1e-10)
+    npt.assert_allclose(blocks[1], hessian[10:, 10:], rtol=1e-10)
+    covariances, _ = fisher.block_diagonal_covariance(blocks=[['a', 'b']])
+    npt.assert_allclose(covariances[0], np.linalg.inv(hessian), rtol=1e-8)
+    blocks, _ = fisher.block_diagonal_hessian(blocks=[np.array([0, 5, 12])])
+    npt.assert_allclose(blocks[0], hessian[np.ix_([0, 5, 12], [0, 5, 12])], rtol=1e-10)
+
+
+def test_low_rank_plus_diagonal(fisher):
+    fisher, hessian = fisher
+    with pytest.raises(ValueError):
+        fisher.draw_samples()
+    fisher.compute_low_rank_plus_diagonal(num_eigenpairs=3, num_iterations=10, num_probes=100)
+    covariance = np.linalg.inv(hessian)
+    sigma = fisher.get_sigma()
+    npt.assert_allclose(ravel_pytree(sigma)[0], np.sqrt(np.diag(covariance)), rtol=0.1)
+    samples = fisher.draw_samples(num_samples=20000, seed=1)
+    assert samples['b'].shape == (20000, 20)
+    flat_samples = jax.vmap(lambda s: ravel_pytree(s)[0])(samples)
+    npt.assert_allclose(flat_samples.mean(axis=0), ravel_pytree(fisher.best_fit)[0], atol=0.05)
+    npt.assert_allclose(np.cov(flat_samples.T), covariance, atol=0.1)
+
+
+def test_low_rank_plus_diagonal_dense(fisher):
+    # dense Hessian, exactly diagonal plus low-rank, with known diagonal
+    fisher, hessian = fisher
+    fisher.compute_low_rank_plus_diagonal(num_eigenpairs=3, num_iterations=30, 
+                                          hessian_diagonal=np.diag(hessian))
+    eigenvalues, U, diag = fisher.low_rank_plus_diagonal
+    hessian_approx = np.diag(diag) + U @ np.diag(eigenvalues) @ U.T
+    # same action as the Hessian within the span of its top eigenvectors
+    true_eigenvalues, true_eigenvectors = np.linalg.eigh(hessian)
+    U_top = true_eigenvectors[:, ::-1][:, :3]
+    npt.assert_allclose(U_top.T @ hessian_approx @ U_top, np.diag(true_eigenvalues[::-1][:3]), atol=1e-6)
+    # the remaining curvature is only approximated, but much better than with the top eigenpairs alone
+    remainder = hessian - U_top @ np.diag(true_eigenvalues[::-1][:3]) @ U_top.T
+    assert np.linalg.norm(hessian_approx - hessian) < 0.2 * np.linalg.norm(remainder)
+    npt.assert_allclose(ravel_pytree(fisher.marginal_variances())[0], 
+                        np.diag(np.linalg.inv(hessian)), rtol=1e-2)
@@ -0,0 +1,90 @@
+# Testing the vectorized prior and parameter conversions of the legacy Parameters class
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax
+import jax.numpy as jnp
+
+from herculens.Coordinates.pixel_grid import PixelGrid
+from herculens.Instrument.psf import PSF
+from herculens.MassModel.mass_model import MassModel
+from herculens.LightModel.light_model import LightModel
+from herculens.LensImage.lens_image import LensImage
+from herculens.Inference.legacy.parameters import Parameters
+
+
+jax.config.update("jax_enable_x64", True)
+
+
+@pytest.fixture
+def parameters():
+    npix = 20
+    pixel_grid = PixelGrid(nx=npix, ny=npix, transform_pix2angle=0.1 * np.eye(2),
+                           ra_at_xy_0=-0.95, dec_at_xy_0=-0.95)
+    lens_image = LensImage(pixel_grid, PSF(psf_type='GAUSSIAN', fwhm=0.2, pixel_size=0.1),
+                           lens_mass_model_class=MassModel(['SIE', 'SHEAR']),
+                           source_model_class=LightModel(['PIXELATED'], kwargs_pixelated={'num_pixels': 8}),
+                           lens_light_model_class=LightModel(['SERSIC_ELLIPSE']))
+    kwargs_init = {
+        'kwargs_lens': [{'theta_E': 1., 'e1': 0.1, 'e2': -0.05, 'center_x': 0., 'center_y': 0.},
+                        {'gamma1': 0.01, 'gamma2': 0.02, 'ra_0': 0., 'dec_0': 0.}],
+        'kwargs_source': [{'pixels': 1e-3}],
+        'kwargs_lens_light': [{'amp': 5., 'R_sersic': 0.5, 'n_sersic': 3., 'e1': 0.1, 'e2': -0.05,
+                               'center_x': 0.01, 'center_y': -0.01}],
+    }
+    kwargs_fixed = {
+        'kwargs_lens': [{}, {'ra_0': 0., 'dec_0': 0.}],
+        'kwargs_source': [{}],
+        'kwargs_lens_light': [{}],
+    }
+    kwargs_prior = {
+        'kwargs_lens': [{'theta_E': ['gaussian', 1., 0.1], 'e1': ['uniform', -0.3, 0.3]},
+                        {'gamma1': ['gaussian', 0., 0.05]}],
+        'kwargs_source': [{'pixels': ['uniform', 0., 1.]}],
+        'kwargs_lens_light': [{'n_sersic': ['uniform', 0.5, 8.]}],
+    }
+    kwargs_joint = {
+        'lens_with_lens_light': [[(0, 0), ['center_x', 'center_y']]],
+    }
+    return Parameters(lens_image, kwargs_init, kwargs_fixed,
+                      kwargs_prior=kwargs_prior, kwargs_joint=kwargs_joint)
+
+
+def test_args_kwargs_roundtrip(parameters):
+    # SIE (3 free, centers joint) + SHEAR (2) + 8x8 pixels + SERSIC_ELLIPSE (7)
+    assert parameters.num_parameters == 3 + 2 + 64 + 7
+    args = parameters.initial_values()
+    kwargs = parameters.args2kwargs(args)
+    assert kwargs['kwargs_source'][0]['pixels'].shape == (8, 8)
+    npt.assert_allclose(kwargs['kwargs_source'][0]['pixels'], 1e-3)
+    assert kwargs['kwargs_lens'][1]['ra_0'] == 0.
+    # joint parameters
+    assert kwargs['kwargs_lens'][0]['center_x'] == kwargs['kwargs_lens_light'][0]['center_x'] == 0.01
+    npt.assert_array_equal(parameters.kwargs2args(kwargs), args)
+    # the conversion is traceable
+    args_new = args + 0.1
+    kwargs_jit = jax.jit(parameters.args2kwargs)(args_new)
+    npt.assert_allclose(jax.jit(parameters.kwargs2args)(kwargs_jit), args_new)
+
+
+def test_log_prior(parameters):
+    rng = np.random.default_rng(0)
+    args = parameters.initial_values() + rng.normal(scale=0.5, size=parameters.num_parameters)
+    npt.assert_allclose(parameters.log_prior(args), parameters.log_prior_nojit(np.asarray(args)))
+    # a parameter vector within the bounds
+    args_in = parameters.apply_bounds(args)
+    npt.assert_allclose(parameters.log_prior_uniform(args_in), 0.)
+    npt.assert_allclose(parameters.log_prior(args_in), parameters.log_prior_gaussian(args_in))
+    expected_gaussian = - 0.5 * ((args[0] - 1.) / 0.1)**2 - 0.5 * (args[3] / 0.05)**2
+    npt.assert_allclose(parameters.log_prior_gaussian(args), expected_gaussian)
+    lowers, uppers = parameters.bounds
+    expected_uniform = - np.sum((args - np.clip(args, lowers, uppers))**2)
+    npt.assert_allclose(parameters.log_prior_uniform(args), expected_uniform)
+    # gradients are finite everywhere, and only non-zero for parameters with a prior
+    grad = jax.grad(parameters.log_prior_gaussian)(args)
+    assert np.all(np.isfinite(grad))
+    assert np.count_nonzero(grad) == 2
@@ -0,0 +1,101 @@
+# Testing the sensitivity mapping
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax
+import jax.numpy as jnp
+import numpyro
+import numpyro.distributions as dist
+
+from herculens.Coordinates.pixel_grid import PixelGrid
+from herculens.Instrument.psf import PSF
+from herculens.MassModel.mass_model import MassModel
+from herculens.LightModel.light_model import LightModel
+from herculens.LensImage.lens_image import LensImage
+from herculens.Inference.ProbModel.numpyro import NumpyroModel
+from herculens.Inference.sensitivity_mapping import SensitivityMapping
+
+
+npix = 30
+pixel_grid = PixelGrid(nx=npix, ny=npix, transform_pix2angle=0.1 * np.eye(2),
+                       ra_at_xy_0=-1.45, dec_at_xy_0=-1.45)
+lens_image = LensImage(pixel_grid, PSF(psf_type='GAUSSIAN', fwhm=0.2, pixel_size=0.1),
+                       lens_mass_model_class=MassModel(['SIE', 'SIS']),
+                       source_model_class=LightModel(['SERSIC_ELLIPSE']))
+kwargs_source = [{'amp': 10., 'R_sersic': 0.2, 'n_sersic': 1., 'e1': 0.1, 'e2': 0.,
+                  'center_x': 0.05, 'center_y': 0.}]
+true_perturber = {'theta_E': 0.1, 'center_x': 0.75, 'center_y': -0.45}
+sigma = 0.05
+data = lens_image.model(
+    kwargs_lens=[{'theta_E': 1., 'e1': 0.05, 'e2': 0., 'center_x': 0., 'center_y': 0.}, true_perturber],
+    kwargs_source=kwargs_source)
+
+
+class PerturbedModel(NumpyroModel):
+
+    def model(self):
+        theta_E = numpyro.sample('lens_theta_E', dist.Normal(1., 0.1))
+        e1 = numpyro.sample('lens_e1', dist.Normal(0., 0.1))
+        mass = numpyro.sample('perturber_theta_E', dist.Normal(0., 0.5))
+        x = numpyro.sample('perturber_center_x', dist.Uniform(-1.5, 1.5))
+        y = numpyro.sample('perturber_center_y', dist.Uniform(-1.5, 1.5))
+        kwargs_lens = [{'theta_E': theta_E, 'e1': e1, 'e2': 0., 'center_x': 0., 'center_y': 0.},
+                       {'theta_E': mass, 'center_x': x, 'center_y': y}]
+        model = lens_image.model(kwargs_lens=kwargs_lens, kwargs_source=kwargs_source)
+        numpyro.sample('obs', dist.Normal(model, sigma), obs=data)
+
+
+@pytest.fixture
+def mapping():
+    params = {'lens_theta_E': 1., 'lens_e1': 0.05}
+    return SensitivityMapping(PerturbedModel(), params)
+
+
+def test_gradient_map_chunks(mapping):
+    x_grid, y_grid = pixel_grid.pixel_coordinates
+    x_grid, y_grid = x_grid[::3, ::3], y_grid[::3, ::3]
+    sens_map, extrema, runtime = mapping.sensitivity_map(x_grid, y_grid, method='gradient', chunk_size=7)
+    assert sens_map.shape == x_grid.shape
+    sens_map_1, _, _ = mapping.sensitivity_map(x_grid, y_grid, method='gradient', chunk_size=1000)
+    npt.assert_allclose(sens_map, sens_map_1, rtol=1e-5, atol=1e-5)
+    # compare with a direct evaluation
+    i, j = 4, 7
+    params = {'lens_theta_E': 1., 'lens_e1': 0.05, 'perturber_center_x': x_grid[i, j],
+              'perturber_center_y': y_grid[i, j], 'perturber_theta_E': 0.}
+    grad_mass = jax.grad(lambda m: mapping.loss({**params, 'perturber_theta_E': m}))(0.)
+    npt.assert_allclose(sens_map[i, j], grad_mass, rtol=1e-4)
+    x_min, y_min, z_min = extrema
+    assert np.all(z_min < 0)
+
+
+def test_delta_loss_and_fisher(mapping):
+    x_grid, y_grid = pixel_grid.pixel_coordinates
+    x_grid, y_grid = x_grid[1::3, 1::3], y_grid[1::3, 1::3]
+    sens_map, (x_min, y_min, z_min), _ = mapping.sensitivity_map(
+        x_grid, y_grid, method='delta_loss', test_mass=0.1, chunk_size=16)
+    i, j = np.unravel_index(np.argmin(sens_map), sens_map.shape)
+    npt.assert_allclose([x_grid[i, j], y_grid[i, j]],
+                        [true_perturber['center_x'], true_perturber['center_y']], atol=0.01)
+    assert sens_map[i, j] < 0
+
+    fisher_map, _, _ = mapping.sensitivity_map(x_grid, y_grid, method='fisher', chunk_size=16)
+    fisher_map_marg, _, _ = mapping.sensitivity_map(x_grid, y_grid, method='fisher', chunk_size=16,
+                                                    marginalize_keys=['lens_theta_E', 'lens_e1'])
+    assert np.all(fisher_map > 0)
+    # marginalizing over the macro model can only reduce the information on the perturber mass
+    assert np.all(fisher_map_marg <= fisher_map * (1. + 1e-4))
+    assert np.any(fisher_map_marg < 0.99 * fisher_map)
+
+
+def test_errors(mapping):
+    x_grid, y_grid = pixel_grid.pixel_coordinates
+    with pytest.raises(ValueError):
+        mapping.sensitivity_map(x_grid, y_grid, method='unknown')
+    with pytest.raises(ValueError):
+        mapping.sensitivity_map(x_grid, y_grid, method='delta_loss')
+    with pytest.raises(ValueError):
+        mapping.sensitivity_map(x_grid, y_grid[:-1])
@@ -1,5 +1,6 @@
 import unittest
 import numpy as np
+import numpy.testing as npt
 import jax.numpy as jnp
 from jax import random
 
@@ -45,6 +46,79 @@ class TestNoise(unittest.TestCase):
         realisation = noise.realisation(model, self.prng_key)
         self.assertEqual(realisation.shape, (self.nx, self.ny))
 
+    def test_realisations(self):
+        noise = Noise(self.nx, self.ny, exposure_time=self.exposure_time, background_rms=self.background_rms)
+        model = jnp.ones((self.nx, self.ny))
+        realisations = noise.realisations(model, self.prng_key, 2000)
+        self.assertEqual(realisations.shape, (2000, self.nx, self.ny))
+        npt.assert_allclose(jnp.var(realisations, axis=0).mean(), noise.C_D_model(model).mean(), rtol=0.05)
+        # a single realisation is the same as with the unbatched method
+        keys = random.split(self.prng_key, 2000)
+        npt.assert_allclose(realisations[1], noise.realisation(model, keys[1]), rtol=1e-5, atol=1e-6)
+
+    def test_realisations_batched_exposure_and_model(self):
+        noise = Noise(self.nx, self.ny, exposure_time=self.exposure_time, background_rms=self.background_rms)
+        models = jnp.stack([jnp.zeros((self.nx, self.ny)), 100. * jnp.ones((self.nx, self.ny))])
+        exposure_maps = jnp.stack([jnp.ones((self.nx, self.ny)), 1e6 * jnp.ones((self.nx, self.ny))])
+        realisations = noise.realisations(models, self.prng_key, 2, add_background=False, exposure_map=exposure_maps)
+        npt.assert_allclose(realisations[0], 0.)
+        self.assertTrue(0. < jnp.std(realisations[1]) < 0.1)
+
+    def test_realisations_correlated_background(self):
+        # power spectrum of a smoothing kernel, normalized to the background variance
+        kx = np.fft.fftfreq(self.nx)
+        power_spectrum = np.exp(- (kx[:, None]**2 + kx[None, :]**2) / 0.05)
+        power_spectrum *= self.background_rms**2 / power_spectrum.mean()
+        noise = Noise(self.nx, self.ny, exposure_time=self.exposure_time, 
+                      background_rms=self.background_rms, background_power_spectrum=power_spectrum)
+        realisations = noise.realisations(jnp.zeros((self.nx, self.ny)), self.prng_key, 4000, add_poisson_model=False)
+        npt.assert_allclose(jnp.var(realisations), self.background_rms**2, rtol=0.05)
+        # neighbouring pixels are correlated
+        corr = jnp.mean(realisations[:, :, 1:] * realisations[:, :, :-1]) / jnp.var(realisations)
+        self.assertGreater(corr, 0.5)
+
+    def test_correlated_log_likelihood(self):
+        kernel = np.array([[0.05, 0.2, 0.05], [0.2, 1., 0.2], [0.05, 0.2, 0.05]])
+        noise = Noise(self.nx, self.ny, exposure_time=self.exposure_time, 
+                      background_rms=self.background_rms, correlation_kernel=kernel)
+        rng = np.random.default_rng(0)
+        model = np.abs(rng.normal(size=(self.nx, self.ny)))
+        data = model + self.background_rms * rng.normal(size=(self.nx, self.ny))
+        # dense covariance matrix
+        num_pix = self.nx * self.ny
+        spectrum = Noise.correlation_spectrum_from_kernel(kernel, (self.nx, self.ny))
+        corr = np.array([np.fft.ifft2(spectrum * np.fft.fft2(e.reshape(self.nx, self.ny))).real.ravel() 
+                         for e in np.eye(num_pix)])
+        std = np.sqrt(np.array(noise.C_D_model(model))).ravel()
+        cov = std[:, None] * corr * std[None, :]
+        res = (data - model).ravel()
+        _, log_det = np.linalg.slogdet(cov)
+        log_like = - 0.5 * (res @ np.linalg.solve(cov, res) + log_det + num_pix * np.log(2. * np.pi))
+        npt.assert_allclose(noise.log_likelihood(data, model), log_like, rtol=1e-4)
+        # masked pixels: the chi-square is exact
+        mask = np.ones((self.nx, self.ny))
+        mask[3:6, 4:8] = 0.
+        inside = mask.ravel() > 0
+        chi2 = res[inside] @ np.linalg.solve(cov[np.ix_(inside, inside)], res[inside])
+        whitened = noise.whitened_residuals(data, model, mask=mask, cg_tol=1e-8)
+        npt.assert_allclose(jnp.sum(whitened**2), chi2, rtol=1e-3)
+
+    def test_uncorrelated_log_likelihood(self):
+        noise = Noise(self.nx, self.ny, exposure_time=self.exposure_time, background_rms=self.background_rms)
+        model = jnp.ones((self.nx, self.ny))
+        data = model + 0.1
+        var = noise.C_D_model(model)
+        log_like = - 0.5 * jnp.sum((data - model)**2 / var + jnp.log(2. * np.pi * var))
+        npt.assert_allclose(noise.log_likelihood(data, model), log_like, rtol=1e-5)
+        self.assertFalse(noise.is_correlated)
+
+    def test_correlation_kernel_errors(self):
+        with self.assertRaises(ValueError):
+            Noise(self.nx, self.ny, exposure_time=self.exposure_time, correlation_kernel=np.ones((2, 2)))
+        with self.assertRaises(ValueError):
+            # not positive definite
+            Noise(self.nx, self.ny, exposure_time=self.exposure_time, correlation_kernel=np.ones((3, 3)))
+
     def test_variance_boost_map_property(self):
         noise = Noise(self.nx, self.ny, exposure_time=self.exposure_time)
         noise.variance_boost_map = self.variance_boost_map
@@ -0,0 +1,80 @@
+# Testing the multi-plane LensImage
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax
+import jax.numpy as jnp
+
+from herculens.Coordinates.pixel_grid import PixelGrid
+from herculens.Instrument.psf import PSF
+from herculens.Instrument.noise import Noise
+from herculens.MassModel.mass_model import MassModel
+from herculens.MassModel.mass_model_multiplane import MPMassModel
+from herculens.LightModel.light_model_multiplane import MPLightModel
+from herculens.LensImage.lens_image_multiplane import MPLensImage
+
+
+@pytest.fixture
+def mp_lens_image():
+    npix, pix_scl = 20, 0.2
+    half_size = npix * pix_scl / 2.
+    pixel_grid = PixelGrid(
+        nx=npix, ny=npix, transform_pix2angle=pix_scl * np.eye(2),
+        ra_at_xy_0=-half_size + pix_scl / 2., dec_at_xy_0=-half_size + pix_scl / 2.,
+    )
+    psf = PSF(psf_type='GAUSSIAN', fwhm=0.3, pixel_size=pix_scl)
+    noise = Noise(npix, npix, background_rms=1e-2, exposure_time=1000.)
+    mass_model = MPMassModel([MassModel(['SIE']), MassModel(['SIS'])])
+    light_model = MPLightModel([['SERSIC_ELLIPSE']] * 3, [{}] * 3)
+    lens_image = MPLensImage(
+        pixel_grid, psf, noise, mass_model, light_model,
+        kwargs_numerics={'supersampling_factor': 2},
+    )
+    kwargs_sersic = {'amp': 5., 'R_sersic': 0.3, 'n_sersic': 2., 'e1': 0., 'e2': 0.1, 
+                     'center_x': 0.05, 'center_y': 0.1}
+    kwargs_light = [[kwargs_sersic]] * 3
+    kwargs_mass = [
+        [{'theta_E': 1., 'e1': 0.1, 'e2': 0., 'center_x': 0., 'center_y': 0.}],
+        [{'theta_E': 0.3, 'center_x': 0.1, 'center_y': -0.1}],
+    ]
+    eta_flat = jnp.array([0.8])
+    return lens_image, eta_flat, kwargs_mass, kwargs_light
+
+
+def test_model_incremental(mp_lens_image):
+    lens_image, eta_flat, kwargs_mass, kwargs_light = mp_lens_image
+    model_ref = lens_image.model(eta_flat=eta_flat, kwargs_mass=kwargs_mass, kwargs_light=kwargs_light)
+    model = lens_image.model_incremental(eta_flat=eta_flat, kwargs_mass=kwargs_mass, kwargs_light=kwargs_light)
+    npt.assert_allclose(model, model_ref, rtol=1e-5, atol=1e-8)
+    ra_steps_front = lens_image._ray_cache['ra_steps'][1]
+
+    # change only the back mass plane: the front plane positions are re-used
+    kwargs_mass_new = [kwargs_mass[0], [{'theta_E': 0.5, 'center_x': 0.1, 'center_y': -0.1}]]
+    model_ref = lens_image.model(eta_flat=eta_flat, kwargs_mass=kwargs_mass_new, kwargs_light=kwargs_light)
+    model = lens_image.model_incremental(eta_flat=eta_flat, kwargs_mass=kwargs_mass_new, kwargs_light=kwargs_light)
+    npt.assert_allclose(model, model_ref, rtol=1e-5, atol=1e-8)
+    assert lens_image._ray_cache['ra_steps'][1] is ra_steps_front
+
+    # change the front mass plane: everything is re-traced
+    kwargs_mass_new = [[dict(kwargs_mass[0][0], theta_E=1.2)], kwargs_mass_new[1]]
+    model_ref = lens_image.model(eta_flat=eta_flat, kwargs_mass=kwargs_mass_new, kwargs_light=kwargs_light)
+    model = lens_image.model_incremental(eta_flat=eta_flat, kwargs_mass=kwargs_mass_new, kwargs_light=kwargs_light)
+    npt.assert_allclose(model, model_ref, rtol=1e-5, atol=1e-8)
+    assert lens_image._ray_cache['ra_steps'][1] is not ra_steps_front
+
+    lens_image.clear_ray_cache()
+    assert lens_image._ray_cache is None
+
+
+def test_simulation(mp_lens_image):
+    lens_image, eta_flat, kwargs_mass, kwargs_light = mp_lens_image
+    model = lens_image.model(eta_flat=eta_flat, kwargs_mass=kwargs_mass, kwargs_light=kwargs_light)
+    simu = lens_image.simulation(noise_seed=3, eta_flat=eta_flat, kwargs_mass=kwargs_mass, kwargs_light=kwargs_light)
+    assert simu.shape == model.shape
+    assert not np.allclose(simu, model)
+    simu_same = lens_image.simulation(noise_seed=3, eta_flat=eta_flat, kwargs_mass=kwargs_mass, kwargs_light=kwargs_light)
+    npt.assert_allclose(simu, simu_same)
@@ -0,0 +1,104 @@
+# Testing the LensImageStack class
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax
+
+from herculens.Coordinates.pixel_grid import PixelGrid
+from herculens.Instrument.psf import PSF
+from herculens.Instrument.noise import Noise
+from herculens.MassModel.mass_model import MassModel
+from herculens.LightModel.light_model import LightModel
+from herculens.LensImage.lens_image import LensImage
+from herculens.LensImage.lens_image_stack import LensImageStack
+
+
+NPIX, PIX_SCL, SUPERSAMPLING = 24, 0.1, 2
+
+
+def _lens_image(psf, offset=(0., 0.)):
+    half_size = NPIX * PIX_SCL / 2.
+    pixel_grid = PixelGrid(
+        nx=NPIX, ny=NPIX, transform_pix2angle=PIX_SCL * np.eye(2),
+        ra_at_xy_0=-half_size + PIX_SCL / 2. + offset[0], 
+        dec_at_xy_0=-half_size + PIX_SCL / 2. + offset[1],
+    )
+    noise = Noise(NPIX, NPIX, background_rms=1e-2, exposure_time=1000.)
+    return LensImage(
+        pixel_grid, psf, noise_class=noise,
+        lens_mass_model_class=MassModel(['SIE']),
+        source_model_class=LightModel(['SERSIC_ELLIPSE']),
+        lens_light_model_class=LightModel(['SERSIC']),
+        kwargs_numerics={'supersampling_factor': SUPERSAMPLING},
+    )
+
+
+def _pixel_psf(size, sigma):
+    x = np.arange(size) - size // 2
+    kernel = np.exp(-(x[:, None]**2 + x[None, :]**2) / (2. * sigma**2))
+    return PSF(psf_type='PIXEL', kernel_point_source=kernel / kernel.sum())
+
+
+KWARGS_MODEL = dict(
+    kwargs_lens=[{'theta_E': 0.7, 'e1': 0.05, 'e2': -0.03, 'center_x': 0., 'center_y': 0.}],
+    kwargs_source=[{'amp': 5., 'R_sersic': 0.15, 'n_sersic': 1.5, 'e1': 0.1, 'e2': 0.,
+                    'center_x': 0.05, 'center_y': -0.02}],
+    kwargs_lens_light=[{'amp': 2., 'R_sersic': 0.4, 'n_sersic': 3., 'center_x': 0., 'center_y': 0.}],
+)
+
+
+def test_model_matches_shifted_lens_images():
+    # offsets that are multiples of the supersampled pixel size are exactly interpolated
+    sub_pix = PIX_SCL / SUPERSAMPLING
+    offsets = np.array([[0., 0.], [sub_pix, 0.], [-sub_pix, 2*sub_pix]])
+    psf_list = [_pixel_psf(7, 1.), _pixel_psf(9, 1.3), _pixel_psf(5, 0.7)]
+    stack = LensImageStack(_lens_image(psf_list[0]), offsets, psf_list=psf_list)
+    model = stack.model(**KWARGS_MODEL)
+    assert model.shape == (3, NPIX, NPIX)
+    for i in range(3):
+        model_ref = _lens_image(psf_list[i], offset=offsets[i]).model(**KWARGS_MODEL)
+        # boundary pixels are affected by the edges of the supersampled grid
+        npt.assert_allclose(model[i][4:-4, 4:-4], model_ref[4:-4, 4:-4], rtol=1e-4, atol=1e-5)
+
+
+def test_gaussian_psf():
+    offsets = np.array([[0., 0.], [PIX_SCL / SUPERSAMPLING, 0.]])
+    psf_gaussian = PSF(psf_type='GAUSSIAN', fwhm=0.2, pixel_size=PIX_SCL)
+    stack = LensImageStack(_lens_image(psf_gaussian), offsets, psf_list=[psf_gaussian, PSF(psf_type='NONE')])
+    kernel = stack._conv.kernel_cube[0]
+    assert kernel.shape[0] % 2 == 1
+    npt.assert_allclose(kernel.sum(), 1., rtol=1e-6)
+    model = stack.model(**KWARGS_MODEL)
+    # the Gaussian PSF is convolved as a pixelated kernel, equivalent to the Gaussian convolution of LensImage
+    model_ref = _lens_image(psf_gaussian).model(**KWARGS_MODEL)
+    npt.assert_allclose(model[0][4:-4, 4:-4], model_ref[4:-4, 4:-4], atol=1e-4 * model_ref.max())
+    model_ref = _lens_image(PSF(psf_type='NONE'), offset=offsets[1]).model(**KWARGS_MODEL)
+    npt.assert_allclose(model[1][4:-4, 4:-4], model_ref[4:-4, 4:-4], rtol=1e-4, atol=1e-5)
+
+
+def test_log_likelihood():
+    offsets = np.array([[0., 0.], [0.03, -0.02]])
+    stack = LensImageStack(_lens_image(_pixel_psf(7, 1.)), offsets)
+    data = stack.simulation(jax.random.PRNGKey(0), **KWARGS_MODEL)
+    model = stack.model(**KWARGS_MODEL)
+    log_like = stack.log_likelihood(data, model)
+    assert np.isfinite(log_like)
+    assert 0.5 < stack.reduced_chi2(data, model) < 2.
+    # likelihood is differentiable with respect to exposure offsets
+    grad = jax.grad(lambda o: stack.log_likelihood(data, stack.model(**KWARGS_MODEL, exposure_offsets=o)))(offsets)
+    assert np.all(np.isfinite(grad))
+
+
+def test_raise():
+    with pytest.raises(ValueError):
+        LensImageStack(_lens_image(_pixel_psf(7, 1.)), np.zeros((2, 3)))
+    with pytest.raises(ValueError):
+        LensImageStack(_lens_image(_pixel_psf(7, 1.)), np.zeros((2, 2)), psf_list=[_pixel_psf(7, 1.)])
+    psf = _pixel_psf(7, 1.)
+    psf.psf_type = 'UNKNOWN'
+    with pytest.raises(ValueError):
+        LensImageStack(_lens_image(_pixel_psf(7, 1.)), np.zeros((1, 2)), psf_list=[psf])
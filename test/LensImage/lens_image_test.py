@@ -0,0 +1,112 @@
+# Testing the LensImage3D class
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from herculens.Coordinates.pixel_grid import PixelGrid
+from herculens.Instrument.psf import PSF
+from herculens.Instrument.noise import Noise
+from herculens.MassModel.mass_model import MassModel
+from herculens.LightModel.light_model import LightModel
+from herculens.LensImage.lens_image import LensImage, LensImage3D
+
+
+def _setup_lens_image(psf):
+    npix, pix_scl = 24, 0.1
+    half_size = npix * pix_scl / 2.
+    pixel_grid = PixelGrid(
+        nx=npix, ny=npix, transform_pix2angle=pix_scl * np.eye(2),
+        ra_at_xy_0=-half_size + pix_scl / 2., dec_at_xy_0=-half_size + pix_scl / 2.,
+    )
+    noise = Noise(npix, npix, background_rms=1e-2, exposure_time=1000.)
+    return LensImage(
+        pixel_grid, psf, noise_class=noise,
+        lens_mass_model_class=MassModel(['SIE', 'SHEAR']),
+        source_model_class=LightModel(['SERSIC_ELLIPSE']),
+        lens_light_model_class=LightModel(['SERSIC']),
+        kwargs_numerics={'supersampling_factor': 2},
+    )
+
+
+def _pixel_kernel(size, sigma):
+    x = np.arange(size) - size // 2
+    kernel = np.exp(-(x[:, None]**2 + x[None, :]**2) / (2. * sigma**2))
+    return kernel / kernel.sum()
+
+
+@pytest.mark.parametrize("psf_type", ['PIXEL', 'GAUSSIAN'])
+def test_shared_grid_model(psf_type):
+    if psf_type == 'PIXEL':
+        psf_list = [PSF(psf_type='PIXEL', kernel_point_source=_pixel_kernel(size, sigma)) 
+                    for size, sigma in [(7, 1.), (11, 1.5), (5, 0.8)]]
+    else:
+        psf_list = [PSF(psf_type='GAUSSIAN', fwhm=fwhm, pixel_size=0.1)
+                    for fwhm in [0.2, 0.3, 0.15]]
+    lens_image_list = [_setup_lens_image(psf) for psf in psf_list]
+    lens_image_3d = LensImage3D(lens_image_list, mode='stack')
+    lens_image_3d_loop = LensImage3D(lens_image_list, mode='stack', share_grid=False)
+    assert lens_image_3d.shared_grid
+    assert not lens_image_3d_loop.shared_grid
+
+    kwargs_lens = [{'theta_E': 0.8, 'e1': 0.05, 'e2': -0.03, 'center_x': 0., 'center_y': 0.},
+                   {'gamma1': 0.02, 'gamma2': -0.01, 'ra_0': 0., 'dec_0': 0.}]
+    kwargs_source_list = [[{'amp': amp, 'R_sersic': 0.2, 'n_sersic': 1.5, 'e1': 0.1, 'e2': 0.,
+                            'center_x': 0.05, 'center_y': -0.02}] for amp in [5., 8., 3.]]
+    kwargs_lens_light_list = [[{'amp': amp, 'R_sersic': 0.5, 'n_sersic': 3., 
+                                'center_x': 0., 'center_y': 0.}] for amp in [2., 4., 6.]]
+    model = lens_image_3d.model(kwargs_lens=kwargs_lens, kwargs_source_list=kwargs_source_list,
+                                kwargs_lens_light_list=kwargs_lens_light_list)
+    model_loop = lens_image_3d_loop.model(kwargs_lens=kwargs_lens, kwargs_source_list=kwargs_source_list,
+                                          kwargs_lens_light_list=kwargs_lens_light_list)
+    assert model.shape == (3, 24, 24)
+    npt.assert_allclose(model, model_loop, rtol=1e-4, atol=1e-5)
+    for i, lens_image in enumerate(lens_image_list):
+        model_sgl = lens_image.model(kwargs_lens=kwargs_lens, kwargs_source=kwargs_source_list[i],
+                                     kwargs_lens_light=kwargs_lens_light_list[i])
+        npt.assert_allclose(model[i], model_sgl, rtol=1e-4, atol=1e-5)
+
+
+def test_no_shared_grid():
+    psf = PSF(psf_type='GAUSSIAN', fwhm=0.2, pixel_size=0.1)
+    lens_image_list = [_setup_lens_image(psf), _setup_lens_image(psf)]
+    lens_image_list[1] = LensImage(
+        lens_image_list[0].Grid, psf, noise_class=lens_image_list[0].Noise,
+        lens_mass_model_class=MassModel(['SIE', 'SHEAR']),
+        source_model_class=LightModel(['SERSIC_ELLIPSE']),
+        lens_light_model_class=LightModel(['SERSIC']),
+        kwargs_numerics={'supersampling_factor': 3},
+    )
+    assert not LensImage3D(lens_image_list).shared_grid
+    with pytest.raises(ValueError):
+        LensImage3D(lens_image_list, share_grid=True)
+    # same shape and supersampling, but shifted pixel coordinates
+    pixel_grid = lens_image_list[0].Grid
+    shifted_grid = PixelGrid(nx=24, ny=24, transform_pix2angle=0.1 * np.eye(2),
+                             ra_at_xy_0=pixel_grid.pixel_coordinates[0][0, 0] + 0.05,
+                             dec_at_xy_0=pixel_grid.pixel_coordinates[1][0, 0])
+    lens_image_list[1] = LensImage(
+        shifted_grid, psf, noise_class=lens_image_list[0].Noise,
+        lens_mass_model_class=MassModel(['SIE', 'SHEAR']),
+        source_model_class=LightModel(['SERSIC_ELLIPSE']),
+        lens_light_model_class=LightModel(['SERSIC']),
+        kwargs_numerics={'supersampling_factor': 2},
+    )
+    assert not LensImage3D(lens_image_list).shared_grid
+    with pytest.raises(ValueError, match="different coordinates"):
+        LensImage3D(lens_image_list, share_grid=True)
+
+
+def test_stack_kernels_mixed_sizes():
+    from scipy.signal import fftconvolve
+    from herculens.LensImage.Numerics.convolution import BatchedPixelKernelConvolution
+    kernel_list = [_pixel_kernel(size, 1.) for size in (4, 7, 6)] + [np.random.RandomState(0).rand(5, 4)]
+    kernel_cube = BatchedPixelKernelConvolution.stack_kernels(kernel_list)
+    assert kernel_cube.shape == (4, 7, 7)
+    image_cube = np.random.RandomState(1).rand(4, 20, 20)
+    conv = BatchedPixelKernelConvolution(kernel_list, (20, 20))
+    image_conv = conv.convolution2d(image_cube)
+    for i, kernel in enumerate(kernel_list):
+        npt.assert_allclose(image_conv[i], fftconvolve(image_cube[i], kernel, mode='same'), atol=1e-5)
@@ -0,0 +1,57 @@
+# This file provides unit tests for the herculens MPMassModel class.
+
+import pytest
+import numpy as np
+import numpy.testing as npt
+import jax
+import jax.numpy as jnp
+
+from herculens.MassModel.mass_model import MassModel
+from herculens.MassModel.mass_model_multiplane import MPMassModel
+
+jax.config.update("jax_enable_x64", True)
+
+
+@pytest.fixture
+def mp_setup():
+    x, y = np.meshgrid(np.linspace(-2., 2., 7), np.linspace(-2., 2., 6))
+    profile_lists = [['SIE'], ['SIE', 'SHEAR'], ['SIS']]
+    kwargs_mass = [
+        [{'theta_E': 1., 'e1': 0.1, 'e2': 0., 'center_x': 0., 'center_y': 0.}],
+        [{'theta_E': 0.5, 'e1': 0., 'e2': 0.1, 'center_x': 0.1, 'center_y': 0.}, 
+         {'gamma1': 0.02, 'gamma2': -0.01}],
+        [{'theta_E': 0.3, 'center_x': -0.1, 'center_y': 0.2}],
+    ]
+    eta_flat = jnp.array([0.8, 0.7, 0.9])
+    return (x.ravel(), y.ravel()), profile_lists, kwargs_mass, eta_flat
+
+
+@pytest.mark.parametrize("N", [None, 2])
+def test_ray_shooting_scan(mp_setup, N):
+    (x, y), profile_lists, kwargs_mass, eta_flat = mp_setup
+    mp_mass_loop = MPMassModel([MassModel(p) for p in profile_lists], scan_planes=False)
+    mp_mass_scan = MPMassModel([MassModel(p) for p in profile_lists], scan_planes=True)
+    xs_loop, ys_loop = mp_mass_loop.ray_shooting(x, y, eta_flat, kwargs_mass, N=N)
+    xs_scan, ys_scan = mp_mass_scan.ray_shooting(x, y, eta_flat, kwargs_mass, N=N)
+    num_planes = 4 if N is None else N + 1
+    assert xs_scan.shape == (num_planes, x.size)
+    npt.assert_allclose(xs_scan, xs_loop, rtol=1e-10, atol=1e-10)
+    npt.assert_allclose(ys_scan, ys_loop, rtol=1e-10, atol=1e-10)
+    # the image plane is left untouched
+    npt.assert_allclose(xs_scan[0], x, rtol=1e-6)
+
+
+def test_distortion_matrix(mp_setup):
+    (x, y), profile_lists, kwargs_mass, eta_flat = mp_setup
+    mp_mass = MPMassModel([MassModel(p) for p in profile_lists], scan_planes=True)
+    A_auto = mp_mass.A(x, y, eta_flat, kwargs_mass, kind='auto')
+    A_direct = mp_mass.A(x, y, eta_flat, kwargs_mass, kind='direct')
+    assert A_auto.shape == (4, x.size, 2, 2)
+    npt.assert_allclose(A_auto, A_direct, rtol=1e-4, atol=1e-4)
+    # image plane is the identity
+    npt.assert_allclose(A_auto[0], np.broadcast_to(np.eye(2), (x.size, 2, 2)), atol=1e-6)
+    # shape of the input coordinates is preserved
+    A_2d = mp_mass.A(x.reshape(6, 7), y.reshape(6, 7), eta_flat, kwargs_mass)
+    assert A_2d.shape == (4, 6, 7, 2, 2)
+    with pytest.raises(ValueError):
+        mp_mass.A(x, y, eta_flat, kwargs_mass, kind='unknown')
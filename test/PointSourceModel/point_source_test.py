@@ -0,0 +1,90 @@
+# Testing point source models
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import pytest
+import numpy as np
+import numpy.testing as npt
+import jax
+import jax.numpy as jnp
+
+from herculens.Coordinates.pixel_grid import PixelGrid
+from herculens.MassModel.mass_model import MassModel
+from herculens.PointSourceModel.point_source import PointSource
+
+
+pytest.importorskip("helens")
+
+
+@pytest.fixture
+def point_source():
+    npix, pix_scl = 40, 0.1
+    half_size = npix * pix_scl / 2
+    ra_at_xy_0 = dec_at_xy_0 = -half_size + pix_scl / 2
+    transform_pix2angle = pix_scl * np.eye(2)
+    pixel_grid = PixelGrid(npix, npix, transform_pix2angle, ra_at_xy_0, dec_at_xy_0)
+    mass_model = MassModel(['SIE'])
+    return PointSource('SOURCE_POSITION', mass_model, pixel_grid)
+
+
+def test_zero_amp_duplicated_images(point_source):
+    kwargs_solver = {'nsolutions': 5, 'niter': 5, 'scale_factor': 2, 'nsubdivisions': 1}
+    accuracy = point_source.solver.estimate_accuracy(5, 2, 1)
+    # image #2 is a duplicate of image #0, image #4 is an exact copy of image #3
+    # (the latter being close to the origin, which was problematic when rounding)
+    theta_x = jnp.array([0.8, -1.1, 0.8 + 0.3 * accuracy, 1e-4, 1e-4])
+    theta_y = jnp.array([0.3, -0.2, 0.3 - 0.2 * accuracy, -0.7, -0.7])
+    amp = jnp.array([1., 2., 3., 4., 5.])
+    amp_out, theta_x_out, theta_y_out = point_source._zero_amp_duplicated_images(
+        amp, theta_x, theta_y, kwargs_solver
+    )
+    # ordering is preserved
+    npt.assert_array_equal(theta_x_out, theta_x)
+    npt.assert_array_equal(theta_y_out, theta_y)
+    # first occurrences are kept, duplicates are turned off
+    npt.assert_allclose(amp_out[np.array([0, 1, 3])], amp[np.array([0, 1, 3])], rtol=1e-6)
+    npt.assert_allclose(amp_out[np.array([2, 4])], 0., atol=1e-2)
+
+
+def test_zero_amp_duplicated_images_is_differentiable(point_source):
+    theta_y = jnp.array([0.3, -0.2, 0.3])
+    amp = jnp.ones(3)
+    def total_amp(dx):
+        theta_x = jnp.array([0.8, -1.1, 0.8 + dx])
+        amp_out, _, _ = jax.jit(point_source._zero_amp_duplicated_images, static_argnums=(3,))(
+            amp, theta_x, theta_y, None
+        )
+        return amp_out.sum()
+    # the total amplitude varies smoothly from 2 to 3 as the third image moves away
+    values = jax.vmap(total_amp)(jnp.linspace(0., 0.5, 50))
+    assert values[0] == pytest.approx(2., abs=1e-3)
+    assert values[-1] == pytest.approx(3., abs=1e-3)
+    assert np.all(np.diff(values) >= 0.)
+    assert np.isfinite(jax.grad(total_amp)(0.02))
+
+
+def test_zero_amp_duplicated_images_close_pair(point_source):
+    # two genuine images separated by 0.05 arcsec, and a duplicate of the first one
+    theta_x = jnp.array([0.8, 0.85, 0.8 + 1e-5])
+    theta_y = jnp.array([0.3, 0.3, 0.3])
+    amp = jnp.array([1., 2., 3.])
+    # the damping factor of an image at distance d from an earlier one is 1 - exp(-(d / tolerance)**4)
+    for tolerance, factor in [(0.05, 1. - np.exp(-1.)), (0.05 / 1.5, 0.994), (0.02, 1.)]:
+        amp_out, _, _ = point_source._zero_amp_duplicated_images(amp, theta_x, theta_y, None, tolerance=tolerance)
+        npt.assert_allclose(amp_out[:2], [1., 2. * factor], rtol=1e-3)
+        npt.assert_allclose(amp_out[2], 0., atol=1e-6)
+    # the tolerance is a user-facing argument, also accepted from the solver settings
+    kwargs_point_source = {'ra': 0.05, 'dec': 0.02, 'amp': 1.}
+    kwargs_lens = [{'theta_E': 1., 'e1': 0.1, 'e2': 0.05, 'center_x': 0.01, 'center_y': 0.02}]
+    kwargs_solver = {'nsolutions': 5, 'niter': 5, 'scale_factor': 2, 'nsubdivisions': 1}
+    _, _, amp_default = point_source.image_positions_and_amplitudes(
+        kwargs_point_source, kwargs_lens=kwargs_lens, kwargs_solver=kwargs_solver)
+    _, _, amp_large = point_source.image_positions_and_amplitudes(
+        kwargs_point_source, kwargs_lens=kwargs_lens, kwargs_solver=kwargs_solver, duplicate_tolerance=5.)
+    _, _, amp_solver = point_source.image_positions_and_amplitudes(
+        kwargs_point_source, kwargs_lens=kwargs_lens, kwargs_solver={**kwargs_solver, 'duplicate_tolerance': 5.})
+    npt.assert_allclose(amp_solver, amp_large)
+    # a tolerance larger than the separation of the images turns off all but the first one
+    assert jnp.sum(amp_default > 0.05 * amp_default.max()) == 4
+    npt.assert_allclose(amp_large[0], amp_default[0])
+    assert np.all(amp_large[1:] < 0.1 * amp_default[1:])
@@ -0,0 +1,61 @@
+# Testing the finite-difference regularization operators
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax
+import jax.numpy as jnp
+
+from herculens.Coordinates.pixel_grid import PixelGrid
+from herculens.RegulModel.operators import DifferentialOperator
+
+
+jax.config.update("jax_enable_x64", True)
+
+
+@pytest.mark.parametrize("kind", ['gradient', 'curvature', 'hessian'])
+@pytest.mark.parametrize("boundary", ['valid', 'zero'])
+def test_operator_consistency(kind, boundary):
+    shape = (12, 15)
+    op = DifferentialOperator(shape, kind=kind, pixel_size=0.1, boundary=boundary)
+    pixels = jax.random.normal(jax.random.PRNGKey(0), shape)
+    coeffs = op.apply(pixels)
+    assert coeffs.shape == op.output_shape
+    # sparse matrix
+    D = op.to_bcoo().todense()
+    npt.assert_allclose(D @ pixels.ravel(), coeffs.ravel(), rtol=1e-10, atol=1e-10)
+    # transpose, quadratic form, gradient and diagonal preconditioner
+    npt.assert_allclose(op.transpose(coeffs).ravel(), D.T @ coeffs.ravel(), rtol=1e-10, atol=1e-10)
+    npt.assert_allclose(op.quadratic_form(pixels), 0.5 * np.sum(coeffs**2))
+    npt.assert_allclose(op.quadratic_form_gradient(pixels), jax.grad(op.quadratic_form)(pixels), rtol=1e-10)
+    npt.assert_allclose(op.diagonal().ravel(), np.diag(D.T @ D), rtol=1e-10)
+
+
+def test_derivatives():
+    pixel_grid = PixelGrid(nx=20, ny=20, transform_pix2angle=0.05 * np.eye(2),
+                           ra_at_xy_0=-0.475, dec_at_xy_0=-0.475)
+    x, y = pixel_grid.pixel_coordinates
+    psi = x**2 + 3. * y**2 + x * y
+    # central differences are exact for quadratic functions
+    grad = DifferentialOperator.from_pixel_grid(pixel_grid, kind='gradient').apply(psi)
+    npt.assert_allclose(grad[0], (2. * x + y)[1:-1, 1:-1], rtol=1e-10, atol=1e-10)
+    npt.assert_allclose(grad[1], (6. * y + x)[1:-1, 1:-1], rtol=1e-10, atol=1e-10)
+    laplacian = DifferentialOperator.from_pixel_grid(pixel_grid, kind='curvature').apply(psi)
+    npt.assert_allclose(laplacian, 8., rtol=1e-8)
+    hessian = DifferentialOperator.from_pixel_grid(pixel_grid, kind='hessian').apply(psi)
+    npt.assert_allclose(hessian[0], 2., rtol=1e-8)
+    npt.assert_allclose(hessian[1], 6., rtol=1e-8)
+    npt.assert_allclose(hessian[2], np.sqrt(2.), rtol=1e-8)
+
+
+def test_build_in_jit():
+    @jax.jit
+    def regularized_loss(pixels):
+        op = DifferentialOperator(pixels.shape, kind='curvature')
+        return op.quadratic_form(pixels) + jnp.sum(op.diagonal())
+    assert np.isfinite(regularized_loss(jnp.ones((10, 10))))
+    with pytest.raises(ValueError):
+        DifferentialOperator((10, 10), kind='unknown')
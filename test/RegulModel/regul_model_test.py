@@ -0,0 +1,110 @@
+# Testing the regularization models and the propagation of noise to their weights
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from herculens.Coordinates.pixel_grid import PixelGrid
+from herculens.Instrument.psf import PSF
+from herculens.Instrument.noise import Noise
+from herculens.MassModel.mass_model import MassModel
+from herculens.LightModel.light_model import LightModel
+from herculens.LensImage.lens_image import LensImage
+from herculens.RegulModel.regul_model import RegularizationModel
+from herculens.RegulModel import regul_util
+
+
+npix = 40
+pixel_grid = PixelGrid(nx=npix, ny=npix, transform_pix2angle=0.08 * np.eye(2),
+                       ra_at_xy_0=-1.56, dec_at_xy_0=-1.56)
+psf = PSF(psf_type='GAUSSIAN', fwhm=0.2, pixel_size=0.08)
+noise = Noise(npix, npix, background_rms=0.01, exposure_time=1000.)
+
+
+@pytest.fixture
+def source_setup():
+    lens_image = LensImage(pixel_grid, psf, noise_class=noise,
+                           lens_mass_model_class=MassModel(['SIE']),
+                           source_model_class=LightModel(['PIXELATED'], kwargs_pixelated={'num_pixels': 32}))
+    kwargs = {
+        'kwargs_lens': [{'theta_E': 1., 'e1': 0.1, 'e2': 0., 'center_x': 0., 'center_y': 0.}],
+        'kwargs_source': [{'pixels': 0.01 * np.ones((32, 32))}],
+    }
+    return lens_image, kwargs
+
+
+def test_analytic_noise_propagation_lens_light():
+    lens_image = LensImage(pixel_grid, psf, noise_class=noise,
+                           lens_light_model_class=LightModel(['PIXELATED'], kwargs_pixelated={'num_pixels': npix}))
+    kwargs = {'kwargs_lens_light': [{'pixels': 0.01 * np.ones((npix, npix))}]}
+    kwargs_weights = dict(model_type='lens_light', wavelet_type_list=['starlet'], 
+                          starlet_num_scales=3, sigma_clipping=False)
+    std_mc, _ = regul_util.data_noise_to_wavelet_light(lens_image, kwargs, num_samples=4000, **kwargs_weights)
+    std_an, _ = regul_util.data_noise_to_wavelet_light(lens_image, kwargs, method='analytic', **kwargs_weights)
+    assert std_an[0].shape == std_mc[0].shape == (4, npix, npix)
+    # without lensing, the analytic propagation is exact (away from the borders)
+    inner = (slice(None), slice(10, -10), slice(10, -10))
+    npt.assert_allclose(std_an[0][inner][:-1], std_mc[0][inner][:-1], rtol=0.1)
+
+
+def test_analytic_noise_propagation_with_refinement(source_setup):
+    lens_image, kwargs = source_setup
+    kwargs_weights = dict(wavelet_type_list=['starlet'], starlet_num_scales=3)
+    std_mc, _ = regul_util.data_noise_to_wavelet_light(lens_image, kwargs, num_samples=1000, **kwargs_weights)
+    std_an, _ = regul_util.data_noise_to_wavelet_light(lens_image, kwargs, method='analytic', 
+                                                       num_refinement_samples=200, **kwargs_weights)
+    for std_an_k, std_mc_k in zip(std_an[0][:-1], std_mc[0][:-1]):
+        valid = std_mc_k > 0.
+        npt.assert_allclose(np.median(std_an_k[valid] / std_mc_k[valid]), 1., atol=0.1)
+
+
+def test_cached_weights(source_setup):
+    lens_image, kwargs = source_setup
+    regul_model = RegularizationModel([('source', 0, 'SPARSITY_STARLET')])
+    regul_model.initialize(lens_image, kwargs, method='analytic')
+    weights = regul_model.get_weights()[0]
+    # small change of the lens model: weights are reused
+    kwargs['kwargs_lens'][0]['theta_E'] = 1. + 1e-4
+    regul_model.update_weights(lens_image, kwargs, cache_tolerance=1e-3, method='analytic')
+    assert regul_model.get_weights()[0] is weights
+    # different settings or larger change: weights are recomputed
+    regul_model.update_weights(lens_image, kwargs, cache_tolerance=1e-3, method='analytic', starlet_num_scales=3)
+    assert regul_model.get_weights()[0].shape[0] == 4
+    kwargs['kwargs_lens'][0]['theta_E'] = 1.1
+    weights = regul_model.get_weights()[0]
+    regul_model.update_weights(lens_image, kwargs, cache_tolerance=1e-3, method='analytic', starlet_num_scales=3)
+    assert regul_model.get_weights()[0] is not weights
+    assert not np.allclose(regul_model.get_weights()[0], weights)
+
+
+@pytest.mark.parametrize("kwargs_batch", [{'batch_size': 64}, {'memory_budget': 2e6}])
+def test_streaming_noise_propagation(source_setup, kwargs_batch):
+    lens_image, kwargs = source_setup
+    kwargs_weights = dict(wavelet_type_list=['starlet'], num_samples=300, seed=1)
+    std, _ = regul_util.data_noise_to_wavelet_light(lens_image, kwargs, **kwargs_weights)
+    std_stream, _ = regul_util.data_noise_to_wavelet_light(lens_image, kwargs, **kwargs_batch, **kwargs_weights)
+    npt.assert_allclose(std_stream[0], std[0], rtol=1e-4, atol=1e-6 * np.max(std[0]))
+    # deterministic
+    std_stream_2, _ = regul_util.data_noise_to_wavelet_light(lens_image, kwargs, **kwargs_batch, **kwargs_weights)
+    npt.assert_array_equal(std_stream_2[0], std_stream[0])
+
+
+def test_cached_weights_source_change(source_setup):
+    lens_image, kwargs = source_setup
+    regul_model = RegularizationModel([('source', 0, 'SPARSITY_STARLET')])
+    regul_model.initialize(lens_image, kwargs, method='analytic')
+    weights = regul_model.get_weights()[0]
+    # initialize() always recomputes the weights
+    regul_model.initialize(lens_image, kwargs, method='analytic')
+    assert regul_model.get_weights()[0] is not weights
+    npt.assert_allclose(regul_model.get_weights()[0], weights)
+    # only the source changes: the noise variance changes, hence the weights too
+    weights = regul_model.get_weights()[0]
+    kwargs['kwargs_source'][0]['pixels'] = 1e4 * kwargs['kwargs_source'][0]['pixels']
+    regul_model.update_weights(lens_image, kwargs, cache_tolerance=1e-3, method='analytic')
+    assert regul_model.get_weights()[0] is not weights
+    regul_model_ref = RegularizationModel([('source', 0, 'SPARSITY_STARLET')])
+    regul_model_ref.initialize(lens_image, kwargs, method='analytic')
+    npt.assert_allclose(regul_model.get_weights()[0], regul_model_ref.get_weights()[0])
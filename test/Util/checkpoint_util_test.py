@@ -0,0 +1,82 @@
+# Testing checkpointing of optimizers and samplers
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import os
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import jax
+import jax.numpy as jnp
+
+from herculens.Util.checkpoint_util import save_checkpoint, load_checkpoint, get_resume_path
+from herculens.Inference.loss import Loss
+from herculens.Inference.Optimization.optax import OptaxOptimizer
+from herculens.Inference.Optimization.jaxopt import JaxoptOptimizer
+from herculens.Inference.Sampling.sampling import Sampler
+
+
+class QuadraticModel(object):
+
+    def log_prob(self, args, constrained=False):
+        return - jnp.sum((args['x'] - jnp.array([1., -2., 0.5]))**2)
+
+
+def test_save_load(tmp_path):
+    path = str(tmp_path / 'ckpt.npz')
+    pytree = {'a': jnp.arange(3.), 'b': (jnp.ones((2, 2)), 5), 'key': jax.random.PRNGKey(1)}
+    save_checkpoint(path, pytree)
+    loaded = load_checkpoint(path, like=pytree)
+    for leaf, leaf_loaded in zip(jax.tree_util.tree_leaves(pytree), jax.tree_util.tree_leaves(loaded)):
+        npt.assert_array_equal(leaf, leaf_loaded)
+    assert os.listdir(tmp_path) == ['ckpt.npz']  # no leftover temporary file
+    with pytest.raises(ValueError):
+        load_checkpoint(path, like={'a': 0.})
+    assert get_resume_path(True, path) == path
+    assert get_resume_path(True, str(tmp_path / 'other.npz')) is None
+    assert get_resume_path(None, path) is None
+    with pytest.raises(FileNotFoundError):
+        get_resume_path(str(tmp_path / 'other.npz'), path)
+
+
+def test_optax_resume(tmp_path):
+    path = str(tmp_path / 'optax.npz')
+    optimizer = OptaxOptimizer(Loss(QuadraticModel()))
+    init_params = {'x': jnp.zeros(3)}
+    kwargs = dict(algorithm='adam', max_iterations=50, schedule_learning_rate=False,
+                  progress_bar=False, return_param_history=True)
+    best_fit, _, extra_fields, _ = optimizer.run(init_params, **kwargs)
+    # 'interrupted' run, then resumed one
+    optimizer.run(init_params, checkpoint_path=path, checkpoint_every=10, **dict(kwargs, max_iterations=30))
+    best_fit_r, _, extra_fields_r, _ = optimizer.run(init_params, checkpoint_path=path, resume=True, **kwargs)
+    npt.assert_allclose(best_fit_r['x'], best_fit['x'], rtol=1e-6)
+    npt.assert_allclose(extra_fields_r['loss_history'], extra_fields['loss_history'], rtol=1e-6)
+    assert len(extra_fields_r['param_history']) == 50
+
+
+def test_jaxopt_resume(tmp_path):
+    path = str(tmp_path / 'jaxopt.npz')
+    optimizer = JaxoptOptimizer(Loss(QuadraticModel()))
+    init_params = {'x': jnp.array([3., 2., 1.])}
+    best_fit, _, extra_fields, _ = optimizer.run(init_params, method='LBFGS', maxiter=8)
+    optimizer.run(init_params, method='LBFGS', maxiter=5, checkpoint_path=path, checkpoint_every=2)
+    best_fit_r, _, extra_fields_r, _ = optimizer.run(init_params, method='LBFGS', maxiter=8, resume=path)
+    npt.assert_allclose(best_fit_r['x'], best_fit['x'], rtol=1e-6)
+    npt.assert_allclose(extra_fields_r['loss_history'], extra_fields['loss_history'], rtol=1e-6)
+
+
+def test_hmc_blackjax_resume(tmp_path):
+    pytest.importorskip("blackjax")
+    path = str(tmp_path / 'hmc.npz')
+    sampler = Sampler(Loss(QuadraticModel()))
+    init_params = {'x': jnp.zeros(3)}
+    kwargs = dict(num_warmup=50, sampler_type='NUTS', use_stan_warmup=True)
+    samples, logL, _, _ = sampler.hmc_blackjax(0, init_params, num_samples=40, **kwargs)
+    # simulate an interrupted run
+    sampler.hmc_blackjax(0, init_params, num_samples=15, checkpoint_path=path, checkpoint_every=15, **kwargs)
+    samples_r, logL_r, _, _ = sampler.hmc_blackjax(0, init_params, num_samples=40, 
+                                                   checkpoint_path=path, resume=True, **kwargs)
+    assert samples_r['x'].shape == (40, 3)
+    npt.assert_allclose(samples_r['x'], samples['x'], rtol=1e-5)
+    npt.assert_allclose(logL_r, logL, rtol=1e-5)
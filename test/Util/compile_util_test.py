@@ -0,0 +1,151 @@
+# Testing the compilation utilities
+# 
+# Copyright (c) 2024, herculens developers and contributors
+
+import os
+import json
+import subprocess
+import sys
+import numpy as np
+import jax
+
+from herculens.Coordinates.pixel_grid import PixelGrid
+from herculens.Instrument.psf import PSF
+from herculens.MassModel.mass_model import MassModel
+from herculens.LightModel.light_model import LightModel
+from herculens.LensImage.lens_image import LensImage
+from herculens.Util.compile_util import model_fingerprint
+
+
+def _setup_lens_image(npix=20, source_profiles=('SERSIC_ELLIPSE',), supersampling_factor=1):
+    pixel_grid = PixelGrid(nx=npix, ny=npix, transform_pix2angle=0.1 * np.eye(2),
+                           ra_at_xy_0=-1., dec_at_xy_0=-1.)
+    psf = PSF(psf_type='GAUSSIAN', fwhm=0.2, pixel_size=0.1)
+    return LensImage(pixel_grid, psf,
+                     lens_mass_model_class=MassModel(['SIE']),
+                     source_model_class=LightModel(list(source_profiles)),
+                     kwargs_numerics={'supersampling_factor': supersampling_factor})
+
+
+def test_model_fingerprint():
+    fingerprint = model_fingerprint(_setup_lens_image())
+    assert fingerprint == model_fingerprint(_setup_lens_image())
+    assert len(fingerprint) == 16
+    assert fingerprint != model_fingerprint(_setup_lens_image(npix=22))
+    assert fingerprint != model_fingerprint(_setup_lens_image(source_profiles=('SERSIC',)))
+    assert fingerprint != model_fingerprint(_setup_lens_image(supersampling_factor=2))
+    assert fingerprint != model_fingerprint(_setup_lens_image(), band='F160W')
+
+
+_KWARGS_SOURCE = [{'amp': 1., 'R_sersic': 0.3, 'n_sersic': 2., 'e1': 0., 'e2': 0., 'center_x': 0., 'center_y': 0.}]
+
+
+class _ProbModel(object):
+
+    def __init__(self, lens_image, data):
+        self.lens_image = lens_image
+        self.data = data
+
+    def log_prob(self, params, constrained=False):
+        import jax.numpy as jnp
+        kwargs_lens = [{'theta_E': params['theta_E'], 'e1': 0., 'e2': 0., 'center_x': 0., 'center_y': 0.}]
+        model = self.lens_image.model(kwargs_lens=kwargs_lens, kwargs_source=_KWARGS_SOURCE)
+        return - 0.5 * jnp.sum((self.data - model)**2)
+
+
+_LENS_IMAGE = _setup_lens_image()
+
+
+def _make_loss(data):
+    # the model structure is shared, only the data differ from one lens to another
+    from herculens.Inference.loss import Loss
+    return Loss(_ProbModel(_LENS_IMAGE, data))
+
+
+_SCRIPT = """
+import json, sys
+import numpy as np
+import jax.numpy as jnp
+sys.path.insert(0, {test_dir!r})
+from compile_util_test import _setup_lens_image, _make_loss, _KWARGS_SOURCE
+from herculens.Util.compile_util import model_fingerprint, enable_compilation_cache, warm_start
+
+lens_image = _setup_lens_image()
+data = {data_value} * np.ones((20, 20))  # a different lens in each process
+
+enable_compilation_cache({cache_dir!r}, fingerprint=model_fingerprint(lens_image), min_compile_time_secs=0.)
+params = {{'theta_E': jnp.array(1.)}}
+report = warm_start(None, params, lens_image=lens_image,
+                    kwargs_model={{'kwargs_lens': [{{'theta_E': 1., 'e1': 0., 'e2': 0., 'center_x': 0., 'center_y': 0.}}],
+                                  'kwargs_source': _KWARGS_SOURCE}},
+                    make_loss=_make_loss, data=data)
+np.testing.assert_allclose(report['loss.gradient']['compiled'](params, data)['theta_E'],
+                           _make_loss(data).gradient(params)['theta_E'], rtol=1e-6)
+print(json.dumps({{name: {{k: v for k, v in r.items() if k != 'compiled'}} for name, r in report.items()}}))
+"""
+
+
+def test_persistent_cache(tmp_path):
+    reports = []
+    for data_value in (1., 2.):
+        script = _SCRIPT.format(test_dir=os.path.dirname(os.path.abspath(__file__)),
+                                cache_dir=str(tmp_path / 'cache'), data_value=data_value)
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+        reports.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    assert set(reports[0].keys()) == {'loss.function', 'loss.gradient', 'loss.value_and_gradient', 'lens_image.model'}
+    # the first process compiles and writes to the cache, the second reads from it
+    # even though the data differ, since they are arguments of the executables
+    assert all(r['cache_misses'] >= 1 and r['cache_hits'] == 0 for r in reports[0].values())
+    assert all(r['cache_hits'] >= 1 and r['cache_misses'] == 0 for r in reports[1].values())
+    assert len(os.listdir(tmp_path / 'cache')) == 1  # one sub-directory per fingerprint
+
+
+def test_warm_start_data_arguments():
+    import jax.numpy as jnp
+    from herculens.Util.compile_util import warm_start
+    params = {'theta_E': jnp.array(1.)}
+    data_1, data_2 = np.ones((20, 20)), np.random.RandomState(0).rand(20, 20)
+    # with the data stored in the loss, they are constants of the executable
+    report = warm_start(_make_loss(data_1), params, methods=('function',))
+    np.testing.assert_allclose(report['loss.function']['compiled'](params),
+                               _make_loss(data_1).function(params), rtol=1e-6)
+    # with the data as an argument, the executable compiled for one lens is re-used for another
+    report = warm_start(None, params, make_loss=_make_loss, data=data_1)
+    for name in ('function', 'gradient', 'value_and_gradient'):
+        compiled = report[f'loss.{name}']['compiled']
+        for data in (data_1, data_2):
+            np.testing.assert_allclose(
+                jnp.stack(jax.tree_util.tree_leaves(compiled(params, data))),
+                jnp.stack(jax.tree_util.tree_leaves(getattr(_make_loss(data), name)(params))), rtol=1e-6)
+
+
+def test_profile_compilation():
+    from herculens.Inference.loss import Loss
+    from herculens.Util.compile_util import profile_compilation, format_compilation_report
+    kwargs_sie = {'theta_E': 0.2, 'e1': 0., 'e2': 0., 'center_x': 0., 'center_y': 0.}
+    kwargs_source = [{'amp': 1., 'R_sersic': 0.3, 'n_sersic': 2., 'e1': 0., 'e2': 0.,
+                      'center_x': 0., 'center_y': 0.}]
+    reports = {}
+    for num_profiles in (1, 6):
+        lens_image = _setup_lens_image()
+        lens_image.MassModel = MassModel(['SIE'] * num_profiles)
+        reports[num_profiles] = profile_compilation(
+            lens_image, kwargs_lens=[kwargs_sie] * num_profiles, kwargs_source=kwargs_source)
+    report = reports[6]
+    assert set(report.keys()) == {'mass', 'source', 'convolution', 'model'}
+    for r in report.values():
+        assert r['compile_time'] > 0. and r['hlo_op_count'] > 0
+        assert sum(r['hlo_op_counts'].values()) == r['hlo_op_count']
+        assert r['temp_size_in_bytes'] >= 0
+    # the Python loop over mass profiles is unrolled, which only affects the mass component
+    assert report['mass']['hlo_op_count'] > 4 * reports[1]['mass']['hlo_op_count']
+    assert report['source']['hlo_op_count'] == reports[1]['source']['hlo_op_count']
+    assert len(format_compilation_report(report).splitlines()) == 2 + len(report)
+
+    class ProbModel:
+        def log_prob(self, params, constrained=False):
+            return - 0.5 * (params['x']**2).sum()
+
+    report = profile_compilation(lens_image, kwargs_lens=[kwargs_sie] * 6, kwargs_source=kwargs_source,
+                                 loss=Loss(ProbModel()), params={'x': np.ones(3)})
+    assert 'loss.gradient' in report